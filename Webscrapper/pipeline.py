@@ -0,0 +1,263 @@
+"""
+Staged ingestion pipeline that scrapes sources straight into Mongo:
+
+    fetch -> parse -> normalize -> dedupe -> embed -> write
+
+Stages are connected by bounded queues, so a slow stage (usually embed)
+makes the ones before it wait instead of piling work up in memory. Each
+stage runs its own number of workers, can take its input in batches and
+keeps throughput and latency counters. Jobs are written through db.py
+directly rather than through the REST server.
+
+    python -m Webscrapper.pipeline           # one run
+    python -m Webscrapper.pipeline daemon    # a run every PIPELINE_INTERVAL seconds
+"""
+
+import asyncio
+import collections
+import datetime
+import inspect
+import os
+import sys
+import threading
+import time
+
+import aiohttp
+
+import db.db as db
+import db.schema as schema
+import Webscrapper.scrapper as scrapper
+
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 1000))
+PARSE_WORKERS = int(os.environ.get("PIPELINE_PARSE_WORKERS", 2))
+EMBED_WORKERS = int(os.environ.get("PIPELINE_EMBED_WORKERS", 4))
+WRITE_WORKERS = int(os.environ.get("PIPELINE_WRITE_WORKERS", 2))
+DEDUPE_BATCH_SIZE = 500
+EMBED_BATCH_SIZE = db.BULK_EMBED_BATCH_SIZE
+WRITE_BATCH_SIZE = 500
+LINGER = 0.2
+INTERVAL = float(os.environ.get("PIPELINE_INTERVAL", 3600))
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+    func takes an item, or a list of up to batch_size items when
+    batch_size is set, and returns an iterable of items for the next
+    stage (it may be a coroutine function). Blocking funcs run in the
+    default thread pool so they don't stall the other stages.
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=None, blocking=False, linger=LINGER):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.blocking = blocking
+        self.linger = linger
+        self.counters = {"in": 0, "out": 0, "errors": 0, "calls": 0,
+                         "busy": 0.0, "max_latency": 0.0, "max_queued": 0}
+
+    async def work(self, inbox, outbox):
+        while True:
+            items = [await inbox.get()]
+            self.counters["max_queued"] = max(self.counters["max_queued"], inbox.qsize() + 1)
+            if self.batch_size:
+                _drain(inbox, items, self.batch_size)
+                if len(items) < self.batch_size and self.linger:
+                    # give upstream a moment to fill the batch
+                    await asyncio.sleep(self.linger)
+                    _drain(inbox, items, self.batch_size)
+            outputs = await self._call(items if self.batch_size else items[0], len(items))
+            for output in outputs:
+                if outbox is not None:
+                    await outbox.put(output)
+            for _ in items:
+                inbox.task_done()
+
+    async def _call(self, arg, count):
+        started = time.monotonic()
+        try:
+            if self.blocking:
+                outputs = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: list(self.func(arg)))
+            else:
+                outputs = self.func(arg)
+                if inspect.isawaitable(outputs):
+                    outputs = await outputs
+                outputs = list(outputs)
+        except Exception as e:
+            print(f"{self.name}: {count} items failed: {e}")
+            self.counters["errors"] += count
+            outputs = []
+        latency = time.monotonic() - started
+        self.counters["in"] += count
+        self.counters["out"] += len(outputs)
+        self.counters["calls"] += 1
+        self.counters["busy"] += latency
+        self.counters["max_latency"] = max(self.counters["max_latency"], latency)
+        return outputs
+
+
+def _drain(queue, items, limit):
+    while len(items) < limit and not queue.empty():
+        items.append(queue.get_nowait())
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues.
+    """
+
+    def __init__(self, stages, queue_size=QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.elapsed = 0.0
+
+    async def run(self, items):
+        '''
+        Feeds items to the first stage and returns once every stage has
+        drained. Returns stats().
+        '''
+        started = time.monotonic()
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        workers = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            workers.append([asyncio.ensure_future(stage.work(queues[i], outbox))
+                            for _ in range(stage.workers)])
+        try:
+            for item in items:
+                await queues[0].put(item)
+            # items only flow forward, so once a stage's queue is drained
+            # nothing new can reach it
+            for queue, tasks in zip(queues, workers):
+                await queue.join()
+                for task in tasks:
+                    task.cancel()
+        finally:
+            every = [task for tasks in workers for task in tasks]
+            for task in every:
+                task.cancel()
+            await asyncio.gather(*every, return_exceptions=True)
+            self.elapsed = time.monotonic() - started
+        return self.stats()
+
+    def stats(self):
+        res = {}
+        for stage in self.stages:
+            counters = dict(stage.counters)
+            counters["throughput"] = counters["out"] / self.elapsed if self.elapsed else 0.0
+            counters["avg_latency"] = (counters["busy"] / counters["calls"]
+                                       if counters["calls"] else 0.0)
+            res[stage.name] = counters
+        return res
+
+    def errors(self):
+        return sum(stage.counters["errors"] for stage in self.stages)
+
+
+def normalize_job(job):
+    '''
+    job: a scraped job with a YYYY-MM-DD date
+    Returns [job] with stripped strings and a datetime date.
+    '''
+    job = {key: value.strip() if isinstance(value, str) else value
+           for key, value in job.items()}
+    job["date"] = datetime.datetime.strptime(job["date"], "%Y-%m-%d")
+    return [job]
+
+
+def build_pipeline(session, previous, fetched, outcomes):
+    '''
+    session: the aiohttp session sources are fetched with
+    previous: the conditional fetch state of the last run
+    fetched: filled with the new state of every source fetched
+    outcomes: Counter of what happened to each job
+    '''
+    seen = set()
+    # blocking stages run in worker threads and share outcomes and seen
+    lock = threading.Lock()
+
+    async def fetch(url):
+        html, state = await scrapper.fetch_source(session, url, previous.get(url, {}))
+        fetched[url] = state
+        return [] if html is None else [html]
+
+    def dedupe(jobs):
+        results, docs, _ = db.dedupe_job_postings(jobs)
+        fresh = []
+        with lock:
+            outcomes.update(result["status"] for result in results if result is not None)
+            for doc in docs:
+                # two batches of one run can carry the same new posting
+                if doc["fingerprint"] in seen:
+                    outcomes["unchanged"] += 1
+                    continue
+                seen.add(doc["fingerprint"])
+                fresh.append(doc)
+        return fresh
+
+    def embed(docs):
+        return zip(docs, db.embed_job_docs(docs, EMBED_BATCH_SIZE))
+
+    def write(pairs):
+        docs, vectors = zip(*pairs)
+        results = db.insert_job_docs(list(docs), list(vectors))
+        with lock:
+            outcomes.update(result["status"] for result in results)
+        return results
+
+    return Pipeline([
+        Stage("fetch", fetch, workers=scrapper.CONCURRENCY),
+        Stage("parse", scrapper.parse_jobs, workers=PARSE_WORKERS, blocking=True),
+        Stage("normalize", normalize_job),
+        Stage("dedupe", dedupe, batch_size=DEDUPE_BATCH_SIZE, blocking=True),
+        Stage("embed", embed, workers=EMBED_WORKERS, batch_size=EMBED_BATCH_SIZE,
+              blocking=True),
+        Stage("write", write, workers=WRITE_WORKERS, batch_size=WRITE_BATCH_SIZE,
+              blocking=True),
+    ])
+
+
+async def ingest(sources=scrapper.SOURCES, state_path=scrapper.STATE_PATH):
+    '''
+    Runs the pipeline once over sources, after making sure the indexes
+    deduplication relies on exist (the unique fingerprint index).
+    The fetch state is only saved if no stage failed, so the next run
+    fetches everything again; deduplication makes that cheap.
+    Returns {"stages": per stage stats, "jobs": counts per outcome}.
+    '''
+    schema.ensure_indexes()
+    previous = scrapper.load_state(state_path)
+    fetched = {}
+    outcomes = collections.Counter()
+    connector = aiohttp.TCPConnector(limit=scrapper.CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=scrapper.TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pipeline = build_pipeline(session, previous, fetched, outcomes)
+        stats = await pipeline.run(sources)
+    if pipeline.errors():
+        print(f"{pipeline.errors()} items failed; keeping the previous fetch state")
+    else:
+        previous.update(fetched)
+        scrapper.save_state(previous, state_path)
+    return {"stages": stats, "jobs": dict(outcomes)}
+
+
+def print_summary(summary):
+    for name, counters in summary["stages"].items():
+        print(f"{name:>9}: in {counters['in']:>6} out {counters['out']:>6} "
+              f"errors {counters['errors']:>4} {counters['throughput']:8.1f}/s "
+              f"avg {counters['avg_latency'] * 1000:7.1f}ms "
+              f"max {counters['max_latency'] * 1000:7.1f}ms")
+    print(f"jobs: {summary['jobs']}")
+
+
+if __name__ == "__main__":
+    daemon = len(sys.argv) > 1 and sys.argv[1] == "daemon"
+    while True:
+        print_summary(asyncio.run(ingest()))
+        if not daemon:
+            break
+        time.sleep(INTERVAL)
@@ -1,37 +1,204 @@
-import requests
-from bs4 import BeautifulSoup
+"""
+Scrapes job tables and posts them to the server's bulk endpoint.
+Every source is fetched through one shared keep-alive session with at
+most CONCURRENCY requests in flight. Sources are fetched conditionally
+(If-None-Match / If-Modified-Since) and the hash of the last page seen
+is stored in STATE_PATH, so an unchanged source is neither parsed nor
+posted again. Tables are parsed with lxml when it is installed and with
+BeautifulSoup otherwise.
+"""
+
+import asyncio
+import hashlib
 import json
+import os
+
+import aiohttp
+
+try:
+    import lxml.html as lxml_html
+except ImportError:
+    lxml_html = None
+
+SOURCES = ["https://github.com/SimplifyJobs/Summer2024-Internships"]
+API_URL = os.environ.get("SCRAPER_API_URL", "http://localhost:8000")
+ADD_JOBS_ENDPOINT = "/add_new_jobs_bulk"
+STATE_PATH = os.environ.get(
+    "SCRAPER_STATE_PATH", os.path.join(os.path.dirname(__file__), "scrape_state.json")
+)
+BULK_SIZE = 500
+CONCURRENCY = int(os.environ.get("SCRAPER_CONCURRENCY", 4))
+TIMEOUT = 60
+YEAR = "2024"
+
+month_to_num = {"jan": '01', "feb": '02', "mar": '03', "apr": '04', "may": '05', "jun": '06',
+                "jul": '07', "aug": '08', "sep": '09', "oct": '10', "nov": '11', "dec": '12'}
+
+TABLE_CLASS = "ehcSsh"
+TABLE_XPATH = (
+    f"//div[contains(concat(' ', normalize-space(@class), ' '), ' {TABLE_CLASS} ')]//table"
+)
+SAME_COMPANY = '↳'
 
-month_to_num = {"jan": '01', "feb": '02', "mar": '03', "apr": '04', "may": '05', "jun": '06', "jul": '07', "aug": '08', "sep": '09', "oct": '10', "nov": '11', "dec": '12'}
-add_job_url = 'http://localhost:8000/add_new_job?company={}&job_description={}&job_type={}&location={}&date={}&link={}'
-def scrap_job_table(url): 
+
+def parse_jobs(html, year=YEAR, fast=True):
     """
-    Scrap job table from a given URL, extract job details, and post them to a specified endpoint.
+    Extract the jobs from a SimplifyJobs style table.
+    Rows are read newest first and parsing stops at the first December
+    posting, which belongs to the previous season.
     """
-    res = requests.get(url)
-    soup = BeautifulSoup(res.content, 'html.parser')
-    div = soup.find('div', class_='Box-sc-g0xbh4-0 ehcSsh')
+    rows = _rows_lxml(html) if fast and lxml_html is not None else _rows_bs4(html)
     company = None
-    jobs = div.find('table')
-    for job in jobs.find_all('tr'):
-        columns = job.find_all('td')
-        if(len(columns) != 5): 
-            continue
-        if columns[0].text != '↳':
-            company = columns[0].text
-        job_title = columns[1].text
-        location = columns[2].text
-        link = str(columns[3].find('a')['href'])
-        date = columns[4].text
+    found = []
+    for first, job_title, location, link, date in rows:
+        if first != SAME_COMPANY:
+            company = first
         month, day = date.split()
-        date = f"{month} {day}"
-        year = "2024"
-        date_iso = f"{year}-{month_to_num[month.lower()]}-{day}"
-        if(month == 'Dec'): 
+        if month == 'Dec':
             break
-        res = requests.post(add_job_url.format(company, "", job_title,  location, date_iso, link))
-        # break
-    pass 
+        if link is None:
+            # closed postings have no application link
+            continue
+        date_iso = f"{year}-{month_to_num[month.lower()]}-{int(day):02d}"
+        found.append({"company": company, "job_description": "", "job_type": job_title,
+                      "location": location, "date": date_iso, "link": link})
+    return found
+
+
+def _rows_lxml(html):
+    tree = lxml_html.fromstring(html)
+    tables = tree.xpath(TABLE_XPATH)
+    if not tables:
+        return
+    for row in tables[0].iter("tr"):
+        columns = row.findall("td")
+        if len(columns) != 5:
+            continue
+        links = columns[3].xpath(".//a/@href")
+        yield (columns[0].text_content(), columns[1].text_content(),
+               columns[2].text_content(), str(links[0]) if links else None,
+               columns[4].text_content())
+
+
+def _rows_bs4(html):
+    from bs4 import BeautifulSoup
+    table = BeautifulSoup(html, 'html.parser').select_one(f"div.{TABLE_CLASS} table")
+    if table is None:
+        return
+    for row in table.find_all('tr'):
+        columns = row.find_all('td')
+        if len(columns) != 5:
+            continue
+        link = columns[3].find('a')
+        yield (columns[0].text, columns[1].text, columns[2].text,
+               str(link['href']) if link is not None else None, columns[4].text)
+
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_PATH):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+async def fetch_source(session, url, previous):
+    """
+    Fetch url unless it is unchanged since previous (its stored state).
+    Returns (html, state), with html None when the source is unchanged.
+    """
+    headers = {}
+    if previous.get("etag"):
+        headers["If-None-Match"] = previous["etag"]
+    if previous.get("last_modified"):
+        headers["If-Modified-Since"] = previous["last_modified"]
+    async with session.get(url, headers=headers) as res:
+        if res.status == 304:
+            return None, previous
+        res.raise_for_status()
+        html = await res.text()
+        state = {
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "hash": hashlib.sha256(html.encode("utf-8")).hexdigest(),
+        }
+    if state["hash"] == previous.get("hash"):
+        return None, state
+    return html, state
+
+
+async def post_jobs(session, jobs, api_url=API_URL, bulk_size=BULK_SIZE):
+    """
+    Post jobs to the bulk endpoint bulk_size at a time, concurrently.
+    Returns the summed counts of the responses.
+    """
+    async def post(chunk):
+        async with session.post(api_url + ADD_JOBS_ENDPOINT, json=chunk) as res:
+            res.raise_for_status()
+            return await res.json()
+
+    bodies = await asyncio.gather(*(
+        post(jobs[start:start + bulk_size]) for start in range(0, len(jobs), bulk_size)
+    ))
+    totals = {}
+    for body in bodies:
+        for key, value in body.items():
+            if isinstance(value, int):
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+async def scrape_source(session, url, state, api_url=API_URL):
+    html, new_state = await fetch_source(session, url, state.get(url, {}))
+    if html is None:
+        state[url] = new_state
+        print(f"{url}: unchanged")
+        return {"unchanged_source": True}
+    # parsing a large table is CPU bound; keep the event loop fetching
+    jobs = await asyncio.get_running_loop().run_in_executor(None, parse_jobs, html)
+    totals = await post_jobs(session, jobs, api_url)
+    # only remember the page once its jobs are stored
+    state[url] = new_state
+    print(f"{url}: {len(jobs)} jobs, {totals}")
+    return totals
+
+
+async def scrape(sources=SOURCES, api_url=API_URL, state_path=STATE_PATH,
+                 concurrency=CONCURRENCY):
+    """
+    Scrape every source through one session and return a summary per source.
+    A failing source is reported and does not stop the others.
+    """
+    state = load_state(state_path)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(
+            *(scrape_source(session, url, state, api_url) for url in sources),
+            return_exceptions=True,
+        )
+    save_state(state, state_path)
+    summary = {}
+    for url, result in zip(sources, results):
+        if isinstance(result, Exception):
+            print(f"{url}: failed: {result}")
+            result = {"error": str(result)}
+        summary[url] = result
+    return summary
+
+
+def scrap_job_table(url):
+    """
+    Scrap job table from a given URL, extract job details, and post them to a specified endpoint.
+    """
+    return asyncio.run(scrape([url]))[url]
+
 
 if __name__ == "__main__":
-    scrap_job_table("https://github.com/SimplifyJobs/Summer2024-Internships")
+    asyncio.run(scrape())
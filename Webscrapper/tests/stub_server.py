@@ -0,0 +1,51 @@
+from aiohttp import web
+
+import Webscrapper.scrapper as scrapper
+
+PAGE_PATH = "/page"
+
+
+class StubServer:
+    """
+    A local server with one job page and a fake bulk endpoint.
+    """
+
+    def __init__(self, html, etag='"v1"', last_modified="Wed, 14 Feb 2024 00:00:00 GMT"):
+        self.html = html
+        self.etag = etag
+        self.last_modified = last_modified
+        self.page_requests = []
+        self.posted = []
+        self.fail_posts = False
+
+    async def page(self, request):
+        self.page_requests.append(dict(request.headers))
+        headers = {}
+        if self.etag:
+            headers["ETag"] = self.etag
+            if request.headers.get("If-None-Match") == self.etag:
+                return web.Response(status=304, headers=headers)
+        if self.last_modified:
+            headers["Last-Modified"] = self.last_modified
+        return web.Response(text=self.html, content_type="text/html", headers=headers)
+
+    async def bulk(self, request):
+        if self.fail_posts:
+            return web.Response(status=500)
+        jobs = await request.json()
+        self.posted.append(jobs)
+        return web.json_response({"created": len(jobs), "failed": 0, "results": []})
+
+    async def run(self, coro_factory):
+        app = web.Application()
+        app.router.add_get(PAGE_PATH, self.page)
+        app.router.add_post(scrapper.ADD_JOBS_ENDPOINT, self.bulk)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await coro_factory(f"http://127.0.0.1:{port}")
+        finally:
+            await runner.cleanup()
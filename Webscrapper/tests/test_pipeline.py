@@ -0,0 +1,160 @@
+import asyncio
+import contextlib
+import os
+import threading
+from unittest.mock import patch
+
+import pytest
+
+import Webscrapper.pipeline as pipeline
+from stub_server import PAGE_PATH, StubServer
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def run(stages, items, queue_size=10):
+    return asyncio.run(pipeline.Pipeline(stages, queue_size).run(items))
+
+
+def test_items_flow_through_stages():
+    collected = []
+    stats = run([
+        pipeline.Stage("split", lambda x: [x, x + 100]),
+        pipeline.Stage("batch", lambda xs: [sum(xs)], batch_size=4, linger=0.01),
+        pipeline.Stage("collect", lambda x: collected.append(x) or []),
+    ], range(4))
+    assert sum(collected) == sum(range(4)) * 2 + 400
+    assert stats["split"]["in"] == 4
+    assert stats["split"]["out"] == 8
+    assert stats["batch"]["in"] == 8
+    assert stats["batch"]["calls"] < 8
+    assert stats["collect"]["in"] == stats["batch"]["out"]
+
+
+def test_bounded_queues_apply_backpressure():
+    async def slow(x):
+        await asyncio.sleep(0.001)
+        return []
+
+    stats = run([
+        pipeline.Stage("burst", lambda x: range(50)),
+        pipeline.Stage("slow", slow),
+    ], range(3), queue_size=5)
+    assert stats["slow"]["in"] == 150
+    assert stats["slow"]["max_queued"] <= 5
+
+
+def test_errors_are_counted_and_do_not_stop_the_run():
+    def fail_odd(x):
+        if x % 2:
+            raise ValueError("odd")
+        return [x]
+
+    stats = run([pipeline.Stage("filter", fail_odd, workers=3)], range(10))
+    assert stats["filter"]["errors"] == 5
+    assert stats["filter"]["out"] == 5
+
+
+def test_blocking_stages_run_off_the_event_loop():
+    threads = []
+    run([pipeline.Stage("block", lambda x: threads.append(threading.current_thread()) or [],
+                        blocking=True)], range(3))
+    assert threading.main_thread() not in threads
+
+
+def test_stats_have_throughput_and_latency():
+    stats = run([pipeline.Stage("noop", lambda x: [x])], range(5))
+    assert stats["noop"]["throughput"] > 0
+    assert stats["noop"]["avg_latency"] >= 0
+    assert stats["noop"]["max_latency"] >= stats["noop"]["avg_latency"]
+
+
+def test_normalize_job():
+    [job] = pipeline.normalize_job({"company": " Apple ", "date": "2024-02-03"})
+    assert job["company"] == "Apple"
+    assert job["date"].year == 2024
+    with pytest.raises(ValueError):
+        pipeline.normalize_job({"company": "Apple", "date": "Feb 3"})
+
+
+class FakeDB:
+    """
+    Stands in for the db.py ingestion steps.
+    """
+
+    def __init__(self, existing=(), fail_insert=False):
+        self.existing = set(existing)
+        self.inserted = []
+        self.embedded = 0
+        self.ensured = 0
+        self.fail_insert = fail_insert
+
+    def ensure_indexes(self):
+        self.ensured += 1
+
+    def dedupe(self, jobs):
+        results, docs, positions = [None] * len(jobs), [], []
+        for i, job in enumerate(jobs):
+            if job["link"] in self.existing:
+                results[i] = {"index": i, "status": "unchanged", "job_id": "x"}
+            else:
+                docs.append(dict(job, fingerprint=job["link"]))
+                positions.append(i)
+        return results, docs, positions
+
+    def embed(self, docs, batch_size):
+        self.embedded += len(docs)
+        return [[0.0]] * len(docs)
+
+    def insert(self, docs, vectors):
+        if self.fail_insert:
+            raise RuntimeError("mongo down")
+        self.inserted.extend(docs)
+        return [{"status": "created", "job_id": doc["link"]} for doc in docs]
+
+    @contextlib.contextmanager
+    def patch(self):
+        with patch.multiple(pipeline.db, dedupe_job_postings=self.dedupe,
+                            embed_job_docs=self.embed, insert_job_docs=self.insert), \
+                patch.object(pipeline.schema, "ensure_indexes", self.ensure_indexes):
+            yield
+
+
+def ingest(server, state_path, runs=1):
+    async def go(base):
+        return [await pipeline.ingest([base + PAGE_PATH], state_path) for _ in range(runs)]
+    return asyncio.run(server.run(go))
+
+
+def page():
+    with open(os.path.join(FIXTURES, "jobs_table.html"), encoding="utf-8") as f:
+        return f.read()
+
+
+def test_ingest_writes_new_jobs(tmp_path):
+    fake = FakeDB(existing={"https://jobs.apple.com/2"})
+    with fake.patch():
+        [summary] = ingest(StubServer(page()), str(tmp_path / "state.json"))
+    assert summary["jobs"] == {"created": 2, "unchanged": 1}
+    assert fake.ensured == 1
+    assert fake.embedded == 2
+    assert [doc["company"] for doc in fake.inserted] == ["Apple", "Microsoft"]
+    assert summary["stages"]["write"]["out"] == 2
+
+
+def test_ingest_skips_unchanged_sources(tmp_path):
+    fake = FakeDB()
+    with fake.patch():
+        first, second = ingest(StubServer(page()), str(tmp_path / "state.json"), runs=2)
+    assert first["jobs"] == {"created": 3}
+    assert second["jobs"] == {}
+    assert second["stages"]["parse"]["in"] == 0
+
+
+def test_ingest_failure_keeps_state_for_retry(tmp_path):
+    fake = FakeDB(fail_insert=True)
+    state_path = str(tmp_path / "state.json")
+    with fake.patch():
+        [summary] = ingest(StubServer(page()), state_path)
+    assert summary["stages"]["write"]["errors"] == 3
+    assert not os.path.exists(state_path)
@@ -0,0 +1,121 @@
+import asyncio
+import os
+
+import pytest
+
+import Webscrapper.scrapper as scrapper
+from stub_server import PAGE_PATH, StubServer
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+EXPECTED = [
+    {"company": "Apple", "job_description": "", "job_type": "Software Engineering Intern",
+     "location": "Cupertino, CA", "date": "2024-02-14",
+     "link": "https://jobs.apple.com/1?utm_source=Simplify"},
+    {"company": "Apple", "job_description": "", "job_type": "Machine Learning Intern",
+     "location": "Seattle, WA", "date": "2024-02-03", "link": "https://jobs.apple.com/2"},
+    {"company": "Microsoft", "job_description": "", "job_type": "Explore Intern",
+     "location": "Redmond, WA", "date": "2024-01-12",
+     "link": "https://careers.microsoft.com/3"},
+]
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "state.json")
+
+
+def scrape(server, state_path, between_runs=()):
+    """
+    Runs one scrape, plus one more after each function in between_runs.
+    Returns the summary of every run.
+    """
+    async def run(base):
+        url = base + PAGE_PATH
+        summaries = []
+        for change in (None, *between_runs):
+            if change is not None:
+                change()
+            summary = await scrapper.scrape([url], api_url=base, state_path=state_path)
+            summaries.append(summary[url])
+        return summaries
+    return asyncio.run(server.run(run))
+
+
+def nothing():
+    pass
+
+
+def test_parse_jobs_lxml():
+    assert scrapper.parse_jobs(fixture("jobs_table.html")) == EXPECTED
+
+
+def test_parse_jobs_bs4_matches_lxml():
+    assert scrapper.parse_jobs(fixture("jobs_table.html"), fast=False) == EXPECTED
+
+
+def test_parse_jobs_without_table():
+    assert scrapper.parse_jobs(fixture("no_table.html")) == []
+    assert scrapper.parse_jobs(fixture("no_table.html"), fast=False) == []
+
+
+def test_scrape_posts_jobs(state_path):
+    server = StubServer(fixture("jobs_table.html"))
+    assert scrape(server, state_path) == [{"created": 3, "failed": 0}]
+    assert server.posted == [EXPECTED]
+    assert scrapper.load_state(state_path)
+
+
+def test_scrape_posts_in_bulk_chunks(state_path, monkeypatch):
+    monkeypatch.setattr(scrapper, "BULK_SIZE", 2)
+    server = StubServer(fixture("jobs_table.html"))
+
+    async def run(base):
+        async with scrapper.aiohttp.ClientSession() as session:
+            return await scrapper.post_jobs(session, EXPECTED, api_url=base, bulk_size=2)
+
+    assert asyncio.run(server.run(run)) == {"created": 3, "failed": 0}
+    assert sorted(len(chunk) for chunk in server.posted) == [1, 2]
+
+
+def test_unchanged_source_uses_conditional_get(state_path):
+    server = StubServer(fixture("jobs_table.html"))
+    assert scrape(server, state_path, [nothing])[1] == {"unchanged_source": True}
+    assert server.page_requests[-1]["If-None-Match"] == '"v1"'
+    assert server.page_requests[-1]["If-Modified-Since"] == server.last_modified
+    assert len(server.posted) == 1
+
+
+def test_unchanged_source_detected_by_hash(state_path):
+    server = StubServer(fixture("jobs_table.html"), etag=None, last_modified=None)
+    assert scrape(server, state_path, [nothing])[1] == {"unchanged_source": True}
+    assert "If-None-Match" not in server.page_requests[-1]
+    assert len(server.posted) == 1
+
+
+def test_changed_source_is_posted_again(state_path):
+    server = StubServer(fixture("jobs_table.html"))
+
+    def change():
+        server.etag = '"v2"'
+        server.html = server.html.replace("Explore Intern", "Explore Program Intern")
+
+    assert scrape(server, state_path, [change])[1] == {"created": 3, "failed": 0}
+    assert server.posted[-1][2]["job_type"] == "Explore Program Intern"
+
+
+def test_failed_post_is_retried_next_run(state_path):
+    server = StubServer(fixture("jobs_table.html"))
+    server.fail_posts = True
+
+    def recover():
+        server.fail_posts = False
+
+    failed, retried = scrape(server, state_path, [recover])
+    assert "error" in failed
+    assert retried == {"created": 3, "failed": 0}
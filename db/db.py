@@ -1,9 +1,25 @@
 import db.db_connect as dbc
+import db.embed_dispatcher as embed_dispatcher
+import db.embed_queue as embed_queue
+import db.embedders as embedders
+import db.encoder_pool as encoder_pool
+import db.embedding_cache as ec
+import db.job_events as job_events
+import db.re_embed as re_embed
+import db.resilience as resilience
+import db.schema as schema
+import db.vector_codec as vector_codec
+import db.vector_index as vector_index
+import base64
+import bson.errors as bson_errors
 import datetime
-import openai
-import time
-import random
-import os
+import json
+import pymongo
+import pymongo.errors as pm_errors
+import hashlib
+from bson.objectid import ObjectId
+from pymongo.results import InsertOneResult
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 
 """
@@ -16,12 +32,50 @@ Gradually, we will fill in actual calls to our datastore.
 # import db_connect as dbc
 # print(__name__)
 dbc.connect_db()
-open_ai_client = None
-if os.environ.get("OPENAI_API_KEY") is not None:
-    open_ai_client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# OpenAI or the local CPU embedder; see db.embedders
+embedder = embedders.from_env()
+# shared by every thread of this process, see db.resilience
+embed_breaker = resilience.CircuitBreaker()
+embed_backoff = re_embed.Backoff()
 
 DEFAULT_VECTOR = [0.0000001] * 1536
 
+# Stored with every embedding: the hash of the text it was computed from
+# and the model (and dimensions) that computed it.
+EMBEDDING_HASH_FIELD = "embedding_hash"
+EMBEDDING_MODEL_FIELD = "embedding_model"
+
+# Named projections for reads of "jobs". The embedding and the internal
+# bookkeeping fields never leave Mongo unless a caller explicitly asks.
+INTERNAL_FIELDS = (
+    "embedding_vector", EMBEDDING_HASH_FIELD, EMBEDDING_MODEL_FIELD, "fingerprint",
+    *embed_queue.FIELDS,
+)
+LISTING_PROJECTION = {field: 0 for field in INTERNAL_FIELDS}
+DETAIL_PROJECTION = dict(LISTING_PROJECTION)
+EMBEDDING_FIELDS = ("company", "location", "job_type", "date", "job_description")
+EMBEDDING_TEXT_PROJECTION = {field: 1 for field in EMBEDDING_FIELDS}
+EMBEDDING_STATE_PROJECTION = {
+    **EMBEDDING_TEXT_PROJECTION, EMBEDDING_HASH_FIELD: 1, EMBEDDING_MODEL_FIELD: 1,
+}
+ARCHIVE_COLLECTION = "jobs_archive"
+ARCHIVE_BATCH_SIZE = 1000
+REPORT_BATCH_SIZE = 500
+DUPLICATE_KEY = 11000
+JOB_FIELDS = ("company", "job_description", "job_type", "location", "date", "link")
+REQUIRED_JOB_FIELDS = ("company", "job_type", "location", "date", "link")
+BULK_EMBED_BATCH_SIZE = 100
+IDENTITY_FIELDS = ("company", "job_type", "link")
+FINGERPRINT_PROJECTION = {**{field: 1 for field in JOB_FIELDS}, "fingerprint": 1}
+FINGERPRINT_BATCH_SIZE = 1000
+# query parameters that only track where a click came from
+TRACKING_PARAMS = ("utm_", "ref", "source", "gh_src", "lever-source")
+
+SEARCH_RESULT_PROJECTION = {
+    "company": 1, "job_description": 1, "job_type": 1,
+    "location": 1, "date": 1, "link": 1,
+}
+
 job_data = {
     1: {
         "data": {"keywords": ["internship"]},
@@ -71,6 +125,11 @@ def add_job_posting(company, job_description, job_type, location, date, link):
     date: the date
     link: the link
     This function adds a new job posting to the database.
+    With EMBEDDING_QUEUE=1 the job is written straight away and embedded
+    later by the embedding workers.
+    Postings are deduplicated on job_fingerprint: posting a job that
+    already exists updates it only if something changed, and returns
+    the existing job's id as inserted_id.
     '''
     if (
         company is None
@@ -80,56 +139,298 @@ def add_job_posting(company, job_description, job_type, location, date, link):
         or link is None
     ):
         raise ValueError("None value found")
-    vector = generate_vector(
-        company
-        + " "
-        + location
-        + " "
-        + job_type
-        + " "
-        + date.strftime("%Y-%m-%d")
-        + " "
-        + job_description
+    doc = {
+        "company": company,
+        "job_description": job_description,
+        "job_type": job_type,
+        "location": location,
+        "date": date,
+        "link": link,
+        "version": 1,
+        "fingerprint": job_fingerprint(company, job_type, link),
+    }
+    current = dbc.fetch_one("jobs", {"fingerprint": doc["fingerprint"]},
+                            projection=FINGERPRINT_PROJECTION)
+    if current is not None:
+        current["_id"] = ObjectId(current["_id"])
+        _refresh_job(current, doc)
+        return InsertOneResult(current["_id"], True)
+    try:
+        return _insert_job_posting(doc)
+    except pm_errors.DuplicateKeyError:
+        # a concurrent ingest inserted the same posting first
+        return add_job_posting(company, job_description, job_type, location, date, link)
+
+
+def _insert_job_posting(doc):
+    if embed_queue.ENABLED:
+        res = dbc.insert_one("jobs", {**doc, **embed_queue.pending()})
+        job_events.changed(res.inserted_id)
+        return res
+    text = job_embedding_text(doc)
+    vector = generate_vector(text)
+    fields = embedding_fields(text, vector)
+    res = dbc.insert_one("jobs", {**doc, **fields})
+    vector_index.add(res.inserted_id, vector, fields)
+    job_events.changed(res.inserted_id)
+    return res
+
+
+def add_job_postings(jobs, batch_size=BULK_EMBED_BATCH_SIZE, indices=None):
+    '''
+    jobs: list of dicts with the add_job_posting fields
+    indices: the index each job is reported under, e.g. its position in a
+        request whose invalid items were dropped; its position in jobs
+        by default
+    Validates the jobs and looks them all up by job_fingerprint at once.
+    Known postings are left untouched ("unchanged") or updated through
+    update_job, which only re-embeds when their text changed ("updated").
+    New ones are embedded batch_size texts per API request and written
+    with one unordered insert_many, so one bad job never blocks the others.
+    Returns one result per job, in order: {"index", "status", "job_id"}
+    or {"index", "status": "error", "message"}.
+    '''
+    indices = list(range(len(jobs))) if indices is None else indices
+    results, docs, positions = dedupe_job_postings(jobs, indices)
+    vectors = embed_job_docs(docs, batch_size)
+    for i, result in zip(positions, insert_job_docs(docs, vectors)):
+        results[i] = {"index": indices[i], **result}
+    return results
+
+
+def dedupe_job_postings(jobs, indices=None):
+    '''
+    jobs: list of dicts with the add_job_posting fields
+    indices: as for add_job_postings
+    The first step of add_job_postings: validates the jobs and settles
+    those that already exist.
+    Returns (results, docs, positions): results has an entry for every
+    job settled here and None for the new ones, which are returned as
+    docs ready to embed, with positions giving their index in jobs.
+    '''
+    indices = list(range(len(jobs))) if indices is None else indices
+    results = [None] * len(jobs)
+    docs = []
+    positions = []
+    for i, job in enumerate(jobs):
+        try:
+            docs.append(_new_job_doc(job))
+            positions.append(i)
+        except (TypeError, ValueError) as e:
+            results[i] = {"index": indices[i], "status": "error", "message": str(e)}
+    existing = {}
+    if docs:
+        fingerprints = [doc["fingerprint"] for doc in docs]
+        for job in dbc.fetch_all("jobs", filt={"fingerprint": {"$in": fingerprints}},
+                                 projection=FINGERPRINT_PROJECTION):
+            existing[job["fingerprint"]] = job
+    seen = {}
+    new_docs = []
+    new_positions = []
+    for i, doc in zip(positions, docs):
+        fingerprint = doc["fingerprint"]
+        if fingerprint in seen:
+            results[i] = {"index": indices[i], "status": "error",
+                          "message": f"Same job as index {seen[fingerprint]}"}
+        elif fingerprint in existing:
+            status = _refresh_job(existing[fingerprint], doc)
+            results[i] = {"index": indices[i], "status": status,
+                          "job_id": str(existing[fingerprint]["_id"])}
+        else:
+            new_docs.append(doc)
+            new_positions.append(i)
+        seen[fingerprint] = indices[i]
+    return results, new_docs, new_positions
+
+
+def embed_job_docs(docs, batch_size=BULK_EMBED_BATCH_SIZE):
+    '''
+    docs: new job documents from dedupe_job_postings
+    Sets the embedding of every doc, batch_size texts per API request,
+    or queues them when EMBEDDING_QUEUE=1. Returns the vectors (None
+    for queued docs).
+    '''
+    if embed_queue.ENABLED:
+        for doc in docs:
+            doc.update(embed_queue.pending())
+        return [None] * len(docs)
+    texts = [job_embedding_text(doc) for doc in docs]
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        vectors.extend(embed_backoff.call(generate_vectors, texts[start:start + batch_size]))
+    for doc, text, vector in zip(docs, texts, vectors):
+        doc.update(embedding_fields(text, vector))
+    return vectors
+
+
+def insert_job_docs(docs, vectors):
+    '''
+    docs: embedded job documents
+    vectors: their vectors, from embed_job_docs
+    Writes the docs with one unordered insert_many.
+    Returns a {"status", "job_id"} or {"status": "error", "message"}
+    result per doc.
+    '''
+    failed = {}
+    if docs:
+        try:
+            dbc.insert_many("jobs", docs, ordered=False)
+        except pm_errors.BulkWriteError as e:
+            failed = {err["index"]: err["errmsg"] for err in e.details["writeErrors"]}
+    results = []
+    for k, (doc, vector) in enumerate(zip(docs, vectors)):
+        if k in failed:
+            results.append({"status": "error", "message": failed[k]})
+            continue
+        if vector is not None:
+            vector_index.add(doc["_id"], vector, doc)
+        results.append({"status": "created", "job_id": str(doc["_id"])})
+    if len(failed) < len(docs):
+        job_events.changed()
+    return results
+
+
+def _new_job_doc(job):
+    if not isinstance(job, dict):
+        raise TypeError("Each job must be an object")
+    missing = [field for field in REQUIRED_JOB_FIELDS if job.get(field) is None]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    if not isinstance(job["date"], datetime.datetime):
+        raise TypeError("date must be a datetime")
+    doc = {field: job.get(field) for field in JOB_FIELDS}
+    if doc["job_description"] is None:
+        doc["job_description"] = ""
+    for field in JOB_FIELDS:
+        if field != "date" and not isinstance(doc[field], str):
+            raise TypeError(f"{field} must be a string")
+    doc["_id"] = ObjectId()
+    doc["version"] = 1
+    doc["fingerprint"] = job_fingerprint(doc["company"], doc["job_type"], doc["link"])
+    return doc
+
+
+def _refresh_job(current, doc):
+    changes = {
+        field: doc[field] for field in JOB_FIELDS if current.get(field) != doc[field]
+    }
+    if not changes:
+        return "unchanged"
+    update_job(current["_id"], changes)
+    return "updated"
+
+
+def normalize_link(link):
+    '''
+    link: a job posting URL
+    Lowercases the scheme and host, drops "www.", the fragment, tracking
+    parameters and trailing slashes, and sorts the query, so the same
+    posting reached through different links compares equal.
+    '''
+    parts = urlsplit(link.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[len("www."):]
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(TRACKING_PARAMS)
     )
-    return dbc.insert_one(
-        "jobs",
-        {
-            "company": company,
-            "job_description": job_description,
-            "job_type": job_type,
-            "location": location,
-            "date": date,
-            "link": link,
-            "embedding_vector": vector,
-        },
+    return urlunsplit(
+        (parts.scheme.lower(), host, parts.path.rstrip("/"), urlencode(query), "")
+    )
+
+
+def job_fingerprint(company, job_type, link):
+    '''
+    company: the company name
+    job_type: the job type (the posting's title)
+    link: the link
+    Returns the identity of a posting: a hash of the normalized link,
+    company and title. A unique index on it keeps ingestion idempotent.
+    '''
+    payload = "\x00".join(
+        (normalize_link(link), ec.normalize_text(company), ec.normalize_text(job_type))
     )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def backfill_fingerprints(batch_size=FINGERPRINT_BATCH_SIZE):
+    '''
+    Sets the fingerprint of jobs written before deduplication.
+    Older duplicates of a posting keep no fingerprint; returns how many
+    jobs were fingerprinted.
+    '''
+    done = 0
+    batches = dbc.fetch_batches(
+        "jobs", batch_size, filt={"fingerprint": {"$exists": False}},
+        projection=FINGERPRINT_PROJECTION,
+    )
+    for batch in batches:
+        operations = [
+            pymongo.UpdateOne({"_id": job["_id"]}, {"$set": {"fingerprint": job_fingerprint(
+                job.get("company", ""), job.get("job_type", ""), job.get("link", ""))}})
+            for job in batch
+        ]
+        try:
+            done += dbc.bulk_write("jobs", operations).modified_count
+        except pm_errors.BulkWriteError as e:
+            done += e.details["nModified"]
+        print(f"Fingerprinted {done} jobs")
+    return done
 
 
 def update_job(job_id, changes):
     """
     function to update the parameters of a job
+    The changes are applied and the previous values read back with one
+    find_one_and_update. The job is only re-embedded, with a second
+    update, when a field that feeds the embedding text actually changed,
+    so resending unchanged fields never costs an embedding call nor
+    replaces a good vector with DEFAULT_VECTOR.
+    With EMBEDDING_QUEUE=1 the job is queued for re-embedding instead.
+    Every update increments the job's version, which its ETag is built on.
+    Changing the company, title or link recomputes the job's fingerprint;
+    raises KeyError if another job already has the new one.
+    Returns the updated job without its embedding.
     """
-    if not dbc.exists_by_id(job_id, "jobs"):
-        raise KeyError(f"No job {job_id}")
-    res = dbc.update_doc("jobs", {"_id": job_id}, changes)
-    if not res:
+    changes = {
+        key: value for key, value in changes.items()
+        if key not in ("_id", "embedding_vector", EMBEDDING_HASH_FIELD, EMBEDDING_MODEL_FIELD,
+                       "version", "fingerprint")
+    }
+    if any(field in changes for field in IDENTITY_FIELDS):
+        current = dbc.fetch_one("jobs", {"_id": job_id},
+                                projection={field: 1 for field in IDENTITY_FIELDS})
+        if current is not None:
+            identity = {field: current.get(field, "") for field in IDENTITY_FIELDS}
+            identity.update((f, changes[f]) for f in IDENTITY_FIELDS if f in changes)
+            changes["fingerprint"] = job_fingerprint(**identity)
+    try:
+        before = dbc.find_one_and_update(
+            "jobs", {"_id": job_id}, {"$set": changes, "$inc": {"version": 1}},
+            projection=DETAIL_PROJECTION,
+        )
+    except pm_errors.DuplicateKeyError:
+        raise KeyError("A job with the same link, company and title already exists")
+    if before is None:
         raise KeyError(f"No job {job_id}")
-    job = dbc.fetch_one("jobs", {"_id": job_id})
-    vector = generate_vector(
-        job.setdefault("company", "")
-        + " "
-        + job.setdefault("location", "")
-        + " "
-        + job.setdefault("job_type", "")
-        + " "
-        + job.setdefault("date", datetime.datetime.now()).strftime("%Y-%m-%d")
-        + " "
-        + job.setdefault("job_description", "")
-    )
-    del job["_id"]
-    job["embedding_vector"] = vector
-    dbc.update_doc("jobs", {"_id": job_id}, job)
-    return res
+    job = {**before, **changes, "version": before.get("version", 0) + 1}
+    for field in DETAIL_PROJECTION:
+        job.pop(field, None)
+    changed = [
+        field for field in EMBEDDING_FIELDS
+        if field in changes and changes[field] != before.get(field)
+    ]
+    if embed_queue.ENABLED and changed:
+        dbc.update_doc("jobs", {"_id": job_id}, embed_queue.pending())
+    elif changed:
+        text = job_embedding_text(job)
+        vector = generate_vector(text)
+        fields = embedding_fields(text, vector)
+        dbc.update_doc("jobs", {"_id": job_id}, fields)
+        vector_index.add(job_id, vector, fields)
+    job_events.changed(job_id)
+    return job
 
 
 def check_account(user_id, password):
@@ -145,17 +446,52 @@ def delete_job(admin_id, job_id):
     """finds job by _id and deletes it if possible"""
     if not dbc.exists_by_id(job_id, "jobs"):
         raise KeyError(f"No Job {job_id}")
-    return dbc.del_one("jobs", {"_id": job_id})
+    res = dbc.del_one("jobs", {"_id": job_id})
+    vector_index.remove(job_id)
+    job_events.changed(job_id)
+    return res
 
 
-def delete_job_past_date(past_date):
-    """flushes all entries past a date"""
+def delete_job_past_date(past_date, archive=False, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    flushes all entries past a date with one indexed delete_many.
+    With archive=True the expired jobs are moved into jobs_archive in
+    batches instead, so they can still be inspected later.
+    Returns the number of jobs removed from "jobs".
+    """
     if not isinstance(past_date, datetime.datetime):
         raise TypeError("past_date must be datetime")
-    for job in dbc.fetch_all("jobs"):
-        if job["date"] < past_date:
-            dbc.del_one("jobs", {"_id": job["_id"]})
-    return True
+    expired = {"date": {"$lt": past_date}}
+    if archive:
+        return _archive_jobs(expired, batch_size)
+    res = dbc.del_many("jobs", expired)
+    if res.deleted_count:
+        vector_index.invalidate()
+        job_events.changed()
+    return res.deleted_count
+
+
+def _archive_jobs(filt, batch_size):
+    moved = 0
+    while True:
+        batch = list(
+            dbc.fetch_elements_ordered_by("jobs", "date", limit=batch_size, filt=filt)
+        )
+        if not batch:
+            return moved
+        ids = [job["_id"] for job in batch]
+        try:
+            dbc.insert_many(ARCHIVE_COLLECTION, batch, ordered=False)
+        except pm_errors.BulkWriteError as e:
+            # a previous interrupted run may already have archived some of
+            # these; anything other than duplicate keys is a real failure
+            if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+                raise
+        dbc.del_many("jobs", {"_id": {"$in": ids}})
+        for job_id in ids:
+            vector_index.remove(job_id)
+        job_events.changed()
+        moved += len(ids)
 
 
 def get_most_recent_job(numbers):
@@ -163,30 +499,79 @@ def get_most_recent_job(numbers):
     numbers: the number of jobs to return
     This function fetches the most recent jobs based on the number of jobs provided.
     The jobs are fetched from the database using the "jobs" collection.
-    The jobs are fetched from the database using the "jobs" collection.
     '''
-    jobs = dbc.fetch_elements_ordered_by("jobs", "date", limit=numbers)
+    return get_most_recent_job_page(numbers)[0]
+
+
+def get_most_recent_job_page(numbers, cursor=None):
+    '''
+    numbers: the number of jobs to return
+    cursor: token from a previous page, or None for the first page
+    Keyset pagination over the (date desc, _id desc) index: each page is
+    an index range query starting after the cursor, so deep pages cost
+    the same as the first.
+    Returns (jobs, next_cursor); next_cursor is None on the last page.
+    '''
+    if numbers < 1:
+        raise ValueError("numbers must be greater than 0")
+    filt = None
+    if cursor is not None:
+        date, job_id = decode_page_cursor(cursor)
+        filt = {
+            "$or": [
+                {"date": {"$lt": date}},
+                {"date": date, "_id": {"$lt": job_id}},
+            ]
+        }
+    jobs = dbc.fetch_elements_ordered_by(
+        "jobs", ["date", "_id"], limit=numbers + 1, projection=LISTING_PROJECTION, filt=filt
+    )
     res = [job for job in jobs]
+    next_cursor = None
+    if len(res) > numbers:
+        res = res[:numbers]
+        next_cursor = encode_page_cursor(res[-1]["date"], res[-1]["_id"])
     for entry in res:
         entry["date"] = str(entry["date"].date())
         entry["job_id"] = str(entry["_id"])
         del entry["_id"]
-        del entry["embedding_vector"]
     # print(res)
-    return res
+    return res, next_cursor
+
+
+def encode_page_cursor(date, job_id):
+    '''
+    Returns an opaque token for the position (date, job_id).
+    '''
+    payload = json.dumps({"d": date.isoformat(), "i": str(job_id)})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_page_cursor(token):
+    '''
+    Inverse of encode_page_cursor; raises ValueError on a bad token.
+    '''
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.datetime.fromisoformat(payload["d"]), ObjectId(payload["i"])
+    except (ValueError, KeyError, TypeError, bson_errors.InvalidId):
+        raise ValueError(f"Invalid cursor {token}")
 
 
 def add_account(username, email, password):
     """
     function to add new account
+    Uniqueness of username and email is enforced by unique indexes, so
+    this is a single insert; duplicate-key errors become KeyErrors.
+    Until those indexes exist the account is looked up first.
     """
-    exist = dbc.fetch_one("users", {"username": username})
-    if exist:
-        raise KeyError("Username already exists")
-    exist1 = dbc.fetch_one("users", {"email": email})
-    if exist1:
-        raise KeyError("User's Email already exists")
-    else:
+    if not schema.users_are_unique():
+        if dbc.fetch_one("users", {"username": username}):
+            raise KeyError("Username already exists")
+        if dbc.fetch_one("users", {"email": email}):
+            raise KeyError("User's Email already exists")
+    try:
         return dbc.insert_one(
             "users",
             {
@@ -196,6 +581,10 @@ def add_account(username, email, password):
                 "preference": {"location": "any", "job_type": "any"},
             },
         )
+    except pm_errors.DuplicateKeyError as e:
+        if "email" in (e.details or {}).get("keyPattern", {}):
+            raise KeyError("User's Email already exists")
+        raise KeyError("Username already exists")
 
 
 def update_preference(user_id, preferred_location, preferred_type):
@@ -226,11 +615,69 @@ def delete_account(user_id):
     return dbc.del_one("users", {"_id": user_id})
 
 
-def get_user_reports():
+def get_user_reports(job_id=None, user_id=None, start=None, end=None):
+    """
+    function to fetch all user reports, optionally filtered by job,
+    user and creation date range
+    """
+    return list(iter_user_reports(job_id, user_id, start, end))
+
+
+def iter_user_reports(job_id=None, user_id=None, start=None, end=None, after=None,
+                      batch_size=REPORT_BATCH_SIZE):
     """
-    function to fetch all user reports
+    Yields matching user reports in _id order, batch_size at a time,
+    so callers can stream any number of reports in flat memory.
+    after: only reports with a larger _id (a page cursor)
     """
-    return dbc.fetch_all("user_reports")
+    filt = _user_report_filter(job_id, user_id, start, end, after)
+    for batch in dbc.fetch_batches("user_reports", batch_size, filt=filt):
+        yield from batch
+
+
+def get_user_reports_page(limit, cursor=None, job_id=None, user_id=None,
+                          start=None, end=None):
+    """
+    Returns (reports, next_cursor) for one page of matching reports.
+    The cursor is the last report's _id; next_cursor is None on the
+    last page.
+    """
+    after = None
+    if cursor is not None:
+        if not ObjectId.is_valid(cursor):
+            raise ValueError(f"Invalid cursor {cursor}")
+        after = ObjectId(cursor)
+    filt = _user_report_filter(job_id, user_id, start, end, after)
+    batch = next(dbc.fetch_batches("user_reports", limit + 1, filt=filt), [])
+    if len(batch) > limit:
+        return batch[:limit], str(batch[limit - 1]["_id"])
+    return batch, None
+
+
+def _user_report_filter(job_id, user_id, start, end, after):
+    """
+    Reports have no date field, so the date range is applied to the
+    creation time embedded in their ObjectId.
+    """
+    filt = {}
+    for field, value in (("job_id", job_id), ("user_id", user_id)):
+        if value is None:
+            continue
+        # ids are stored as ObjectIds or as the strings the endpoint got
+        values = [str(value)]
+        if ObjectId.is_valid(value):
+            values.append(ObjectId(value))
+        filt[field] = {"$in": values}
+    id_range = {}
+    if start is not None:
+        id_range["$gte"] = ObjectId.from_datetime(start)
+    if end is not None:
+        id_range["$lt"] = ObjectId.from_datetime(end)
+    if after is not None:
+        id_range["$gt"] = after
+    if id_range:
+        filt["_id"] = id_range
+    return filt
 
 
 def add_user_report(user_id, job_id, report):
@@ -255,7 +702,7 @@ def check_preference(user_id):
     if not dbc.exists_by_id(user_id, "users"):
         raise KeyError(f"No User {user_id}")
     else:
-        user = dbc.fetch_one("users", {"_id": user_id})
+        user = dbc.fetch_one("users", {"_id": user_id}, projection={"preference": 1})
         return user["preference"]
 
 
@@ -274,7 +721,7 @@ def get_user_id(username, password):
     password: the password to be used to authenticate the user
     This function fetches the user ID of a user based on its username and password.
     '''
-    user = dbc.fetch_one("users", {"username": username})
+    user = dbc.fetch_one("users", {"username": username}, projection={"password": 1})
     print(user)
     if user:
         if user["password"] == password:
@@ -290,52 +737,173 @@ def get_username_by_id(user_id):
     user_id: the user id to be fetched
     This function fetches the username of a user based on its ID.
     '''
-    user = dbc.fetch_one("users", {"_id": user_id})
+    user = dbc.fetch_one("users", {"_id": user_id}, projection={"username": 1})
     if user:
         return user["username"]
     else:
         return False
 
 
-def get_job_by_id(job_id):
+def get_job_by_id(job_id, include_embedding=False):
     '''
     job_id: the job id to be fetched
+    include_embedding: also return the embedding_vector
     This function fetches a job based on its ID.
     '''
-    job = dbc.fetch_one("jobs", {"_id": job_id})
+    projection = DETAIL_PROJECTION
+    if include_embedding:
+        projection = {field: 0 for field in INTERNAL_FIELDS if field != "embedding_vector"}
+    job = dbc.fetch_one("jobs", {"_id": job_id}, projection=projection)
     if job:
         job["_id"] = str(job["_id"])
         job["date"] = str(job["date"])
+        if "embedding_vector" in job:
+            job["embedding_vector"] = vector_codec.decode(job["embedding_vector"])
         return job
     else:
         return False
 
 
-def generate_vector(text):
+def get_job_version(job_id):
+    '''
+    job_id: the job id
+    Returns the job's version (0 for jobs written before versioning),
+    or None if there is no such job. Only the version is read.
+    '''
+    job = dbc.fetch_one("jobs", {"_id": job_id}, projection={"version": 1})
+    if job is None:
+        return None
+    return job.get("version", 0)
+
+
+def get_jobs_version():
+    '''
+    Returns a counter that changes whenever jobs are added, updated or deleted.
+    '''
+    return job_events.collection_version()
+
+
+def generate_vector(text, deadline=None):
     '''
     text: the text to be embedded
-    This function generates a vector of job descriptions using the OpenAI.
-    The vector is generated using the OpenAI text-embedding-ada-002 model.
+    deadline: seconds the whole call may take (EMBEDDING_DEADLINE by default)
+    This function generates a vector of job descriptions with the
+    configured embedder (OpenAI text-embedding-ada-002 by default).
+    Vectors are looked up in the embedding cache first, so repeated
+    text never costs a second API call. Concurrent calls share requests
+    through query_dispatcher: identical texts are embedded once and
+    distinct ones are batched. Rate-limit pauses are shared by every
+    thread; once the API keeps failing the circuit breaker skips it.
+    Returns DEFAULT_VECTOR when the text could not be embedded within
+    the deadline.
     '''
-    # print(os.environ.get("OPENAI_API_KEY"))
-    if open_ai_client is None:
+    if not embedder.cacheable:
+        # local embedders encode one text in-process, never in a worker
+        return embedder.embed_one(text)
+    cached = ec.cache.get(embedder.name, text)
+    if cached is not None:
+        return cached
+    budget = resilience.Deadline(resilience.DEADLINE if deadline is None else deadline)
+    try:
+        return query_dispatcher.embed(text, timeout=budget.remaining())
+    except Exception as e:
+        print(f"Could not embed text: {e}")
         return DEFAULT_VECTOR
-    attempt = 0
-    while True:
-        try:
-            response = open_ai_client.embeddings.create(
-                input=text, model="text-embedding-ada-002"
-            )
-            return response.data[0].embedding
-        except openai.RateLimitError:
-            attempt += 1
-            wait_time = min(2 ** attempt + random.random(), 60)
-            if attempt == 10:
-                break
-            time.sleep(wait_time)
-        except Exception:
-            break
-    return DEFAULT_VECTOR
+
+
+def _embed_dispatched(texts):
+    '''
+    Embeds one batch of query_dispatcher, which may hold the texts of
+    several concurrent generate_vector calls.
+    '''
+    deadline = resilience.Deadline()
+    vectors = embed_breaker.call(
+        embed_backoff.call,
+        lambda: embedder.embed(texts, timeout=deadline.remaining()),
+        deadline=deadline,
+    )
+    ec.cache.put_many(embedder.name, texts, vectors)
+    return vectors
+
+
+# coalesces and batches the texts of concurrent generate_vector calls
+query_dispatcher = embed_dispatcher.Dispatcher(_embed_dispatched)
+
+
+def generate_vectors(texts):
+    '''
+    texts: the list of texts to be embedded
+    Embeds every text not already cached with a single embedder call.
+    Unlike generate_vector, API errors (and CircuitOpenError while the
+    breaker is open) are raised so that batch callers can apply their own
+    backoff.
+    '''
+    if not embedder.cacheable:
+        return embedder.embed(texts)
+    vectors = ec.cache.get_many(embedder.name, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        embedded = embed_breaker.call(embedder.embed, [texts[i] for i in missing])
+        for i, vector in zip(missing, embedded):
+            vectors[i] = vector
+        ec.cache.put_many(
+            embedder.name,
+            [texts[i] for i in missing],
+            embedded,
+        )
+    return vectors
+
+
+def train_local_embedder(path=embedders.LOCAL_EMBEDDER_PATH):
+    '''
+    path: where the learned weights are saved
+    Learns the local embedder's IDF weights from every job and makes it
+    this process's embedder. Stored vectors are not touched; run
+    re_embed_all_jobs afterwards.
+    Raises ValueError without a path: weights that are not saved could
+    not be loaded by the servers embedding search queries.
+    '''
+    global embedder
+    if not path:
+        raise ValueError("Set LOCAL_EMBEDDER_PATH so the servers can load the trained weights")
+    texts = (job_embedding_text(job)
+             for batch in dbc.fetch_batches("jobs", re_embed.BATCH_SIZE,
+                                            projection=EMBEDDING_TEXT_PROJECTION)
+             for job in batch)
+    trained = embedders.HashingEmbedder().fit(texts)
+    trained.save(path)
+    previous, embedder = embedder, embedders.pooled(trained)
+    if isinstance(previous, encoder_pool.EncoderPool):
+        previous.close()
+    return trained
+
+
+def get_embedding_cache_stats():
+    '''
+    Returns the hit/miss counters of the embedding cache.
+    '''
+    return ec.cache.stats()
+
+
+def get_embedding_breaker_stats():
+    '''
+    Returns the state and counters of the embedding circuit breaker.
+    '''
+    return embed_breaker.stats()
+
+
+def get_embedding_dispatch_stats():
+    '''
+    Returns how many query embeddings were coalesced and batched.
+    '''
+    return query_dispatcher.stats()
+
+
+def get_db_pool_stats():
+    '''
+    Returns the Mongo connection pool counters of this process.
+    '''
+    return dbc.pool_stats()
 
 
 def search_jobs_by_vector(text, limit=10):
@@ -346,21 +914,16 @@ def search_jobs_by_vector(text, limit=10):
     The vector is generated from the text provided.
     then the vector is passed into mongodb to search for jobs that match the vector.
     Returns jobs that matches the search query.
+    Raises RuntimeError if the API could not embed the query, rather than
+    returning (and letting callers cache) matches for a placeholder vector.
     '''
     vector = generate_vector(text)
-    pipeline = [
-        {
-            "$vectorSearch": {
-                "index": "vector_index",
-                "path": "embedding_vector",
-                "queryVector": vector,
-                "numCandidates": limit * 3,
-                "limit": limit,
-            }
-        }
-    ]
-    cursor = dbc.aggregate_job(pipeline)
-    # print("HI I GOT HERE 3")
+    if vector is DEFAULT_VECTOR:
+        raise RuntimeError("Could not embed the search query, please retry")
+    if vector_index.BACKEND == vector_index.ATLAS:
+        cursor = _atlas_vector_search(vector, limit)
+    else:
+        cursor = _local_vector_search(vector, limit)
     results = [
         {
             "job_id": str(result["_id"]),
@@ -376,26 +939,127 @@ def search_jobs_by_vector(text, limit=10):
     return results
 
 
-def re_embed_all_jobs():
+def _atlas_vector_search(vector, limit):
+    pipeline = [
+        {
+            "$vectorSearch": {
+                "index": "vector_index",
+                "path": "embedding_vector",
+                "queryVector": vector,
+                "numCandidates": limit * 3,
+                "limit": limit,
+            }
+        },
+        {"$project": SEARCH_RESULT_PROJECTION},
+    ]
+    return dbc.aggregate_job(pipeline)
+
+
+def _local_vector_search(vector, limit):
+    hits = vector_index.search(vector, limit, model=embedding_model())
+    ids = [job_id for job_id, _ in hits]
+    jobs = {
+        job["_id"]: job
+        for job in dbc.fetch_all(
+            "jobs", filt={"_id": {"$in": ids}}, projection=SEARCH_RESULT_PROJECTION
+        )
+    }
+    return [jobs[job_id] for job_id in ids if job_id in jobs]
+
+
+def job_embedding_text(job):
     '''
-    This function re-emebeds all jobs embeddings vectors in the database.
+    job: a job document
+    Returns the text that is embedded for a job.
     '''
-    jobs = dbc.fetch_all("jobs")
-    for i, job in enumerate(jobs):
-        job["embedding_vector"] = generate_vector(
-            job["company"]
-            + " "
-            + job["location"]
-            + " "
-            + job["job_type"]
-            + " "
-            + job["date"].strftime("%Y-%m-%d")
-            + " "
-            + job["job_description"]
-        )
-        update_job(job["_id"], job)
-        if i % 10 == 0:
-            print(f"Re-embedding {i} jobs")
+    return (
+        job.get("company", "")
+        + " "
+        + job.get("location", "")
+        + " "
+        + job.get("job_type", "")
+        + " "
+        + job.get("date", datetime.datetime.now()).strftime("%Y-%m-%d")
+        + " "
+        + job.get("job_description", "")
+    )
+
+
+def embedding_model():
+    '''
+    Returns the identifier of the embedder and dimensions vectors are
+    currently computed with.
+    '''
+    return f"{embedder.name}/{embedder.dimensions}"
+
+
+def embedding_text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embedding_fields(text, vector):
+    '''
+    text: the embedding text of a job
+    vector: its vector
+    Returns the fields stored with a job's embedding: the vector, the
+    hash of the text and the model it was computed with. The hash and
+    model are None for DEFAULT_VECTOR, so such jobs count as stale.
+    '''
+    embedded = vector is not DEFAULT_VECTOR
+    return {
+        "embedding_vector": vector_codec.encode(vector),
+        EMBEDDING_HASH_FIELD: embedding_text_hash(text) if embedded else None,
+        EMBEDDING_MODEL_FIELD: embedding_model() if embedded else None,
+    }
+
+
+def embedding_is_stale(job, text):
+    '''
+    Returns whether the job's stored embedding was not computed from
+    text with the current model.
+    '''
+    return (job.get(EMBEDDING_MODEL_FIELD) != embedding_model()
+            or job.get(EMBEDDING_HASH_FIELD) != embedding_text_hash(text))
+
+
+def re_embed_all_jobs(resume=True, force=False):
+    '''
+    This function re-emebeds the jobs embeddings vectors in the database.
+    Jobs are streamed and embedded in batches by db.re_embed, and an
+    interrupted run resumes from its last checkpoint unless resume is False.
+    Only jobs whose text or model changed since they were embedded are
+    sent to the embedder, unless force is True.
+    '''
+    written = re_embed.run(
+        generate_vectors, job_embedding_text, resume=resume,
+        projection=EMBEDDING_STATE_PROJECTION,
+        needs=None if force else embedding_is_stale,
+        fields_of=embedding_fields,
+    )
+    # new vectors change search results
+    vector_index.invalidate()
+    job_events.changed()
+    return written
+
+
+def retrain_vector_index():
+    '''
+    Retrains the IVF index on the vectors it holds and saves it to
+    VECTOR_INDEX_PATH, e.g. after a large ingest.
+    '''
+    index = vector_index.get_index(embedding_model())
+    vector_index.retrain_if_needed(index, force=True)
+    vector_index.save_index()
+
+
+def start_embedding_workers():
+    '''
+    Starts this process's embedding queue workers and sweeper.
+    '''
+    return embed_queue.ensure_started(
+        generate_vectors, job_embedding_text, DEFAULT_VECTOR,
+        projection=EMBEDDING_TEXT_PROJECTION, fields_of=embedding_fields,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+"""
+This file contains the dispatcher request-time embeddings go through.
+
+    single flight: a text already being embedded is not sent again;
+        every caller asking for it waits on the same future.
+    micro-batching: distinct texts arriving within MAX_WAIT of each other
+        are sent as one batched request of at most MAX_BATCH texts.
+
+Under load this cuts both the number of API requests and the latency
+tail, at the cost of up to MAX_WAIT added to a lone request.
+"""
+
+import concurrent.futures as futures
+import os
+import threading
+import time
+
+MAX_BATCH = int(os.environ.get("EMBEDDING_BATCH_MAX", 32))
+MAX_WAIT = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", 5)) / 1000
+# batched requests in flight at once
+CONCURRENCY = int(os.environ.get("EMBEDDING_DISPATCH_CONCURRENCY", 4))
+
+
+class Dispatcher:
+    """
+    embed_batch: function embedding a list of texts, returning their
+        vectors in order; it is called from the dispatcher's threads.
+    A collector thread gathers the waiting texts into batches and hands
+    them to a pool of concurrency threads. Both are started on first use
+    and again in a forked child.
+    """
+
+    def __init__(self, embed_batch, max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+                 concurrency=CONCURRENCY):
+        self.embed_batch = embed_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self._cond = threading.Condition()
+        self._pid = None
+        self._reset()
+
+    def submit(self, text):
+        '''
+        Returns a Future of the vector of text.
+        '''
+        with self._cond:
+            if self._pid != os.getpid():
+                self._start()
+            self.counters["requests"] += 1
+            future = self._inflight.get(text)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return future
+            future = futures.Future()
+            self._inflight[text] = future
+            self._waiting.append(text)
+            self._cond.notify()
+            return future
+
+    def embed(self, text, timeout=None):
+        '''
+        Returns the vector of text, waiting at most timeout seconds
+        (concurrent.futures.TimeoutError past it).
+        '''
+        return self.submit(text).result(timeout)
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counters, waiting=len(self._waiting),
+                        in_flight=len(self._inflight))
+
+    def _reset(self):
+        self._waiting = []
+        self._inflight = {}
+        self.counters = {"requests": 0, "coalesced": 0, "batches": 0, "texts": 0}
+
+    def _start(self):
+        # whatever the parent had queued belongs to the parent
+        self._reset()
+        self._pool = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        threading.Thread(target=self._collect, daemon=True).start()
+        self._pid = os.getpid()
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    self._cond.wait()
+                # linger briefly so concurrent texts share the request
+                until = time.monotonic() + self.max_wait
+                while len(self._waiting) < self.max_batch:
+                    left = until - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                batch = self._waiting[:self.max_batch]
+                del self._waiting[:self.max_batch]
+                pool = self._pool
+            pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        try:
+            vectors, error = self.embed_batch(batch), None
+        except Exception as e:
+            vectors, error = None, e
+        with self._cond:
+            # later callers of these texts start a new request (or hit a cache)
+            waiters = [self._inflight.pop(text) for text in batch]
+            self.counters["batches"] += 1
+            self.counters["texts"] += len(batch)
+        for i, future in enumerate(waiters):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(vectors[i])
@@ -0,0 +1,270 @@
+"""
+This file contains the background embedding queue.
+With EMBEDDING_QUEUE=1, db.py writes jobs straight away with
+embedding_status "pending" instead of calling OpenAI inline. The jobs
+collection itself is the persistent queue: workers claim pending jobs in
+batches, embed each batch with one API request and write the vectors
+back, removing the status. A claim is a lease, so jobs claimed by a
+worker that died are picked up again after LEASE_SECONDS.
+A sweeper periodically re-queues jobs that still hold the placeholder
+vector generate_vector stores when the API fails.
+Workers run inside the server (EMBEDDING_WORKERS per process) or on
+their own:
+
+    python -m db.embed_queue
+"""
+
+import datetime
+import os
+import threading
+import uuid
+
+from pymongo import UpdateOne
+
+import db.db_connect as dbc
+import db.job_events as job_events
+import db.re_embed as re_embed
+import db.vector_codec as vector_codec
+import db.vector_index as vector_index
+
+ENABLED = os.environ.get("EMBEDDING_QUEUE", "0") == "1"
+WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 1))
+BATCH_SIZE = int(os.environ.get("EMBEDDING_QUEUE_BATCH_SIZE", 100))
+POLL_INTERVAL = float(os.environ.get("EMBEDDING_QUEUE_POLL", 2))
+SWEEP_INTERVAL = float(os.environ.get("EMBEDDING_SWEEP_INTERVAL", 600))
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 5
+
+STATUS = "embedding_status"
+PENDING = "pending"
+CLAIMED = "embedding"
+FAILED = "failed"
+CLAIM = "embedding_claim"
+CLAIMED_AT = "embedding_claimed_at"
+ATTEMPTS = "embedding_attempts"
+
+FIELDS = (STATUS, CLAIM, CLAIMED_AT, ATTEMPTS)
+# drop every queue field once the vector is written
+DONE = {field: "" for field in FIELDS}
+
+
+def pending():
+    '''
+    Returns the fields that put a job on the queue. Resetting the claim
+    makes a worker still embedding the old text discard its result.
+    '''
+    return {STATUS: PENDING, CLAIM: None}
+
+
+def claimable(now):
+    return {"$or": [
+        {STATUS: PENDING},
+        {STATUS: CLAIMED,
+         CLAIMED_AT: {"$lt": now - datetime.timedelta(seconds=LEASE_SECONDS)}},
+    ]}
+
+
+def claim(batch_size=BATCH_SIZE, projection=None):
+    '''
+    Claims up to batch_size queued jobs, oldest first.
+    Returns (token, jobs); only the holder of token may complete them.
+    '''
+    now = datetime.datetime.now()
+    candidates = next(
+        dbc.fetch_batches("jobs", batch_size, filt=claimable(now),
+                          projection={dbc.MONGO_ID: 1}),
+        [],
+    )
+    if not candidates:
+        return None, []
+    token = uuid.uuid4().hex
+    ids = [job[dbc.MONGO_ID] for job in candidates]
+    dbc.update_many(
+        "jobs",
+        {"$and": [{dbc.MONGO_ID: {"$in": ids}}, claimable(now)]},
+        {"$set": {STATUS: CLAIMED, CLAIM: token, CLAIMED_AT: now}},
+    )
+    # another worker may have won some of the candidates; no index covers
+    # the claim, so only the candidates are looked at
+    return token, dbc.fetch_all("jobs", filt={dbc.MONGO_ID: {"$in": ids}, CLAIM: token},
+                                projection=projection)
+
+
+def complete(token, jobs, vectors, fields=None):
+    '''
+    Writes the vectors of claimed jobs and takes them off the queue.
+    fields: optional list of the fields to write per job, instead of
+        just the vector
+    Jobs re-queued by an update since they were claimed are skipped,
+    and so kept out of the search index too.
+    '''
+    if fields is None:
+        fields = [{"embedding_vector": vector_codec.encode(vector)} for vector in vectors]
+    operations = [
+        UpdateOne({dbc.MONGO_ID: job[dbc.MONGO_ID], CLAIM: token},
+                  {"$set": job_fields, "$unset": DONE})
+        for job, job_fields in zip(jobs, fields)
+    ]
+    res = dbc.bulk_write("jobs", operations)
+    written = [True] * len(jobs)
+    if res.matched_count < len(jobs):
+        # bulk results aren't per operation; a job was written if it holds our vector
+        stored = {
+            job[dbc.MONGO_ID]: job.get("embedding_vector")
+            for job in dbc.fetch_all(
+                "jobs", filt={dbc.MONGO_ID: {"$in": [job[dbc.MONGO_ID] for job in jobs]}},
+                projection={"embedding_vector": 1})
+        }
+        written = [stored.get(job[dbc.MONGO_ID]) == job_fields["embedding_vector"]
+                   for job, job_fields in zip(jobs, fields)]
+    for job, vector, job_fields, ok in zip(jobs, vectors, fields, written):
+        if ok:
+            vector_index.add(job[dbc.MONGO_ID], vector, job_fields)
+    job_events.changed()
+    return res.modified_count
+
+
+def release(token, jobs):
+    '''
+    jobs: the jobs claimed with token
+    Puts the jobs of a failed claim back on the queue, giving up on
+    those that have failed MAX_ATTEMPTS times.
+    '''
+    ids = [job[dbc.MONGO_ID] for job in jobs]
+    dbc.update_many(
+        "jobs", {dbc.MONGO_ID: {"$in": ids}, CLAIM: token},
+        {"$set": {STATUS: PENDING, CLAIM: None}, "$inc": {ATTEMPTS: 1},
+         "$unset": {CLAIMED_AT: ""}},
+    )
+    dbc.update_many(
+        "jobs", {dbc.MONGO_ID: {"$in": ids}, STATUS: PENDING, ATTEMPTS: {"$gte": MAX_ATTEMPTS}},
+        {"$set": {STATUS: FAILED}},
+    )
+
+
+def sweep(placeholder):
+    '''
+    placeholder: the vector stored when embedding failed
+    Re-queues jobs holding the placeholder (in either storage format)
+    or no vector at all. Returns how many were queued.
+    '''
+    stale = [vector_codec.encode(placeholder, storage)
+             for storage in (vector_codec.ARRAY, vector_codec.BINARY)]
+    res = dbc.update_many(
+        "jobs",
+        {"$and": [
+            {"$or": [{"embedding_vector": {"$in": stale}},
+                     {"embedding_vector": {"$exists": False}}]},
+            {STATUS: {"$nin": [PENDING, CLAIMED]}},
+        ]},
+        {"$set": pending(), "$unset": {ATTEMPTS: ""}},
+    )
+    if res.modified_count:
+        print(f"Queued {res.modified_count} jobs with placeholder vectors")
+    return res.modified_count
+
+
+class WorkerPool:
+    """
+    Threads that drain the queue, plus an optional sweeper thread.
+    All workers share one Backoff, so a rate limit pauses all of them.
+    """
+
+    def __init__(self, embed_batch, text_of, placeholder, projection=None,
+                 workers=WORKERS, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL,
+                 sweep_interval=SWEEP_INTERVAL, backoff=None, fields_of=None):
+        self.embed_batch = embed_batch
+        self.text_of = text_of
+        self.placeholder = placeholder
+        self.projection = projection
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.backoff = backoff or re_embed.Backoff()
+        self.fields_of = fields_of
+        self._stop = threading.Event()
+        self._threads = []
+
+    def run_once(self):
+        '''
+        Claims and embeds one batch. Returns how many jobs were claimed.
+        '''
+        token, jobs = claim(self.batch_size, self.projection)
+        if not jobs:
+            return 0
+        texts = [self.text_of(job) for job in jobs]
+        try:
+            vectors = self.backoff.call(self.embed_batch, texts)
+        except Exception as e:
+            print(f"Embedding {len(jobs)} queued jobs failed: {e}")
+            release(token, jobs)
+            return len(jobs)
+        fields = None
+        if self.fields_of is not None:
+            fields = [self.fields_of(text, vector) for text, vector in zip(texts, vectors)]
+        complete(token, jobs, vectors, fields)
+        return len(jobs)
+
+    def start(self, sweep=True):
+        targets = [self._work] * self.workers
+        if sweep and self.sweep_interval > 0:
+            targets.append(self._sweep)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception as e:
+                print(f"Embedding worker error: {e}")
+                claimed = 0
+            if not claimed:
+                self._stop.wait(self.poll_interval)
+
+    def _sweep(self):
+        while not self._stop.is_set():
+            try:
+                sweep(self.placeholder)
+            except Exception as e:
+                print(f"Embedding sweeper error: {e}")
+            self._stop.wait(self.sweep_interval)
+
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def ensure_started(embed_batch, text_of, placeholder, projection=None, sweep=True,
+                   fields_of=None):
+    '''
+    Starts this process's WorkerPool unless it is already running.
+    Safe to call on every request; worker threads do not survive a fork,
+    so each forked server worker starts its own.
+    '''
+    global _pool, _pool_pid
+    with _lock:
+        if _pool_pid != os.getpid():
+            _pool = WorkerPool(embed_batch, text_of, placeholder, projection,
+                               fields_of=fields_of)
+            _pool.start(sweep=sweep)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+if __name__ == "__main__":
+    import db.db as db
+    db.start_embedding_workers().join()
@@ -0,0 +1,187 @@
+"""
+This file contains the embedding backends.
+Every embedder turns a list of texts into vectors of DIMENSIONS floats
+and has a name identifying its model, so vectors of different models
+never share cache entries.
+
+    openai: text-embedding-ada-002 through the OpenAI API.
+    local: a hashing vectorizer over words and word pairs, weighted by
+        IDF learned from the jobs collection. It runs on the CPU with no
+        network access; the IDF table is saved to LOCAL_EMBEDDER_PATH.
+
+EMBEDDER picks one per deployment. By default OpenAI is used when
+OPENAI_API_KEY is set and the local embedder otherwise, with a warning
+unless EMBEDDER=local is set explicitly. Vectors of
+different embedders are not comparable, so switching requires
+re-embedding the jobs (db.re_embed_all_jobs).
+"""
+
+import hashlib
+import os
+import re
+
+import numpy as np
+import openai
+
+import db.encoder_pool as encoder_pool
+
+OPENAI = "openai"
+LOCAL = "local"
+
+DIMENSIONS = 1536
+OPENAI_MODEL = "text-embedding-ada-002"
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 30))
+
+EMBEDDER = os.environ.get("EMBEDDER") or (OPENAI if os.environ.get("OPENAI_API_KEY") else LOCAL)
+LOCAL_EMBEDDER_PATH = os.environ.get("LOCAL_EMBEDDER_PATH")
+# worker processes encoding for the local embedder; 0 encodes in-process
+LOCAL_EMBEDDER_PROCESSES = int(os.environ.get("LOCAL_EMBEDDER_PROCESSES", 0))
+
+# words, keeping "c++", "c#" and "node.js" whole
+TOKEN = re.compile(r"\w+(?:[.+#]+\w+)*[+#]*")
+
+
+class OpenAIEmbedder:
+    """
+    Embeds with the OpenAI embeddings API. API errors are raised.
+    """
+
+    cacheable = True
+
+    def __init__(self, client, model=OPENAI_MODEL):
+        self.client = client
+        self.model = model
+        self.name = model
+        self.dimensions = DIMENSIONS
+
+    def embed(self, texts, timeout=None):
+        '''
+        timeout: seconds this request may take, the client's default if None
+        '''
+        options = {} if timeout is None else {"timeout": timeout}
+        response = self.client.embeddings.create(input=texts, model=self.model, **options)
+        vectors = [None] * len(texts)
+        for item in response.data:
+            vectors[item.index] = item.embedding
+        return vectors
+
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of words and word pairs with sublinear term
+    frequency and optional IDF weights, L2 normalized so cosine and dot
+    product agree. Cheap enough that its vectors are never cached.
+    """
+
+    cacheable = False
+
+    def __init__(self, dimensions=DIMENSIONS, idf=None):
+        self.dimensions = dimensions
+        self.idf = None if idf is None else np.asarray(idf, dtype=np.float32)
+        self.name = f"local-hashing-{dimensions}"
+        if self.idf is not None:
+            digest = hashlib.sha1(self.idf.tobytes()).hexdigest()[:12]
+            self.name += f"-{digest}"
+
+    def embed(self, texts, timeout=None):
+        return self.encode(texts).tolist()
+
+    def embed_one(self, text):
+        '''
+        Returns the vector of one text, e.g. a search query.
+        '''
+        return self.encode([text])[0].tolist()
+
+    def encode(self, texts):
+        '''
+        Returns the vectors of texts as a float32 array, one row per text.
+        '''
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for bucket, value in self._features(text).items():
+                matrix[row, bucket] = value
+        if self.idf is not None:
+            matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # an all-zero vector has no direction; give empty texts a fixed one
+        matrix[empty] = 1.0
+        norms[empty] = np.sqrt(self.dimensions)
+        return matrix / norms
+
+    def fit(self, texts):
+        '''
+        texts: iterable of job texts
+        Learns IDF weights from the texts.
+        Returns a new embedder using them.
+        '''
+        df = np.zeros(self.dimensions, dtype=np.float64)
+        count = 0
+        for text in texts:
+            df[list(self._features(text))] += 1
+            count += 1
+        idf = np.log((1 + count) / (1 + df)) + 1
+        return HashingEmbedder(self.dimensions, idf)
+
+    def save(self, path):
+        '''
+        Atomically writes the IDF weights to path.
+        '''
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, dimensions=self.dimensions,
+                 idf=self.idf if self.idf is not None else np.zeros(0, dtype=np.float32))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            idf = data["idf"]
+            return cls(int(data["dimensions"]), idf if idf.size else None)
+
+    def _features(self, text):
+        tokens = TOKEN.findall(text.casefold())
+        counts = {}
+        for gram in tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]:
+            counts[gram] = counts.get(gram, 0) + 1
+        features = {}
+        for gram, count in counts.items():
+            digest = int.from_bytes(
+                hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+            bucket = digest % self.dimensions
+            sign = 1.0 if digest >> 63 else -1.0
+            features[bucket] = features.get(bucket, 0.0) + sign * (1 + np.log(count))
+        return features
+
+
+def from_env(kind=None):
+    '''
+    kind: "openai" or "local"; defaults to EMBEDDER
+    Returns the embedder configured for this deployment.
+    '''
+    if kind is None and not os.environ.get("EMBEDDER") and EMBEDDER == LOCAL:
+        # a deployment that lost its key would mix local and OpenAI vectors
+        print("WARNING: OPENAI_API_KEY is not set and EMBEDDER is not set; "
+              "falling back to the local embedder. Its vectors are not comparable "
+              "with OpenAI ones; set EMBEDDER=local to silence this.")
+    kind = kind or EMBEDDER
+    if kind == OPENAI:
+        # retries are left to re_embed.Backoff, which shares them between threads
+        return OpenAIEmbedder(openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"),
+                                            timeout=OPENAI_TIMEOUT, max_retries=0))
+    if kind == LOCAL:
+        if LOCAL_EMBEDDER_PATH and os.path.exists(LOCAL_EMBEDDER_PATH):
+            return pooled(HashingEmbedder.load(LOCAL_EMBEDDER_PATH))
+        return pooled(HashingEmbedder())
+    raise ValueError(f"Unknown embedder {kind}")
+
+
+def pooled(embedder, processes=None):
+    '''
+    embedder: a local embedder
+    Returns embedder behind an EncoderPool of processes worker processes
+    (LOCAL_EMBEDDER_PROCESSES by default), or embedder itself for 0.
+    '''
+    processes = LOCAL_EMBEDDER_PROCESSES if processes is None else processes
+    if processes > 0:
+        return encoder_pool.EncoderPool(embedder, processes)
+    return embedder
@@ -0,0 +1,221 @@
+"""
+This file provides a content-addressed cache for embedding vectors.
+Vectors are keyed by a hash of (model, normalized text) so the same text
+is only ever sent to the embeddings API once per model.
+There are two tiers: an in-process LRU with size/TTL eviction and a
+persistent tier stored in the `embedding_cache` collection. Persistent
+entries are stored through vector_codec, so EMBEDDING_STORAGE applies,
+and Mongo drops them PERSIST_DAYS after they were written through the
+TTL index declared in schema.INDEXES.
+"""
+
+import collections
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+import pymongo.errors
+from pymongo import UpdateOne
+
+import db.db_connect as dbc
+import db.vector_codec as vector_codec
+
+CACHE_COLLECTION = "embedding_cache"
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_SIZE", 4096))
+DEFAULT_TTL = float(os.environ.get("EMBEDDING_CACHE_TTL", 24 * 60 * 60))
+PERSIST = os.environ.get("EMBEDDING_CACHE_PERSIST", "1") == "1"
+PERSIST_DAYS = float(os.environ.get("EMBEDDING_CACHE_PERSIST_DAYS", 30))
+PERSIST_TTL_INDEX = "embedding_cache_ttl"
+STORED_AT = "stored_at"
+
+HITS = "hits"
+MISSES = "misses"
+PERSISTENT_HITS = "persistent_hits"
+EVICTIONS = "evictions"
+
+
+def normalize_text(text):
+    '''
+    text: the text to be embedded
+    Collapses whitespace and case so trivially different strings
+    share one cache entry.
+    '''
+    return " ".join(text.split()).casefold()
+
+
+def cache_key(model, text):
+    '''
+    model: the embedding model name
+    text: the text to be embedded
+    Returns the content address of (model, normalized text).
+    '''
+    payload = model + "\x00" + normalize_text(text)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    LRU + TTL cache of embedding vectors with an optional Mongo backed tier.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 persist=PERSIST, collection=CACHE_COLLECTION):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self.collection = collection
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {HITS: 0, MISSES: 0, PERSISTENT_HITS: 0, EVICTIONS: 0}
+
+    def get(self, model, text):
+        '''
+        Returns the cached vector for (model, text) or None.
+        The in-memory tier is checked first, then the persistent tier.
+        '''
+        key = cache_key(model, text)
+        vector = self._get_memory(key)
+        if vector is not None:
+            return vector
+        vector = self._get_persistent(key)
+        with self._lock:
+            if vector is None:
+                self._counters[MISSES] += 1
+                return None
+            self._counters[PERSISTENT_HITS] += 1
+        self._put_memory(key, vector)
+        return vector
+
+    def put(self, model, text, vector):
+        '''
+        Stores vector for (model, text) in both tiers.
+        '''
+        key = cache_key(model, text)
+        self._put_memory(key, vector)
+        self._put_persistent(key, model, vector)
+
+    def get_many(self, model, texts):
+        '''
+        Returns a list of cached vectors (or None) lined up with texts.
+        Memory misses are looked up in the persistent tier with one query.
+        '''
+        keys = [cache_key(model, text) for text in texts]
+        vectors = [self._get_memory(key) for key in keys]
+        missing = {keys[i] for i, vector in enumerate(vectors) if vector is None}
+        found = self._get_persistent_many(missing)
+        for i, key in enumerate(keys):
+            if vectors[i] is not None:
+                continue
+            vectors[i] = found.get(key)
+            with self._lock:
+                self._counters[MISSES if vectors[i] is None else PERSISTENT_HITS] += 1
+            if vectors[i] is not None:
+                self._put_memory(key, vectors[i])
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        '''
+        Stores every (text, vector) pair in both tiers.
+        The persistent tier is written with a single bulk_write.
+        '''
+        keys = [cache_key(model, text) for text in texts]
+        for key, vector in zip(keys, vectors):
+            self._put_memory(key, vector)
+        if not self.persist or not keys:
+            return
+        operations = [
+            UpdateOne({dbc.MONGO_ID: key}, {"$set": _persistent_doc(model, vector)}, upsert=True)
+            for key, vector in zip(keys, vectors)
+        ]
+        try:
+            dbc.bulk_write(self.collection, operations)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not persist embeddings: {e}")
+
+    def stats(self):
+        '''
+        Returns the hit/miss counters and the current size of the memory tier.
+        '''
+        with self._lock:
+            res = dict(self._counters)
+            res["size"] = len(self._entries)
+        lookups = res[HITS] + res[PERSISTENT_HITS] + res[MISSES]
+        res["hit_rate"] = (res[HITS] + res[PERSISTENT_HITS]) / lookups if lookups else 0.0
+        return res
+
+    def clear(self):
+        '''
+        Empties the memory tier and resets the counters.
+        The persistent tier is left alone.
+        '''
+        with self._lock:
+            self._entries.clear()
+            for counter in self._counters:
+                self._counters[counter] = 0
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self._counters[EVICTIONS] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters[HITS] += 1
+            return vector
+
+    def _put_memory(self, key, vector):
+        with self._lock:
+            self._entries[key] = (vector, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters[EVICTIONS] += 1
+
+    def _get_persistent(self, key):
+        if not self.persist:
+            return None
+        try:
+            doc = dbc.fetch_one(self.collection, {dbc.MONGO_ID: key})
+        except pymongo.errors.PyMongoError:
+            return None
+        if doc is None:
+            return None
+        return vector_codec.decode(doc["vector"])
+
+    def _get_persistent_many(self, keys):
+        if not self.persist or not keys:
+            return {}
+        try:
+            docs = dbc.fetch_all(self.collection, filt={dbc.MONGO_ID: {"$in": list(keys)}})
+        except pymongo.errors.PyMongoError:
+            return {}
+        return {doc[dbc.MONGO_ID]: vector_codec.decode(doc["vector"]) for doc in docs}
+
+    def _put_persistent(self, key, model, vector):
+        if not self.persist:
+            return
+        try:
+            dbc.update_doc(
+                self.collection,
+                {dbc.MONGO_ID: key},
+                _persistent_doc(model, vector),
+                upsert=True,
+            )
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not persist embedding: {e}")
+
+
+def _persistent_doc(model, vector):
+    # TTL indexes compare against UTC, which is how naive datetimes are stored
+    return {"model": model, "vector": vector_codec.encode(vector),
+            STORED_AT: datetime.datetime.utcnow()}
+
+
+cache = EmbeddingCache()
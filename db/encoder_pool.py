@@ -0,0 +1,124 @@
+"""
+This file contains the process pool the local embedder encodes in.
+Encoding is pure Python and NumPy and holds the GIL, so a large batch
+(a re-embed, a scraper run) encoded inside a server process would stall
+its requests. An EncoderPool splits a batch into chunks and encodes them
+in worker processes. The workers write float32 rows straight into one
+shared memory block instead of pickling 1536 floats per text back.
+Small calls, such as embedding a search query, are encoded in-process
+since shipping them to a worker costs more than the encoding.
+"""
+
+import concurrent.futures as futures
+import multiprocessing
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+CHUNK_SIZE = int(os.environ.get("LOCAL_EMBEDDER_CHUNK_SIZE", 64))
+# calls with at most this many texts are encoded in the calling process
+INLINE_MAX = int(os.environ.get("LOCAL_EMBEDDER_INLINE_MAX", 8))
+
+_embedder = None
+
+
+def _init_worker(embedder):
+    global _embedder
+    _embedder = embedder
+
+
+def _encode_into(name, shape, start, texts):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+        out[start:start + len(texts)] = _embedder.encode(texts)
+        # the view must go before the block can be closed
+        del out
+    finally:
+        block.close()
+    return len(texts)
+
+
+class EncoderPool:
+    """
+    Wraps a local embedder (one with encode) and has the same interface.
+    Workers are spawned on first use, and again in a forked child, so
+    they never inherit the server's Mongo client or threads.
+    """
+
+    def __init__(self, embedder, processes, chunk_size=CHUNK_SIZE, inline_max=INLINE_MAX):
+        self.embedder = embedder
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.inline_max = inline_max
+        self.name = embedder.name
+        self.dimensions = embedder.dimensions
+        self.cacheable = embedder.cacheable
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts, timeout=None):
+        return self.encode(texts).tolist()
+
+    def embed_one(self, text):
+        '''
+        Returns the vector of one text, encoded in-process whatever
+        inline_max is, since a search query is waiting on it.
+        '''
+        return self.embedder.embed_one(text)
+
+    def encode(self, texts):
+        '''
+        texts: list of texts
+        Returns their vectors as a float32 array, one row per text.
+        '''
+        texts = list(texts)
+        if len(texts) <= self.inline_max:
+            return self.embedder.encode(texts)
+        shape = (len(texts), self.dimensions)
+        block = shared_memory.SharedMemory(create=True, size=len(texts) * self.dimensions * 4)
+        try:
+            executor = self._get_executor()
+            pending = [
+                executor.submit(_encode_into, block.name, shape, start,
+                                texts[start:start + self.chunk_size])
+                for start in range(0, len(texts), self.chunk_size)
+            ]
+            # let every chunk finish writing before the block goes away
+            futures.wait(pending)
+            for future in pending:
+                future.result()
+            view = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+            vectors = view.copy()
+            del view
+        except BrokenProcessPool:
+            # a worker died; start fresh ones on the next call
+            self.close()
+            raise
+        finally:
+            block.close()
+            block.unlink()
+        return vectors
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = futures.ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.embedder,),
+                )
+                self._pid = os.getpid()
+            return self._executor
@@ -0,0 +1,49 @@
+"""
+This file tracks writes to the jobs collection.
+Every mutation in db.py calls changed(), which increments a counter in
+the collection_versions collection. Every process sees it: the response
+caches and the HTTP ETags of job listings are both derived from it, so
+they agree with each other. generation() is a cheaper per-process
+counter that only sees this process's writes.
+"""
+
+import threading
+
+import db.db_connect as dbc
+
+VERSIONS_COLLECTION = "collection_versions"
+JOBS = "jobs"
+
+_generation = 0
+_lock = threading.Lock()
+
+
+def changed(job_id=None):
+    '''
+    job_id: the job that changed, or None for bulk changes
+    Records that the jobs collection was written to.
+    '''
+    global _generation
+    with _lock:
+        _generation += 1
+    dbc.find_one_and_update(
+        VERSIONS_COLLECTION, {dbc.MONGO_ID: JOBS}, {"$inc": {"version": 1}},
+        projection={dbc.MONGO_ID: 1}, upsert=True,
+    )
+    return _generation
+
+
+def generation():
+    return _generation
+
+
+def collection_version(collection=JOBS):
+    '''
+    Returns how many times the collection has been changed through db.py,
+    across every process.
+    '''
+    doc = dbc.fetch_one(VERSIONS_COLLECTION, {dbc.MONGO_ID: collection},
+                        projection={"version": 1})
+    if doc is None:
+        return 0
+    return doc["version"]
@@ -0,0 +1,197 @@
+"""
+This file contains the batched re-embedding engine used by
+db.re_embed_all_jobs.
+Jobs are streamed from Mongo in _id order, embedded many texts per API
+request with a bounded number of requests in flight, and written back
+with bulk_write. The last fully written _id is checkpointed so an
+interrupted run picks up where it stopped.
+"""
+
+import concurrent.futures
+import datetime
+import os
+import random
+import threading
+import time
+
+import openai
+from pymongo import UpdateOne
+
+import db.db_connect as dbc
+import db.resilience as resilience
+import db.vector_codec as vector_codec
+
+CHECKPOINT_COLLECTION = "re_embed_checkpoints"
+CHECKPOINT_ID = "re_embed_all_jobs"
+
+BATCH_SIZE = int(os.environ.get("RE_EMBED_BATCH_SIZE", 100))
+CONCURRENCY = int(os.environ.get("RE_EMBED_CONCURRENCY", 4))
+MAX_ATTEMPTS = int(os.environ.get("RE_EMBED_MAX_ATTEMPTS", 8))
+MAX_BACKOFF = 60
+
+
+class Backoff:
+    """
+    Rate-limit state shared by every worker of a run.
+    When one request is rate limited, all workers pause until the
+    server's retry-after (or an exponential delay) has elapsed.
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def call(self, func, *args, deadline=None):
+        '''
+        Calls func(*args), retrying on openai.RateLimitError.
+        Any other error is raised to the caller.
+        deadline: optional resilience.Deadline; a pause that would outlast
+            it raises DeadlineExceeded (or the RateLimitError) instead.
+        '''
+        attempt = 0
+        while True:
+            self._wait(deadline)
+            try:
+                return func(*args)
+            except openai.RateLimitError as e:
+                attempt += 1
+                delay = retry_delay(e, attempt)
+                # pause the other callers even if this one gives up
+                self._pause(delay)
+                if attempt >= self.max_attempts or (
+                        deadline is not None and not deadline.allows(delay)):
+                    raise
+
+    def _wait(self, deadline=None):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            if deadline is not None and not deadline.allows(delay):
+                raise resilience.DeadlineExceeded("Rate limited past the deadline")
+            self._sleep(delay)
+
+    def _pause(self, delay):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+
+def retry_delay(error, attempt):
+    '''
+    error: the RateLimitError raised by the API
+    attempt: how many times the call has failed so far
+    Returns the server's retry-after if given, else exponential backoff with jitter.
+    '''
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            return min(float(retry_after), MAX_BACKOFF)
+        except (TypeError, ValueError):
+            pass
+    return min(2 ** attempt + random.random(), MAX_BACKOFF)
+
+
+def load_checkpoint(name=CHECKPOINT_ID):
+    '''
+    Returns the last _id written by an unfinished run, or None.
+    '''
+    doc = dbc.fetch_one(CHECKPOINT_COLLECTION, {dbc.MONGO_ID: name})
+    if doc is None:
+        return None
+    return doc["last_id"]
+
+
+def save_checkpoint(last_id, name=CHECKPOINT_ID):
+    dbc.update_doc(
+        CHECKPOINT_COLLECTION,
+        {dbc.MONGO_ID: name},
+        {"last_id": last_id, "updated_at": datetime.datetime.now()},
+        upsert=True,
+    )
+
+
+def clear_checkpoint(name=CHECKPOINT_ID):
+    dbc.del_one(CHECKPOINT_COLLECTION, {dbc.MONGO_ID: name})
+
+
+def run(embed_batch, text_of, filt=None, batch_size=BATCH_SIZE,
+        concurrency=CONCURRENCY, backoff=None, resume=True, name=CHECKPOINT_ID,
+        projection=None, needs=None, fields_of=None):
+    '''
+    embed_batch: function taking a list of texts and returning their vectors
+    text_of: function building the embedding text of a job document
+    filt: optional filter restricting which jobs are re-embedded
+    projection: fields text_of needs; defaults to everything but the vector
+    needs: optional function (job, text) telling whether a job has to be
+        re-embedded; jobs it rejects are read but not embedded
+    fields_of: optional function (text, vector) returning the fields to
+        write; defaults to just the vector
+    Re-embeds jobs batch by batch and returns how many were written.
+    The checkpoint only advances over batches that are fully written,
+    so batches finishing out of order never skip work on resume.
+    '''
+    backoff = backoff or Backoff()
+    after_id = load_checkpoint(name) if resume else None
+    if after_id is not None:
+        print(f"Resuming re-embedding after {after_id}")
+
+    def work(batch):
+        texts = [text_of(job) for job in batch]
+        todo = [(job, text) for job, text in zip(batch, texts)
+                if needs is None or needs(job, text)]
+        if not todo:
+            return 0
+        vectors = backoff.call(embed_batch, [text for _, text in todo])
+        operations = [
+            UpdateOne({dbc.MONGO_ID: job[dbc.MONGO_ID]},
+                      {"$set": fields_of(text, vector) if fields_of is not None
+                       else {"embedding_vector": vector_codec.encode(vector)}})
+            for (job, text), vector in zip(todo, vectors)
+        ]
+        dbc.bulk_write("jobs", operations)
+        return len(operations)
+
+    written = 0
+    pending = {}
+    done = {}
+    next_to_commit = 0
+    last_ids = []
+    batches = dbc.fetch_batches(
+        "jobs", batch_size, filt=filt, after_id=after_id,
+        projection=projection or {"embedding_vector": 0},
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seq, batch in enumerate(batches):
+            last_ids.append(batch[-1][dbc.MONGO_ID])
+            pending[pool.submit(work, batch)] = seq
+            while len(pending) >= concurrency:
+                written += _collect(pending, done, concurrent.futures.FIRST_COMPLETED)
+                next_to_commit = _advance(done, last_ids, next_to_commit, name)
+        while pending:
+            written += _collect(pending, done, concurrent.futures.ALL_COMPLETED)
+        _advance(done, last_ids, next_to_commit, name)
+    clear_checkpoint(name)
+    print(f"Re-embedded {written} jobs")
+    return written
+
+
+def _collect(pending, done, return_when):
+    finished, _ = concurrent.futures.wait(pending, return_when=return_when)
+    count = 0
+    for future in finished:
+        seq = pending.pop(future)
+        count += future.result()
+        done[seq] = True
+    return count
+
+
+def _advance(done, last_ids, next_to_commit, name):
+    start = next_to_commit
+    while done.pop(next_to_commit, False):
+        next_to_commit += 1
+    if next_to_commit != start:
+        save_checkpoint(last_ids[next_to_commit - 1], name)
+        print(f"Re-embedded through batch {next_to_commit}")
+    return next_to_commit
@@ -0,0 +1,135 @@
+"""
+This file contains the guards around calls to the embedding API.
+
+    Deadline: a time budget shared by every step of one request, so
+        retries and rate-limit pauses can't outlast it.
+    CircuitBreaker: stops calling the API for a while after repeated
+        failures, so requests fail fast instead of each waiting on a
+        timeout.
+
+Rate-limit pauses are shared through re_embed.Backoff.
+"""
+
+import os
+import threading
+import time
+
+DEADLINE = float(os.environ.get("EMBEDDING_DEADLINE", 10))
+FAILURE_THRESHOLD = int(os.environ.get("EMBEDDING_BREAKER_FAILURES", 5))
+RESET_TIMEOUT = float(os.environ.get("EMBEDDING_BREAKER_RESET", 30))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class Deadline:
+    """
+    Expires seconds after it is created.
+    """
+
+    def __init__(self, seconds=DEADLINE, clock=time.monotonic):
+        self._clock = clock
+        self.expires = clock() + seconds
+
+    def remaining(self):
+        '''
+        Returns the seconds left, raising DeadlineExceeded if none are.
+        '''
+        left = self.expires - self._clock()
+        if left <= 0:
+            raise DeadlineExceeded("Embedding deadline exceeded")
+        return left
+
+    def allows(self, delay):
+        '''
+        Returns whether waiting delay seconds still leaves time to work.
+        '''
+        return self._clock() + delay < self.expires
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through and consecutive failures are counted.
+    Open: after failure_threshold of them, calls raise CircuitOpenError
+    straight away for reset_timeout seconds.
+    Half open: then one trial call is let through; its success closes
+    the breaker again and its failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._rejected = 0
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Calls func(*args, **kwargs) unless the breaker is open.
+        '''
+        self._before()
+        try:
+            res = func(*args, **kwargs)
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+        return res
+
+    def state(self):
+        with self._lock:
+            return self._current()
+
+    def stats(self):
+        with self._lock:
+            return {"state": self._current(), "failures": self._failures,
+                    "rejected": self._rejected}
+
+    def reset(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial = False
+
+    def _current(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def _before(self):
+        with self._lock:
+            state = self._current()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self._rejected += 1
+        raise CircuitOpenError("Embedding API unavailable, not calling it for now")
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self._state = CLOSED
+                self._failures = 0
+            else:
+                self._failures += 1
+                if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                    self._state = OPEN
+                    self._opened_at = self._clock()
+            self._trial = False
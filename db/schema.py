@@ -0,0 +1,148 @@
+"""
+This file declares the indexes our queries rely on.
+ensure_indexes() is idempotent and runs once per process, on the
+server's first request; code that depends on a constraint (e.g. unique
+usernames) may call it again, which is free after it has succeeded.
+An index can still be missing afterwards (legacy duplicate usernames
+keep the unique ones from being built), so such code checks with
+users_are_unique() instead of assuming it.
+"""
+
+import os
+import threading
+
+import pymongo.errors as pm_errors
+from pymongo import ASCENDING, DESCENDING
+
+import db.db_connect as dbc
+import db.embedding_cache as embedding_cache
+
+JOB_TTL_INDEX = "job_ttl"
+JOB_TTL_DAYS = os.environ.get("JOB_TTL_DAYS")
+
+# only index real strings so legacy docs missing the field don't collide
+_IS_STRING = {"$type": "string"}
+
+INDEXES = {
+    "users": [
+        ([("username", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"username": _IS_STRING}}),
+        ([("email", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"email": _IS_STRING}}),
+    ],
+    "jobs": [
+        # serves date sorts, keyset pages and date range expiry
+        ([("date", DESCENDING), ("_id", DESCENDING)], {}),
+        # postings are deduplicated on it; jobs from before it existed have none
+        ([("fingerprint", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"fingerprint": _IS_STRING}}),
+        # only queued jobs carry embedding_status, so this index stays small
+        ([("embedding_status", ASCENDING), ("_id", ASCENDING)],
+         {"partialFilterExpression": {"embedding_status": {"$exists": True}}}),
+    ],
+    "user_reports": [
+        ([("job_id", ASCENDING)], {}),
+        ([("user_id", ASCENDING)], {}),
+    ],
+    embedding_cache.CACHE_COLLECTION: [
+        # bounds the persistent embedding cache; re-embedding a dropped text is cheap
+        ([(embedding_cache.STORED_AT, ASCENDING)],
+         {"name": embedding_cache.PERSIST_TTL_INDEX,
+          "expireAfterSeconds": int(embedding_cache.PERSIST_DAYS * 24 * 60 * 60)}),
+    ],
+}
+
+_ensured_pid = None
+# whether the unique users indexes were found once indexes were ensured
+_unique_users = False
+_lock = threading.Lock()
+
+
+def ensure_indexes(force=False):
+    '''
+    Creates every index in INDEXES (and the TTL index when JOB_TTL_DAYS
+    is set) unless this process has already done so.
+    If Mongo cannot be reached the error is reported and the next call
+    tries again.
+    '''
+    global _ensured_pid, _unique_users
+    with _lock:
+        if _ensured_pid == os.getpid() and not force:
+            return
+        try:
+            _create_indexes()
+            _unique_users = _has_unique_users()
+        except pm_errors.PyMongoError as e:
+            print(f"Could not ensure indexes: {e}")
+            return
+        _ensured_pid = os.getpid()
+
+
+def users_are_unique():
+    '''
+    Ensures the indexes, then returns whether Mongo enforces unique
+    usernames and emails. It doesn't when the unique indexes could not
+    be built, e.g. over legacy duplicates, or Mongo could not be reached.
+    '''
+    ensure_indexes()
+    with _lock:
+        return _ensured_pid == os.getpid() and _unique_users
+
+
+def _has_unique_users():
+    info = dbc.index_information("users").values()
+    unique = [index["key"] for index in info if index.get("unique")]
+    return all(keys in unique for keys, options in INDEXES["users"] if options.get("unique"))
+
+
+def _create_indexes():
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                _create_index(collection, keys, options)
+            except pm_errors.OperationFailure as e:
+                # e.g. existing duplicate usernames; report and keep serving
+                print(f"Could not create index {keys} on {collection}: {e}")
+    if JOB_TTL_DAYS:
+        try:
+            set_job_ttl(float(JOB_TTL_DAYS))
+        except pm_errors.OperationFailure as e:
+            print(f"Could not set the job TTL: {e}")
+
+
+def _create_index(collection, keys, options):
+    seconds = options.get("expireAfterSeconds")
+    existing = dbc.index_information(collection).get(options.get("name"))
+    if seconds is not None and existing is not None:
+        # create_index refuses to change a TTL; collMod changes it in place
+        if existing.get("expireAfterSeconds") != seconds:
+            dbc.run_command("collMod", collection,
+                            index={"name": options["name"], "expireAfterSeconds": seconds})
+        return options["name"]
+    return dbc.create_index(collection, keys, **options)
+
+
+def set_job_ttl(days):
+    """
+    days: jobs expire this many days after their date; None turns expiry off
+    Lets Mongo delete expired jobs itself through a TTL index on date.
+    An existing TTL index is changed in place with collMod, since
+    create_index refuses to change its options.
+    Mongo's TTL deletions bypass db.py, so they don't bump the jobs
+    version: cached listings and their ETags still show expired jobs
+    until the next write through db.py.
+    """
+    existing = dbc.index_information("jobs").get(JOB_TTL_INDEX)
+    if days is None:
+        if existing is not None:
+            dbc.drop_index("jobs", JOB_TTL_INDEX)
+        return None
+    seconds = int(days * 24 * 60 * 60)
+    if existing is None:
+        return dbc.create_index(
+            "jobs", [("date", ASCENDING)], name=JOB_TTL_INDEX, expireAfterSeconds=seconds,
+        )
+    if existing.get("expireAfterSeconds") != seconds:
+        dbc.run_command("collMod", "jobs",
+                        index={"name": JOB_TTL_INDEX, "expireAfterSeconds": seconds})
+    return JOB_TTL_INDEX
@@ -1,9 +1,12 @@
 from bson import ObjectId
 import db.db as db
+import db.embedders as embedders
 import pytest
 import db.db_connect as dbc
+import db.schema as schema
 import datetime
 import os 
+from unittest.mock import MagicMock, patch
 
 TEST_DB = dbc.DB_NAME
 
@@ -14,6 +17,7 @@ job_id_2 = ObjectId()
 job_id_3 = ObjectId("607f191e810c19729de860ea")
 admin_id = ObjectId()
 dbc.client.drop_database(TEST_DB)
+schema.ensure_indexes(force=True)
 
 invalid_id = ObjectId("607f191e810c19729eeeeeee")
 
@@ -138,6 +142,16 @@ def test_delete_job_past_date_works(temp_jobs_1, temp_user):
     assert res[0]["_id"] == job_id_2
 
 
+def test_delete_job_past_date_archive(temp_jobs_1, temp_user):
+    moved = db.delete_job_past_date(datetime.datetime(2022, 5, 17), archive=True, batch_size=1)
+    assert moved == 2
+    res = dbc.fetch_all("jobs")
+    assert [job["_id"] for job in res] == [job_id_2]
+    archived = dbc.fetch_all(db.ARCHIVE_COLLECTION, filt={"_id": {"$in": [job_id, job_id_1]}})
+    assert len(archived) == 2
+    dbc.del_many(db.ARCHIVE_COLLECTION, {"_id": {"$in": [job_id, job_id_1]}})
+
+
 def test_delete_job_past_date_fail(temp_jobs_1, temp_user):
     try:
         db.delete_job_past_date(user_id, "hello")
@@ -153,6 +167,29 @@ def test_get_most_recent_job(temp_user, temp_jobs_1):
     assert res[0]["job_id"] == str(job_id_2)
 
 
+def test_get_most_recent_job_hides_embedding(temp_user, temp_jobs_1):
+    for job in db.get_most_recent_job(3):
+        assert "embedding_vector" not in job
+
+
+def test_get_most_recent_job_page(temp_user, temp_jobs_1):
+    first, cursor = db.get_most_recent_job_page(2)
+    assert [job["job_id"] for job in first][0] == str(job_id_2)
+    assert cursor is not None
+    second, cursor = db.get_most_recent_job_page(2, cursor)
+    assert len(second) == 1
+    assert cursor is None
+    assert {job["job_id"] for job in first + second} == {str(job_id), str(job_id_1), str(job_id_2)}
+
+
+def test_page_cursor_round_trip():
+    date = datetime.datetime(2024, 5, 17, 12, 30)
+    token = db.encode_page_cursor(date, job_id)
+    assert db.decode_page_cursor(token) == (date, job_id)
+    with pytest.raises(ValueError):
+        db.decode_page_cursor("not a cursor")
+
+
 def test_get_most_recent_job_1(temp_user, temp_jobs_1):
     res = db.get_most_recent_job(4)
     print(res)
@@ -166,6 +203,13 @@ def test_add_account():
     assert dbc.client[TEST_DB]["users"].delete_one({"_id": identification})
 
 
+def test_add_account_duplicate_email():
+    identification = db.add_account("FakeAcc", "Fakemail.com", "FakePassword").inserted_id
+    with pytest.raises(KeyError, match="Email already exists"):
+        db.add_account("OtherFakeAcc", "Fakemail.com", "FakePassword")
+    assert dbc.client[TEST_DB]["users"].delete_one({"_id": identification})
+
+
 def test_add_account_bad():
     with pytest.raises(KeyError):
         identification = db.add_account(
@@ -189,6 +233,61 @@ def test_update_job_works():
     dbc.client[TEST_DB]["jobs"].delete_one({"_id": job_id_3})
 
 
+def test_update_job_skips_embedding_when_text_unchanged():
+    identification = db.add_job_posting(
+        "HELLO WORLD", "test", "test", "test", datetime.datetime(2023, 12, 12), "test"
+    ).inserted_id
+    with patch("db.db.generate_vector", return_value=db.DEFAULT_VECTOR) as mock_embed:
+        job = db.update_job(identification, {"link": "new link", "company": "HELLO WORLD"})
+        assert mock_embed.call_count == 0
+        assert job["link"] == "new link"
+        db.update_job(identification, {"company": "NEW COMPANY"})
+        assert mock_embed.call_count == 1
+        assert "NEW COMPANY" in mock_embed.call_args[0][0]
+        # resending every field unchanged neither embeds nor touches the vector
+        stored = dbc.fetch_one("jobs", {"_id": identification})
+        db.update_job(identification, {field: stored[field] for field in db.EMBEDDING_FIELDS})
+        assert mock_embed.call_count == 1
+        assert dbc.fetch_one("jobs", {"_id": identification})["embedding_vector"] == \
+            stored["embedding_vector"]
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": identification})
+
+
+def test_job_versions():
+    identification = db.add_job_posting(
+        "HELLO WORLD", "test", "test", "test", datetime.datetime(2023, 12, 12), "test"
+    ).inserted_id
+    jobs_version = db.get_jobs_version()
+    assert jobs_version > 0
+    assert db.get_job_version(identification) == 1
+    job = db.update_job(identification, {"link": "new link", "version": 100})
+    assert job["version"] == 2
+    assert db.get_job_version(identification) == 2
+    assert db.get_jobs_version() == jobs_version + 1
+    assert db.get_job_version(ObjectId()) is None
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": identification})
+
+
+def test_add_job_posting_queued():
+    with patch("db.embed_queue.ENABLED", True), \
+            patch("db.db.generate_vector") as mock_embed:
+        identification = db.add_job_posting(
+            "HELLO WORLD", "test", "test", "test", datetime.datetime(2023, 12, 12), "test"
+        ).inserted_id
+        job = dbc.fetch_one("jobs", {"_id": identification})
+        assert job["embedding_status"] == "pending"
+        assert "embedding_vector" not in job
+        listed = db.get_job_by_id(identification)
+        for field in db.INTERNAL_FIELDS:
+            assert field not in listed
+        dbc.update_doc("jobs", {"_id": identification},
+                       {"embedding_status": None, "embedding_vector": db.DEFAULT_VECTOR})
+        db.update_job(identification, {"company": "NEW COMPANY"})
+        assert dbc.fetch_one("jobs", {"_id": identification})["embedding_status"] == "pending"
+        assert mock_embed.call_count == 0
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": identification})
+
+
 def test_update_job_fails():
     try:
         db.update_job(invalid_id, {"description": "HELLOOO"})
@@ -205,6 +304,143 @@ def test_add_job_works():
     dbc.client[TEST_DB]["jobs"].delete_one({"_id": res})
 
 
+def test_add_job_records_embedding_state():
+    res = db.add_job_posting(
+        "EMBED STATE", "test", "test", "test", datetime.datetime(2023, 12, 12), "test"
+    ).inserted_id
+    stored = dbc.fetch_one("jobs", {"_id": res})
+    assert stored["embedding_hash"] == db.embedding_text_hash(db.job_embedding_text(stored))
+    assert stored["embedding_model"] == db.embedding_model()
+    assert not db.embedding_is_stale(stored, db.job_embedding_text(stored))
+    assert "embedding_hash" not in db.get_job_by_id(res)
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": res})
+
+
+def test_re_embed_all_jobs_is_incremental():
+    fresh = db.add_job_posting(
+        "FRESH CO", "test", "test", "test", datetime.datetime(2023, 12, 12), "fresh"
+    ).inserted_id
+    stale = db.add_job_posting(
+        "STALE CO", "test", "test", "test", datetime.datetime(2023, 12, 12), "stale"
+    ).inserted_id
+    dbc.client[TEST_DB]["jobs"].update_one({"_id": stale},
+                                          {"$set": {"embedding_model": "old-model"}})
+    embedded = []
+
+    def embed(texts):
+        embedded.extend(texts)
+        return [db.DEFAULT_VECTOR[:] for _ in texts]
+
+    with patch("db.db.generate_vectors", side_effect=embed):
+        db.re_embed_all_jobs(resume=False)
+    assert any(text.startswith("STALE CO") for text in embedded)
+    assert not any(text.startswith("FRESH CO") for text in embedded)
+    assert dbc.fetch_one("jobs", {"_id": stale})["embedding_model"] == db.embedding_model()
+    with patch("db.db.generate_vectors", side_effect=embed):
+        embedded.clear()
+        db.re_embed_all_jobs(resume=False, force=True)
+    assert any(text.startswith("FRESH CO") for text in embedded)
+    dbc.client[TEST_DB]["jobs"].delete_many({"_id": {"$in": [fresh, stale]}})
+
+
+def test_re_embed_all_jobs_invalidates_the_index():
+    with patch("db.re_embed.run", return_value=0), \
+            patch("db.vector_index.invalidate") as mock_invalidate:
+        db.re_embed_all_jobs(resume=False)
+    mock_invalidate.assert_called_once_with()
+
+
+def test_train_local_embedder_needs_a_path():
+    with pytest.raises(ValueError):
+        db.train_local_embedder(path="")
+
+
+def test_add_job_postings():
+    jobs = [
+        {"company": "BULK 1", "job_type": "test", "location": "test",
+         "date": datetime.datetime(2023, 12, 12), "link": "test"},
+        {"company": "BULK 2", "location": "test", "date": datetime.datetime(2023, 12, 12)},
+        {"company": "BULK 3", "job_description": "desc", "job_type": "test",
+         "location": "test", "date": "2023-12-12", "link": "test"},
+        {"company": "BULK 4", "job_description": "desc", "job_type": "test",
+         "location": "test", "date": datetime.datetime(2023, 12, 13), "link": "test"},
+    ]
+    with patch("db.db.generate_vectors",
+               side_effect=lambda texts: [db.DEFAULT_VECTOR] * len(texts)) as mock_embed:
+        results = db.add_job_postings(jobs, batch_size=1)
+        assert mock_embed.call_count == 2
+    assert [result["status"] for result in results] == ["created", "error", "error", "created"]
+    assert "job_type" in results[1]["message"]
+    for result in (results[0], results[3]):
+        job = dbc.fetch_one("jobs", {"_id": ObjectId(result["job_id"])})
+        assert job["company"] in ("BULK 1", "BULK 4")
+        assert job["version"] == 1
+        dbc.client[TEST_DB]["jobs"].delete_one({"_id": ObjectId(result["job_id"])})
+
+
+def test_normalize_link():
+    assert db.normalize_link(" HTTPS://WWW.Example.com/jobs/1/?b=2&utm_source=x&a=1#apply ") \
+        == "https://example.com/jobs/1?a=1&b=2"
+    assert db.normalize_link("https://example.com/jobs/1?ref=simplify") \
+        == db.normalize_link("https://example.com/jobs/1")
+
+
+def test_job_fingerprint():
+    fingerprint = db.job_fingerprint("Apple", "SWE  Intern", "https://www.apple.com/job/1/")
+    assert fingerprint == db.job_fingerprint("apple", "swe intern", "https://apple.com/job/1")
+    assert fingerprint != db.job_fingerprint("Apple", "SWE Intern", "https://apple.com/job/2")
+    assert fingerprint != db.job_fingerprint("Google", "SWE Intern", "https://apple.com/job/1")
+
+
+def test_add_job_posting_is_idempotent():
+    args = ("DEDUP CO", "desc", "intern", "SF", datetime.datetime(2023, 12, 12),
+            "https://dedup.example.com/1")
+    first = db.add_job_posting(*args).inserted_id
+    with patch("db.db.generate_vector", return_value=db.DEFAULT_VECTOR) as mock_embed:
+        again = db.add_job_posting(*args).inserted_id
+        assert again == first
+        assert mock_embed.call_count == 0
+        assert db.get_job_version(first) == 1
+        moved = db.add_job_posting(*args[:3], "NY", *args[4:]).inserted_id
+        assert moved == first
+        assert mock_embed.call_count == 1
+        assert db.get_job_version(first) == 2
+    assert dbc.client[TEST_DB]["jobs"].count_documents({"company": "DEDUP CO"}) == 1
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": first})
+
+
+def test_add_job_postings_dedup():
+    job = {"company": "DEDUP BULK", "job_type": "intern", "location": "SF",
+           "date": datetime.datetime(2023, 12, 12), "link": "https://dedup.example.com/2"}
+    with patch("db.db.generate_vectors",
+               side_effect=lambda texts: [db.DEFAULT_VECTOR] * len(texts)) as mock_embed:
+        first = db.add_job_postings([job, dict(job, link=job["link"] + "/")])
+        assert [result["status"] for result in first] == ["created", "error"]
+        again = db.add_job_postings([job, dict(job, date=datetime.datetime(2024, 1, 1))])
+        assert mock_embed.call_count == 1
+    assert again[0]["status"] == "unchanged"
+    assert again[1]["status"] == "error"
+    # indices from a request whose item 0 was dropped before reaching db.py
+    shifted = db.add_job_postings([job, job], indices=[1, 2])
+    assert [result["index"] for result in shifted] == [1, 2]
+    assert shifted[1]["message"] == "Same job as index 1"
+    changed = db.add_job_postings([dict(job, location="NY")])
+    assert changed[0] == {"index": 0, "status": "updated", "job_id": first[0]["job_id"]}
+    assert dbc.fetch_one("jobs", {"_id": ObjectId(first[0]["job_id"])})["location"] == "NY"
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": ObjectId(first[0]["job_id"])})
+
+
+def test_update_job_identity_collision():
+    first = db.add_job_posting("DEDUP A", "", "intern", "SF", datetime.datetime(2023, 12, 12),
+                               "https://dedup.example.com/3").inserted_id
+    second = db.add_job_posting("DEDUP B", "", "intern", "SF", datetime.datetime(2023, 12, 12),
+                                "https://dedup.example.com/3").inserted_id
+    with pytest.raises(KeyError):
+        db.update_job(second, {"company": "DEDUP A"})
+    assert dbc.fetch_one("jobs", {"_id": second})["company"] == "DEDUP B"
+    dbc.client[TEST_DB]["jobs"].delete_many({"_id": {"$in": [first, second]}})
+
+
 def test_add_job_fails():
     try:
         res = db.add_job_posting("HELLO WORLD", None, "test", "test", "test", "test", "test")
@@ -307,6 +543,15 @@ def test_get_job_by_id_works():
     assert job["location"] == "wash123123"
     dbc.client[TEST_DB]["jobs"].delete_one({"_id": identification})
 
+def test_get_job_by_id_hides_embedding():
+    identification = db.add_job_posting(
+        "HELLO WORLD", "test", "wash123123", "wash123123", datetime.datetime(2023, 12, 12), "test"
+    ).inserted_id
+    assert "embedding_vector" not in db.get_job_by_id(identification)
+    job = db.get_job_by_id(identification, include_embedding=True)
+    assert len(job["embedding_vector"]) == 1536
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": identification})
+
 def test_get_job_by_id_fails():
     try:
         db.get_job_by_id(invalid_id)
@@ -318,13 +563,12 @@ def test_generate_vector_fails_properly():
     test to see if generate vectors fails silently 
     There would be better tests for vector search, but its is only allowed to work on atlas cluster
     '''
-    test = "embed test" 
-    if os.environ.get("OPENAI_API_KEY") == "":
-        res = db.generate_vector(test)
-        assert res == db.DEFAULT_VECTOR
-    else: 
-        return True
-    
+    failing = MagicMock()
+    failing.embeddings.create.side_effect = Exception("API down")
+    with patch("db.db.embedder", embedders.OpenAIEmbedder(failing)):
+        res = db.generate_vector("embed test " + str(ObjectId()))
+    assert res == db.DEFAULT_VECTOR
+
 def test_search_jobs_by_vector_fails_properly():
     '''
     test to see if search jobs by vector fails silently 
@@ -27,3 +27,42 @@ def test_fetch_one(temp_rec):
 def test_fetch_one_not_there(temp_rec):
     ret = dbc.fetch_one(TEST_COLLECT, {TEST_NAME: "not a field value in db!"})
     assert ret is None
+
+
+def test_fetch_one_projection(temp_rec):
+    ret = dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME}, projection={TEST_NAME: 0})
+    assert ret is not None
+    assert TEST_NAME not in ret
+
+
+def test_fetch_all_projection(temp_rec):
+    ret = dbc.fetch_all(TEST_COLLECT, filt={TEST_NAME: TEST_NAME}, projection={dbc.MONGO_ID: 0})
+    assert ret == [{TEST_NAME: TEST_NAME}]
+
+
+def test_pool_options_from_env(monkeypatch):
+    monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "20")
+    monkeypatch.setenv("MONGO_MIN_POOL_SIZE", "2")
+    monkeypatch.setenv("MONGO_MAX_IDLE_TIME_MS", "60000")
+    monkeypatch.setenv("MONGO_COMPRESSORS", "zstd,snappy")
+    options = dbc.pool_options()
+    assert options["maxPoolSize"] == 20
+    assert options["minPoolSize"] == 2
+    assert options["maxIdleTimeMS"] == 60000
+    assert options["compressors"] == "zstd,snappy"
+
+
+def test_get_client_is_per_process(monkeypatch):
+    first = dbc.get_client()
+    assert dbc.get_client() is first
+    # pretend we are a worker forked after the client was created
+    monkeypatch.setattr(dbc, "_client_pid", -1)
+    assert dbc.get_client() is not first
+
+
+def test_pool_stats(temp_rec):
+    dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    stats = dbc.pool_stats()
+    assert stats["checkouts"] >= 1
+    assert stats["in_use"] == 0
+    assert stats["max_pool_size"] == dbc.pool_options()["maxPoolSize"]
@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+import db.embed_dispatcher as embed_dispatcher
+
+
+class SlowEmbed:
+    """
+    Records every batch and holds it until released.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        self.release.wait(5)
+        return [[float(len(text))] for text in texts]
+
+
+def test_identical_texts_share_one_request():
+    embed = SlowEmbed()
+    dispatcher = embed_dispatcher.Dispatcher(embed, max_wait=0.01)
+    pending = [dispatcher.submit("python intern") for _ in range(10)]
+    assert len({id(future) for future in pending}) == 1
+    embed.release.set()
+    assert [future.result(5) for future in pending] == [[13.0]] * 10
+    assert embed.batches == [["python intern"]]
+    assert dispatcher.stats()["coalesced"] == 9
+
+
+def test_concurrent_texts_are_batched():
+    embed = SlowEmbed()
+    embed.release.set()
+    dispatcher = embed_dispatcher.Dispatcher(embed, max_batch=10, max_wait=0.2)
+    pending = [dispatcher.submit(text) for text in ["a", "bb", "ccc"]]
+    assert [future.result(5) for future in pending] == [[1.0], [2.0], [3.0]]
+    assert embed.batches == [["a", "bb", "ccc"]]
+
+
+def test_batches_are_capped():
+    embed = SlowEmbed()
+    embed.release.set()
+    dispatcher = embed_dispatcher.Dispatcher(embed, max_batch=2, max_wait=0.2)
+    pending = [dispatcher.submit(str(i)) for i in range(5)]
+    for future in pending:
+        future.result(5)
+    assert sorted(len(batch) for batch in embed.batches) == [1, 2, 2]
+
+
+def test_errors_reach_every_waiter_and_are_not_kept():
+    calls = []
+
+    def flaky(texts):
+        calls.append(texts)
+        if len(calls) == 1:
+            raise ValueError("API down")
+        return [[1.0] for _ in texts]
+
+    dispatcher = embed_dispatcher.Dispatcher(flaky, max_wait=0.05)
+    pending = [dispatcher.submit("query") for _ in range(3)]
+    for future in pending:
+        with pytest.raises(ValueError):
+            future.result(5)
+    # a later call for the same text tries again
+    assert dispatcher.embed("query", timeout=5) == [1.0]
+    assert len(calls) == 2
+
+
+def test_embed_times_out():
+    embed = SlowEmbed()
+    dispatcher = embed_dispatcher.Dispatcher(embed, max_wait=0)
+    with pytest.raises(embed_dispatcher.futures.TimeoutError):
+        dispatcher.embed("slow", timeout=0.05)
+    embed.release.set()
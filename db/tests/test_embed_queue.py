@@ -0,0 +1,118 @@
+from bson import ObjectId
+import datetime
+import pytest
+import time
+from unittest.mock import patch
+
+import db.db_connect as dbc
+import db.embed_queue as embed_queue
+import db.vector_codec as vector_codec
+
+TEST_DB = dbc.DB_NAME
+PLACEHOLDER = [0.5] * 4
+
+
+def embed(texts):
+    return [[float(len(text))] * 4 for text in texts]
+
+
+def text_of(job):
+    return job["company"]
+
+
+@pytest.fixture(scope="function")
+def queued_jobs():
+    dbc.connect_db()
+    ids = [ObjectId() for _ in range(3)]
+    for i, job_id in enumerate(ids):
+        dbc.client[TEST_DB]["jobs"].insert_one(
+            {"_id": job_id, "company": "c" * (i + 1),
+             "date": datetime.datetime(2024, 1, 1), **embed_queue.pending()}
+        )
+    yield ids
+    dbc.client[TEST_DB]["jobs"].delete_many({"_id": {"$in": ids}})
+
+
+def job(job_id):
+    return dbc.client[TEST_DB]["jobs"].find_one({"_id": job_id})
+
+
+def test_worker_embeds_queued_jobs(queued_jobs):
+    pool = embed_queue.WorkerPool(embed, text_of, PLACEHOLDER, batch_size=10)
+    assert pool.run_once() == 3
+    for i, job_id in enumerate(queued_jobs):
+        doc = job(job_id)
+        assert vector_codec.decode(doc["embedding_vector"]) == [float(i + 1)] * 4
+        assert embed_queue.STATUS not in doc
+        assert embed_queue.CLAIM not in doc
+    assert pool.run_once() == 0
+
+
+def test_claims_are_exclusive(queued_jobs):
+    token, jobs = embed_queue.claim(batch_size=2)
+    assert len(jobs) == 2
+    other, rest = embed_queue.claim(batch_size=10)
+    assert other != token
+    assert {doc["_id"] for doc in rest} == {queued_jobs[2]}
+
+
+def test_expired_claims_are_reclaimed(queued_jobs):
+    token, jobs = embed_queue.claim(batch_size=10)
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=embed_queue.LEASE_SECONDS + 1)
+    dbc.client[TEST_DB]["jobs"].update_many(
+        {embed_queue.CLAIM: token}, {"$set": {embed_queue.CLAIMED_AT: expired}}
+    )
+    _, reclaimed = embed_queue.claim(batch_size=10)
+    assert len(reclaimed) == 3
+
+
+def test_requeued_job_discards_stale_vector(queued_jobs):
+    token, jobs = embed_queue.claim(batch_size=10)
+    dbc.update_doc("jobs", {"_id": queued_jobs[0]}, embed_queue.pending())
+    with patch("db.vector_index.add") as mock_add:
+        embed_queue.complete(token, jobs, embed([text_of(doc) for doc in jobs]))
+    # the superseded vector stays out of the search index too
+    assert {call.args[0] for call in mock_add.call_args_list} == set(queued_jobs[1:])
+    assert job(queued_jobs[0])[embed_queue.STATUS] == embed_queue.PENDING
+    assert "embedding_vector" not in job(queued_jobs[0])
+    assert "embedding_vector" in job(queued_jobs[1])
+
+
+def test_failures_are_released_then_given_up(queued_jobs):
+    def fail(texts):
+        raise RuntimeError("api down")
+
+    pool = embed_queue.WorkerPool(fail, text_of, PLACEHOLDER, batch_size=10)
+    for _ in range(embed_queue.MAX_ATTEMPTS - 1):
+        assert pool.run_once() == 3
+        assert job(queued_jobs[0])[embed_queue.STATUS] == embed_queue.PENDING
+        assert embed_queue.CLAIMED_AT not in job(queued_jobs[0])
+    pool.run_once()
+    assert job(queued_jobs[0])[embed_queue.STATUS] == embed_queue.FAILED
+    assert pool.run_once() == 0
+
+
+def test_sweep_requeues_placeholder_vectors(queued_jobs):
+    pool = embed_queue.WorkerPool(embed, text_of, PLACEHOLDER, batch_size=10)
+    pool.run_once()
+    dbc.update_doc("jobs", {"_id": queued_jobs[0]},
+                   {"embedding_vector": vector_codec.encode(PLACEHOLDER, vector_codec.ARRAY)})
+    dbc.update_doc("jobs", {"_id": queued_jobs[1]},
+                   {"embedding_vector": vector_codec.encode(PLACEHOLDER, vector_codec.BINARY)})
+    assert embed_queue.sweep(PLACEHOLDER) >= 2
+    assert job(queued_jobs[0])[embed_queue.STATUS] == embed_queue.PENDING
+    assert job(queued_jobs[1])[embed_queue.STATUS] == embed_queue.PENDING
+    assert embed_queue.STATUS not in job(queued_jobs[2])
+
+
+def test_pool_threads_drain_queue(queued_jobs):
+    pool = embed_queue.WorkerPool(embed, text_of, PLACEHOLDER, workers=2, batch_size=1,
+                                  poll_interval=0.01)
+    pool.start(sweep=False)
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=10)
+    while datetime.datetime.now() < deadline:
+        if all(embed_queue.STATUS not in job(job_id) for job_id in queued_jobs):
+            break
+        time.sleep(0.01)
+    pool.stop()
+    assert all("embedding_vector" in job(job_id) for job_id in queued_jobs)
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+import db.embedders as embedders
+
+JOBS = [
+    "Acme Software Engineer Intern python backend services",
+    "Globex Data Science Intern python machine learning",
+    "Initech Frontend Engineer Intern react javascript",
+    "Hooli Software Engineer Intern c++ systems",
+]
+
+
+def cosine(a, b):
+    return float(np.dot(a, b))
+
+
+def test_hashing_vectors_are_unit_length():
+    vectors = embedders.HashingEmbedder().embed(JOBS + [""])
+    assert len(vectors) == len(JOBS) + 1
+    for vector in vectors:
+        assert len(vector) == embedders.DIMENSIONS
+        assert np.linalg.norm(vector) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_hashing_is_deterministic():
+    first = embedders.HashingEmbedder().embed(JOBS)
+    second = embedders.HashingEmbedder().embed(JOBS)
+    assert first == second
+
+
+def test_hashing_ranks_related_text_higher():
+    embedder = embedders.HashingEmbedder()
+    query, related, unrelated = embedder.embed(
+        ["python backend intern", JOBS[0], JOBS[2]])
+    assert cosine(query, related) > cosine(query, unrelated)
+
+
+def test_embed_one_matches_embed():
+    embedder = embedders.HashingEmbedder()
+    assert embedder.embed_one(JOBS[0]) == embedder.embed(JOBS[:1])[0]
+
+
+def test_tokens_keep_language_names():
+    assert embedders.TOKEN.findall("c++ and c# with node.js") == [
+        "c++", "and", "c#", "with", "node.js"]
+
+
+def test_fit_downweights_common_words():
+    plain = embedders.HashingEmbedder()
+    fitted = plain.fit(JOBS)
+    assert fitted.name != plain.name
+    query = "intern python"
+    # "intern" is in every job, so it counts for less once fitted
+    assert (cosine(*fitted.embed([query, JOBS[2]]))
+            < cosine(*plain.embed([query, JOBS[2]])))
+    assert (cosine(*fitted.embed([query, JOBS[1]]))
+            > cosine(*fitted.embed([query, JOBS[2]])))
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "embedder.npz")
+    fitted = embedders.HashingEmbedder().fit(JOBS)
+    fitted.save(path)
+    loaded = embedders.HashingEmbedder.load(path)
+    assert loaded.name == fitted.name
+    assert loaded.embed(JOBS) == fitted.embed(JOBS)
+
+
+def test_openai_embedder_keeps_input_order():
+    client = MagicMock()
+    client.embeddings.create.return_value = SimpleNamespace(data=[
+        SimpleNamespace(index=1, embedding=[2.0]),
+        SimpleNamespace(index=0, embedding=[1.0]),
+    ])
+    embedder = embedders.OpenAIEmbedder(client)
+    assert embedder.embed(["a", "b"]) == [[1.0], [2.0]]
+    client.embeddings.create.assert_called_once_with(
+        input=["a", "b"], model=embedders.OPENAI_MODEL)
+
+
+def test_from_env_selects_backend():
+    assert isinstance(embedders.from_env(embedders.LOCAL), embedders.HashingEmbedder)
+    with pytest.raises(ValueError):
+        embedders.from_env("word2vec")
+
+
+def test_implicit_local_fallback_warns(monkeypatch, capsys):
+    monkeypatch.delenv("EMBEDDER", raising=False)
+    monkeypatch.setattr(embedders, "EMBEDDER", embedders.LOCAL)
+    embedders.from_env()
+    assert "WARNING" in capsys.readouterr().out
+    monkeypatch.setenv("EMBEDDER", embedders.LOCAL)
+    embedders.from_env()
+    assert "WARNING" not in capsys.readouterr().out
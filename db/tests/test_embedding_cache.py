@@ -0,0 +1,66 @@
+import time
+
+import db.embedding_cache as ec
+
+MODEL = "test-model"
+VECTOR = [0.5] * 4
+
+
+def test_cache_key_normalizes_text():
+    assert ec.cache_key(MODEL, "Machine  Learning ") == ec.cache_key(MODEL, "machine learning")
+
+
+def test_cache_key_depends_on_model():
+    assert ec.cache_key(MODEL, "intern") != ec.cache_key("other-model", "intern")
+
+
+def test_get_miss_then_hit():
+    cache = ec.EmbeddingCache(persist=False)
+    assert cache.get(MODEL, "intern") is None
+    cache.put(MODEL, "intern", VECTOR)
+    assert cache.get(MODEL, "Intern") == VECTOR
+    stats = cache.stats()
+    assert stats[ec.HITS] == 1
+    assert stats[ec.MISSES] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_lru_eviction():
+    cache = ec.EmbeddingCache(max_entries=2, persist=False)
+    cache.put(MODEL, "a", VECTOR)
+    cache.put(MODEL, "b", VECTOR)
+    cache.get(MODEL, "a")
+    cache.put(MODEL, "c", VECTOR)
+    assert cache.get(MODEL, "b") is None
+    assert cache.get(MODEL, "a") == VECTOR
+    assert cache.stats()[ec.EVICTIONS] == 1
+
+
+def test_ttl_expiry():
+    cache = ec.EmbeddingCache(ttl=0.01, persist=False)
+    cache.put(MODEL, "a", VECTOR)
+    time.sleep(0.02)
+    assert cache.get(MODEL, "a") is None
+
+
+def test_clear():
+    cache = ec.EmbeddingCache(persist=False)
+    cache.put(MODEL, "a", VECTOR)
+    cache.clear()
+    assert cache.stats()["size"] == 0
+    assert cache.get(MODEL, "a") is None
+
+
+def test_persistent_tier_uses_vector_storage(monkeypatch):
+    stored = {}
+    monkeypatch.setattr(ec.vector_codec, "STORAGE", ec.vector_codec.BINARY)
+    monkeypatch.setattr(ec.dbc, "update_doc",
+                        lambda collection, filt, doc, upsert: stored.update(doc))
+    monkeypatch.setattr(ec.dbc, "fetch_one", lambda collection, filt: stored or None)
+    ec.EmbeddingCache().put(MODEL, "intern", VECTOR)
+    assert isinstance(stored["vector"], bytes)
+    assert ec.STORED_AT in stored
+    # a fresh cache has an empty memory tier, so this is read back from Mongo
+    cache = ec.EmbeddingCache()
+    assert cache.get(MODEL, "intern") == VECTOR
+    assert cache.stats()[ec.PERSISTENT_HITS] == 1
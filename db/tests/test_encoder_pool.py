@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import db.embedders as embedders
+import db.encoder_pool as encoder_pool
+
+TEXTS = [f"job {i} software engineer intern python {i % 7}" for i in range(50)]
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = encoder_pool.EncoderPool(embedders.HashingEmbedder(), processes=2,
+                                    chunk_size=8, inline_max=4)
+    yield pool
+    pool.close()
+
+
+def test_pool_matches_inline_encoding(pool):
+    vectors = pool.encode(TEXTS)
+    assert vectors.dtype == np.float32
+    assert vectors.shape == (len(TEXTS), embedders.DIMENSIONS)
+    np.testing.assert_array_equal(vectors, pool.embedder.encode(TEXTS))
+
+
+def test_small_batches_stay_in_process(pool):
+    pool.close()
+    assert pool.embed(TEXTS[:4]) == pool.embedder.embed(TEXTS[:4])
+    assert pool._executor is None
+    assert pool.embed_one(TEXTS[0]) == pool.embedder.embed(TEXTS[:1])[0]
+
+
+def test_pool_keeps_embedder_identity(pool):
+    assert pool.name == pool.embedder.name
+    assert pool.dimensions == pool.embedder.dimensions
+    assert pool.cacheable is False
+
+
+def test_pooled_wraps_only_with_processes():
+    embedder = embedders.HashingEmbedder()
+    assert embedders.pooled(embedder, 0) is embedder
+    wrapped = embedders.pooled(embedder, 1)
+    assert isinstance(wrapped, encoder_pool.EncoderPool)
+    wrapped.close()
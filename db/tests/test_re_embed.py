@@ -0,0 +1,115 @@
+from unittest.mock import Mock
+
+from bson import ObjectId
+import datetime
+import openai
+import pytest
+
+import db.db_connect as dbc
+import db.re_embed as re_embed
+
+TEST_DB = dbc.DB_NAME
+TEST_CHECKPOINT = "test_re_embed"
+
+
+def rate_limit_error(retry_after=None):
+    headers = {} if retry_after is None else {"retry-after": retry_after}
+    return openai.RateLimitError(
+        "slow down", response=Mock(status_code=429, headers=headers), body=None
+    )
+
+
+@pytest.fixture(scope="function")
+def temp_jobs():
+    dbc.connect_db()
+    ids = [ObjectId() for _ in range(5)]
+    for i, job_id in enumerate(ids):
+        dbc.client[TEST_DB]["jobs"].insert_one(
+            {
+                "_id": job_id,
+                "company": f"company{i}",
+                "date": datetime.datetime(2024, 1, 1),
+                "embedding_vector": [0.0],
+            }
+        )
+    yield ids
+    for job_id in ids:
+        dbc.client[TEST_DB]["jobs"].delete_one({"_id": job_id})
+    re_embed.clear_checkpoint(TEST_CHECKPOINT)
+
+
+def test_retry_delay_uses_retry_after():
+    assert re_embed.retry_delay(rate_limit_error("3"), 1) == 3.0
+
+
+def test_retry_delay_exponential():
+    delay = re_embed.retry_delay(rate_limit_error(), 3)
+    assert 8 <= delay < 9
+
+
+def test_backoff_retries_rate_limits():
+    calls = []
+
+    def flaky(texts):
+        calls.append(texts)
+        if len(calls) < 3:
+            raise rate_limit_error("0")
+        return texts
+
+    backoff = re_embed.Backoff(sleep=lambda _: None)
+    assert backoff.call(flaky, ["a"]) == ["a"]
+    assert len(calls) == 3
+
+
+def test_backoff_gives_up():
+    def always_limited(texts):
+        raise rate_limit_error("0")
+
+    backoff = re_embed.Backoff(max_attempts=2, sleep=lambda _: None)
+    with pytest.raises(openai.RateLimitError):
+        backoff.call(always_limited, ["a"])
+
+
+def test_run_embeds_in_batches(temp_jobs):
+    requests = []
+
+    def embed_batch(texts):
+        requests.append(len(texts))
+        return [[1.0] for _ in texts]
+
+    filt = {"_id": {"$in": temp_jobs}}
+    written = re_embed.run(embed_batch, lambda job: job["company"], filt=filt,
+                           batch_size=2, concurrency=2, name=TEST_CHECKPOINT)
+    assert written == 5
+    assert sorted(requests) == [1, 2, 2]
+    for job in dbc.fetch_all("jobs", filt=filt):
+        assert job["embedding_vector"] == [1.0]
+    assert re_embed.load_checkpoint(TEST_CHECKPOINT) is None
+
+
+def test_run_resumes_from_checkpoint(temp_jobs):
+    re_embed.save_checkpoint(temp_jobs[2], TEST_CHECKPOINT)
+    filt = {"_id": {"$in": temp_jobs}}
+    written = re_embed.run(lambda texts: [[1.0] for _ in texts], lambda job: job["company"],
+                           filt=filt, batch_size=2, name=TEST_CHECKPOINT)
+    assert written == 2
+    assert dbc.fetch_one("jobs", {"_id": temp_jobs[0]})["embedding_vector"] == [0.0]
+
+
+def test_run_skips_jobs_not_needing_it(temp_jobs):
+    filt = {"_id": {"$in": temp_jobs}}
+    embedded = []
+
+    def embed_batch(texts):
+        embedded.extend(texts)
+        return [[1.0] for _ in texts]
+
+    written = re_embed.run(embed_batch, lambda job: job["company"], filt=filt,
+                           batch_size=2, name=TEST_CHECKPOINT,
+                           needs=lambda job, text: text != "company1",
+                           fields_of=lambda text, vector: {"embedding_vector": vector,
+                                                           "embedded_text": text})
+    assert written == 4
+    assert "company1" not in embedded
+    assert dbc.fetch_one("jobs", {"_id": temp_jobs[1]})["embedding_vector"] == [0.0]
+    assert dbc.fetch_one("jobs", {"_id": temp_jobs[0]})["embedded_text"] == "company0"
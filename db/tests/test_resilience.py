@@ -0,0 +1,115 @@
+from unittest.mock import Mock
+
+import openai
+import pytest
+
+import db.re_embed as re_embed
+import db.resilience as resilience
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fail():
+    raise ValueError("API down")
+
+
+@pytest.fixture(scope="function")
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture(scope="function")
+def breaker(clock):
+    return resilience.CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+
+
+def test_breaker_opens_after_repeated_failures(breaker):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(fail)
+    assert breaker.state() == resilience.OPEN
+    never = Mock()
+    with pytest.raises(resilience.CircuitOpenError):
+        breaker.call(never)
+    never.assert_not_called()
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_success_resets_failure_count(breaker):
+    with pytest.raises(ValueError):
+        breaker.call(fail)
+    assert breaker.call(lambda: 1) == 1
+    with pytest.raises(ValueError):
+        breaker.call(fail)
+    assert breaker.state() == resilience.CLOSED
+
+
+def test_half_open_trial_closes_on_success(breaker, clock):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(fail)
+    clock.now = 10
+    assert breaker.state() == resilience.HALF_OPEN
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state() == resilience.CLOSED
+
+
+def test_half_open_trial_reopens_on_failure(breaker, clock):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(fail)
+    clock.now = 10
+    with pytest.raises(ValueError):
+        breaker.call(fail)
+    assert breaker.state() == resilience.OPEN
+
+
+def test_half_open_lets_one_trial_through(breaker, clock):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(fail)
+    clock.now = 10
+
+    def trial():
+        # a second caller arriving during the trial is rejected
+        with pytest.raises(resilience.CircuitOpenError):
+            breaker.call(lambda: None)
+        return "ok"
+
+    assert breaker.call(trial) == "ok"
+
+
+def test_deadline_runs_out(clock):
+    deadline = resilience.Deadline(5, clock=clock)
+    assert deadline.remaining() == 5
+    assert deadline.allows(4)
+    assert not deadline.allows(5)
+    clock.now = 5
+    with pytest.raises(resilience.DeadlineExceeded):
+        deadline.remaining()
+
+
+def test_backoff_gives_up_at_the_deadline(clock):
+    limited = openai.RateLimitError(
+        "slow down", response=Mock(status_code=429, headers={"retry-after": "30"}), body=None
+    )
+    calls = []
+
+    def always_limited():
+        calls.append(1)
+        raise limited
+
+    backoff = re_embed.Backoff(sleep=lambda _: None)
+    with pytest.raises(openai.RateLimitError):
+        backoff.call(always_limited, deadline=resilience.Deadline(10, clock=clock))
+    assert len(calls) == 1
+    # the pause is shared, so the next caller doesn't even try
+    with pytest.raises(resilience.DeadlineExceeded):
+        backoff.call(always_limited, deadline=resilience.Deadline(10))
+    assert len(calls) == 1
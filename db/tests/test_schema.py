@@ -0,0 +1,47 @@
+from unittest.mock import patch
+
+import db.db_connect as dbc
+import db.embedding_cache as ec
+import db.schema as schema
+
+
+def test_ensure_indexes():
+    schema.ensure_indexes(force=True)
+    users = dbc.index_information("users")
+    unique = [index["key"] for index in users.values() if index.get("unique")]
+    assert [("username", 1)] in unique
+    assert [("email", 1)] in unique
+    job_keys = [index["key"] for index in dbc.index_information("jobs").values()]
+    assert [("date", -1), ("_id", -1)] in job_keys
+    report_keys = [index["key"] for index in dbc.index_information("user_reports").values()]
+    assert [("job_id", 1)] in report_keys
+    assert [("user_id", 1)] in report_keys
+
+
+def test_set_job_ttl():
+    schema.set_job_ttl(30)
+    info = dbc.index_information("jobs")
+    assert info[schema.JOB_TTL_INDEX]["expireAfterSeconds"] == 30 * 24 * 60 * 60
+    schema.set_job_ttl(7)
+    info = dbc.index_information("jobs")
+    assert info[schema.JOB_TTL_INDEX]["expireAfterSeconds"] == 7 * 24 * 60 * 60
+    schema.set_job_ttl(None)
+    assert schema.JOB_TTL_INDEX not in dbc.index_information("jobs")
+
+
+def test_embedding_cache_expires():
+    schema.ensure_indexes(force=True)
+    info = dbc.index_information(ec.CACHE_COLLECTION)
+    assert info[ec.PERSIST_TTL_INDEX]["expireAfterSeconds"] == int(
+        ec.PERSIST_DAYS * 24 * 60 * 60)
+
+
+def test_users_are_unique_only_with_the_indexes():
+    schema.ensure_indexes(force=True)
+    assert schema.users_are_unique()
+    # e.g. legacy duplicate usernames kept the unique index from being built
+    with patch("db.schema._create_indexes"), \
+            patch("db.db_connect.index_information", return_value={}):
+        schema.ensure_indexes(force=True)
+        assert not schema.users_are_unique()
+    schema.ensure_indexes(force=True)
@@ -0,0 +1,50 @@
+from bson import BSON
+from bson.binary import Binary
+import numpy as np
+import pytest
+
+import db.vector_codec as vc
+
+VECTOR = [0.25, -1.5, 3.0, 0.0]
+
+
+def test_binary_round_trip():
+    stored = vc.encode(VECTOR, vc.BINARY)
+    assert isinstance(stored, Binary)
+    assert stored.subtype == vc.VECTOR_SUBTYPE
+    assert len(stored) == len(vc.FLOAT32_HEADER) + 4 * len(VECTOR)
+    assert vc.decode(stored) == VECTOR
+
+
+def test_binary_survives_bson():
+    doc = BSON.decode(BSON.encode({"embedding_vector": vc.encode(VECTOR, vc.BINARY)}))
+    assert vc.to_array(doc["embedding_vector"]).tolist() == VECTOR
+
+
+def test_raw_bytes_are_read():
+    raw = np.asarray(VECTOR, dtype="<f4").tobytes()
+    assert vc.decode(raw) == VECTOR
+
+
+def test_array_storage_passes_through():
+    assert vc.encode(np.asarray(VECTOR), vc.ARRAY) == VECTOR
+    assert vc.decode(VECTOR) == VECTOR
+    assert vc.to_array(VECTOR).dtype == np.float32
+
+
+def test_binary_is_smaller_than_array():
+    vector = [0.1] * 1536
+    binary_size = len(BSON.encode({"v": vc.encode(vector, vc.BINARY)}))
+    array_size = len(BSON.encode({"v": vc.encode(vector, vc.ARRAY)}))
+    assert binary_size * 3 < array_size
+
+
+def test_unknown_storage():
+    with pytest.raises(ValueError):
+        vc.encode(VECTOR, "yaml")
+
+
+def test_is_encoded():
+    assert vc.is_encoded(vc.encode(VECTOR, vc.BINARY), vc.BINARY)
+    assert not vc.is_encoded(VECTOR, vc.BINARY)
+    assert vc.is_encoded(VECTOR, vc.ARRAY)
@@ -0,0 +1,260 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+
+import db.vector_index as vi
+
+DIM = 8
+
+
+def one_hot(i, dim=DIM):
+    vector = [0.0] * dim
+    vector[i] = 1.0
+    return vector
+
+
+@pytest.fixture(scope="function")
+def index():
+    index = vi.ExactIndex(dim=DIM, capacity=2)
+    for i in range(DIM):
+        index.add(f"job{i}", one_hot(i))
+    return index
+
+
+def test_search_finds_exact_match(index):
+    res = index.search(one_hot(3), 1)
+    assert res[0][0] == "job3"
+    assert res[0][1] == pytest.approx(1.0)
+
+
+def test_search_orders_by_similarity(index):
+    query = np.array(one_hot(1)) * 2 + np.array(one_hot(5))
+    res = index.search(query, 3)
+    assert [job_id for job_id, _ in res[:2]] == ["job1", "job5"]
+    assert res[0][1] > res[1][1] > res[2][1]
+
+
+def test_search_limit_larger_than_index(index):
+    assert len(index.search(one_hot(0), 100)) == DIM
+
+
+def test_update_replaces_vector(index):
+    index.add("job0", one_hot(7))
+    assert len(index) == DIM
+    assert {job_id for job_id, _ in index.search(one_hot(7), 2)} == {"job0", "job7"}
+
+
+def test_remove_keeps_rows_packed(index):
+    index.remove("job2")
+    index.remove("not there")
+    assert len(index) == DIM - 1
+    assert "job2" not in index
+    assert index.search(one_hot(7), 1)[0][0] == "job7"
+    assert "job2" not in [job_id for job_id, _ in index.search(one_hot(2), DIM)]
+
+
+def test_empty_index():
+    assert vi.ExactIndex(dim=DIM).search(one_hot(0), 5) == []
+
+
+def test_wrong_dimension_rejected(index):
+    with pytest.raises(ValueError):
+        index.add("bad", [1.0, 2.0])
+
+
+@pytest.fixture(scope="function")
+def clustered():
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(4, DIM))
+    vectors = np.concatenate([center + rng.normal(scale=0.05, size=(25, DIM))
+                              for center in centers])
+    ids = [f"job{i}" for i in range(len(vectors))]
+    return ids, vectors
+
+
+def test_add_many_matches_add(clustered):
+    ids, vectors = clustered
+    bulk = vi.ExactIndex(dim=DIM)
+    bulk.add_many(ids, vectors)
+    single = vi.ExactIndex(dim=DIM)
+    for job_id, vector in zip(ids, vectors):
+        single.add(job_id, vector)
+    assert bulk.search(vectors[7], 5) == single.search(vectors[7], 5)
+
+
+def test_ivf_full_probe_matches_exact(clustered):
+    ids, vectors = clustered
+    exact = vi.ExactIndex(dim=DIM)
+    exact.add_many(ids, vectors)
+    ivf = vi.IVFIndex(dim=DIM)
+    ivf.train(ids, vectors, nlist=4)
+    assert ivf.nlist == 4
+    for query in vectors[::10]:
+        expected = [job_id for job_id, _ in exact.search(query, 5)]
+        assert [job_id for job_id, _ in ivf.search(query, 5, nprobe=4)] == expected
+
+
+def test_ivf_single_probe_finds_neighbour(clustered):
+    ids, vectors = clustered
+    ivf = vi.IVFIndex(dim=DIM, nprobe=1)
+    ivf.train(ids, vectors, nlist=4)
+    assert ivf.search(vectors[30], 1)[0][0] == "job30"
+
+
+def test_ivf_incremental_insert_and_delete(clustered):
+    ids, vectors = clustered
+    ivf = vi.IVFIndex(dim=DIM, nprobe=1)
+    ivf.train(ids, vectors, nlist=4)
+    ivf.add("new", vectors[60] * 1.01)
+    assert "new" in ivf
+    assert {job_id for job_id, _ in ivf.search(vectors[60], 2)} == {"new", "job60"}
+    ivf.remove("job60")
+    ivf.remove("new")
+    assert len(ivf) == len(ids) - 1
+    assert "job60" not in [job_id for job_id, _ in ivf.search(vectors[60], 10)]
+
+
+def test_ivf_untrained_is_exact():
+    ivf = vi.IVFIndex(dim=DIM)
+    ivf.add("job1", one_hot(1))
+    ivf.add("job2", one_hot(2))
+    assert ivf.search(one_hot(2), 1)[0][0] == "job2"
+
+
+def test_ivf_save_and_load(clustered, tmp_path):
+    ids, vectors = clustered
+    ivf = vi.IVFIndex(dim=DIM, nprobe=2)
+    ivf.train(ids, vectors, nlist=4)
+    path = str(tmp_path / "index.npz")
+    ivf.save(path)
+    loaded = vi.IVFIndex.load(path)
+    assert loaded.nlist == 4
+    assert loaded.nprobe == 2
+    assert len(loaded) == len(ids)
+    for query in vectors[::20]:
+        expected = ivf.search(query, 3)
+        res = loaded.search(query, 3)
+        assert [job_id for job_id, _ in res] == [job_id for job_id, _ in expected]
+        assert [score for _, score in res] == pytest.approx([score for _, score in expected])
+
+
+def test_ivf_untrained_save_is_trained_once_large_enough(clustered, tmp_path):
+    ids, vectors = clustered
+    path = str(tmp_path / "index.npz")
+    vi.IVFIndex(dim=DIM).save(path)
+    loaded = vi.IVFIndex.load(path, nprobe=3)
+    assert loaded.nprobe == 3
+    loaded.add_many(ids, vectors)
+    assert loaded.nlist == 1
+    assert not loaded.needs_training(min_size=len(ids) + 1)
+    assert loaded.needs_training(min_size=len(ids))
+    loaded.retrain(nlist=4)
+    assert loaded.nlist == 4
+    assert loaded.trained_size == len(ids)
+    assert loaded.search(vectors[30], 1)[0][0] == "job30"
+
+
+def test_ivf_retrains_after_growth(clustered, tmp_path):
+    ids, vectors = clustered
+    ivf = vi.IVFIndex(dim=DIM)
+    ivf.train(ids[:25], vectors[:25], nlist=2)
+    assert not ivf.needs_training(growth=2)
+    ivf.add_many(ids[25:], vectors[25:])
+    assert ivf.needs_training(growth=2)
+    path = str(tmp_path / "index.npz")
+    ivf.save(path)
+    assert vi.IVFIndex.load(path).trained_size == 25
+    assert vi.retrain_if_needed(ivf)
+    assert ivf.trained_size == len(ids)
+    assert not ivf.needs_training(growth=2)
+
+
+def test_refresh_runs_in_background_and_keeps_writes(monkeypatch):
+    built, release = [], threading.Event()
+
+    def load_index(model=None):
+        if built:
+            # a rebuild that started before job9 was added
+            release.wait(5)
+        index = vi.ExactIndex(dim=DIM)
+        index.add(f"job{len(built)}", one_hot(len(built)))
+        built.append(index)
+        return index
+
+    monkeypatch.setattr(vi, "load_index", load_index)
+    monkeypatch.setattr(vi, "BACKEND", vi.EXACT)
+    monkeypatch.setattr(vi, "REFRESH_SECONDS", 0)
+    vi.reset()
+    first = vi.get_index()
+    assert vi.get_index() is first
+    vi.invalidate()
+    # searches keep the current index while the rebuild is blocked
+    assert vi.get_index() is first
+    vi.add("job9", one_hot(7))
+    release.set()
+    for _ in range(100):
+        if vi.get_index() is not first:
+            break
+        time.sleep(0.05)
+    fresh = vi.get_index()
+    assert fresh is built[1]
+    assert "job1" in fresh and "job9" in fresh
+    vi.reset()
+
+
+class FakeJobs:
+    """
+    Stands in for the jobs collection read by the index loaders.
+    """
+
+    def __init__(self, monkeypatch):
+        self.jobs = {}
+        monkeypatch.setattr(vi, "DIMENSIONS", DIM)
+        monkeypatch.setattr(vi.dbc, "fetch_batches", self.fetch_batches)
+
+    def put(self, job_id, vector, text_hash, model="m"):
+        self.jobs[job_id] = {"_id": job_id, "embedding_vector": list(vector),
+                             vi.HASH_FIELD: text_hash, vi.MODEL_FIELD: model}
+
+    def fetch_batches(self, collection, batch_size, filt=None, projection=None):
+        wanted = (filt or {}).get("_id", {}).get("$in")
+        yield [job for job_id, job in self.jobs.items() if wanted is None or job_id in wanted]
+
+
+def test_sync_picks_up_rewritten_vectors(monkeypatch):
+    jobs = FakeJobs(monkeypatch)
+    for i in range(4):
+        jobs.put(f"job{i}", one_hot(i), f"h{i}")
+    index = vi.IVFIndex(dim=DIM)
+    vi.sync_index(index)
+    assert index.search(one_hot(2), 1)[0][0] == "job2"
+    # another process re-embeds job2
+    jobs.put("job2", one_hot(6), "h2b")
+    vi.sync_index(index)
+    job_id, score = index.search(one_hot(6), 1)[0]
+    assert job_id == "job2" and score == pytest.approx(1.0)
+    assert index.stamp("job2") == "m:h2b"
+
+
+def test_saved_index_keeps_stamps_and_model(monkeypatch, tmp_path):
+    jobs = FakeJobs(monkeypatch)
+    ids = [ObjectId() for _ in range(4)]
+    for i, job_id in enumerate(ids):
+        jobs.put(job_id, one_hot(i), f"h{i}")
+    path = str(tmp_path / "index.npz")
+    monkeypatch.setattr(vi, "BACKEND", vi.IVF)
+    monkeypatch.setattr(vi, "INDEX_PATH", path)
+    built = vi.load_index(model="m")
+    assert built.model == "m"
+    loaded = vi.IVFIndex.load(path, id_type=ObjectId)
+    assert loaded.model == "m" and loaded.stamp(ids[1]) == "m:h1"
+    # the embedder changed: the saved vectors are of the old model
+    for i, job_id in enumerate(ids):
+        jobs.put(job_id, one_hot(i + 4), f"h{i}", model="n")
+    rebuilt = vi.load_index(model="n")
+    assert rebuilt.model == "n"
+    assert rebuilt.search(one_hot(5), 1)[0][0] == ids[1]
+    assert vi.IVFIndex.load(path).model == "n"
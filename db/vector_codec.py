@@ -0,0 +1,112 @@
+"""
+This file converts job embedding vectors between the stored form and
+Python lists / NumPy arrays.
+With EMBEDDING_STORAGE=binary vectors are packed as little-endian
+float32 in a BSON Binary of subtype 9 (the BSON vector format Atlas
+vector search understands), about 4x smaller than an array of doubles.
+Either form is read transparently, so a collection can be migrated
+while it is in use:
+
+    python -m db.vector_codec migrate binary
+"""
+
+import os
+import sys
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import UpdateOne
+
+import db.db_connect as dbc
+
+ARRAY = "array"
+BINARY = "binary"
+
+STORAGE = os.environ.get("EMBEDDING_STORAGE", ARRAY)
+
+VECTOR_SUBTYPE = 9
+FLOAT32_DTYPE = 0x27
+FLOAT32_HEADER = bytes([FLOAT32_DTYPE, 0])
+LITTLE_ENDIAN_FLOAT32 = np.dtype("<f4")
+MIGRATE_BATCH_SIZE = 500
+
+
+def encode(vector, storage=None):
+    '''
+    vector: list or array of floats
+    Returns the value to store in embedding_vector for the given storage.
+    '''
+    storage = storage or STORAGE
+    if storage == BINARY:
+        packed = np.asarray(vector, dtype=LITTLE_ENDIAN_FLOAT32).tobytes()
+        return Binary(FLOAT32_HEADER + packed, VECTOR_SUBTYPE)
+    if storage == ARRAY:
+        return [float(x) for x in vector]
+    raise ValueError(f"Unknown embedding storage {storage}")
+
+
+def to_array(value):
+    '''
+    value: a stored embedding_vector in either format
+    Returns a float32 NumPy array.
+    '''
+    if isinstance(value, bytes):
+        data = bytes(value)
+        if getattr(value, "subtype", None) == VECTOR_SUBTYPE:
+            if data[:1] != FLOAT32_HEADER[:1]:
+                raise ValueError("Only float32 BSON vectors are supported")
+            data = data[len(FLOAT32_HEADER):]
+        return np.frombuffer(data, dtype=LITTLE_ENDIAN_FLOAT32).astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def decode(value):
+    '''
+    value: a stored embedding_vector in either format
+    Returns the vector as a list of floats, e.g. for JSON responses.
+    '''
+    if isinstance(value, bytes):
+        return to_array(value).tolist()
+    return value
+
+
+def is_encoded(value, storage):
+    if storage == BINARY:
+        return isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE
+    return isinstance(value, list)
+
+
+def migrate(storage=None, batch_size=MIGRATE_BATCH_SIZE):
+    '''
+    Rewrites every job whose embedding_vector is not in the given
+    storage format, in _id-ordered batches. Returns the number converted.
+    '''
+    storage = storage or STORAGE
+    converted = 0
+    batches = dbc.fetch_batches(
+        "jobs", batch_size, filt={"embedding_vector": {"$exists": True}},
+        projection={"embedding_vector": 1},
+    )
+    for batch in batches:
+        operations = [
+            UpdateOne(
+                {dbc.MONGO_ID: job[dbc.MONGO_ID]},
+                {"$set": {"embedding_vector": encode(to_array(job["embedding_vector"]),
+                                                     storage)}},
+            )
+            for job in batch
+            if not is_encoded(job["embedding_vector"], storage)
+        ]
+        if operations:
+            dbc.bulk_write("jobs", operations)
+            converted += len(operations)
+            print(f"Converted {converted} embedding vectors to {storage}")
+    return converted
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python -m db.vector_codec migrate [array|binary]")
+        sys.exit(1)
+    dbc.connect_db()
+    migrate(sys.argv[2] if len(sys.argv) > 2 else None)
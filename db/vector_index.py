@@ -0,0 +1,639 @@
+"""
+This file provides the in-process vector search backends used when
+Atlas `$vectorSearch` is not available (e.g. CLOUD_MONGO=0).
+ExactIndex keeps every job's embedding in one contiguous float32 matrix
+of unit rows, so a top-k cosine query is a single matrix-vector product
+followed by argpartition.
+IVFIndex is an approximate IVF-flat index for large corpora: k-means
+centroids split the jobs into inverted lists and a query only scans the
+nprobe lists closest to it.
+db.py keeps the index in step with the jobs collection through
+add() and remove(). Every row carries a stamp, the model and text hash
+its vector was computed from, so a refresh can tell which vectors other
+processes have rewritten. An index also records the model it was built
+for, and a saved index of another model is not loaded.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+from bson.objectid import ObjectId
+
+import db.db_connect as dbc
+import db.vector_codec as vector_codec
+
+ATLAS = "atlas"
+EXACT = "exact"
+IVF = "ivf"
+
+BACKEND = os.environ.get(
+    "VECTOR_SEARCH_BACKEND",
+    ATLAS if os.environ.get("CLOUD_MONGO", dbc.LOCAL) == dbc.CLOUD else EXACT,
+)
+# rebuild from Mongo after this many seconds so writes made by other
+# processes are picked up; 0 disables the refresh.
+REFRESH_SECONDS = float(os.environ.get("VECTOR_INDEX_REFRESH", 300))
+LOAD_BATCH_SIZE = 1000
+DIMENSIONS = 1536
+# IVF tuning: 0 lists means sqrt(number of jobs); more probes trade
+# latency for recall.
+IVF_NLIST = int(os.environ.get("IVF_NLIST", 0))
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 8))
+# an untrained IVF index is trained once it holds IVF_TRAIN_MIN vectors,
+# and retrained once it has grown IVF_RETRAIN_GROWTH times since; 0 disables
+IVF_TRAIN_MIN = int(os.environ.get("IVF_TRAIN_MIN", 256))
+IVF_RETRAIN_GROWTH = float(os.environ.get("IVF_RETRAIN_GROWTH", 2))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+# where the IVF index is saved so workers don't rebuild it at boot
+INDEX_PATH = os.environ.get("VECTOR_INDEX_PATH", "")
+# the fields db.py stores with every vector; together they identify it
+HASH_FIELD = "embedding_hash"
+MODEL_FIELD = "embedding_model"
+STAMP_PROJECTION = {HASH_FIELD: 1, MODEL_FIELD: 1}
+
+
+def stamp(job):
+    '''
+    job: a job document or its embedding fields
+    Returns the model and text hash of the job's vector, or None for a
+    job without them (DEFAULT_VECTOR, jobs embedded before they existed).
+    '''
+    if not job.get(HASH_FIELD):
+        return None
+    return f"{job.get(MODEL_FIELD)}:{job[HASH_FIELD]}"
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+class ExactIndex:
+    """
+    Brute-force cosine index over a contiguous float32 matrix.
+    Deletes swap the last row into the hole so the live rows stay packed.
+    """
+
+    def __init__(self, dim=DIMENSIONS, capacity=1024):
+        self.dim = dim
+        self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self._ids = []
+        self._rows = {}
+        self._stamps = {}
+        # the model the index was built for, None if unknown
+        self.model = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, job_id):
+        return job_id in self._rows
+
+    def stamp(self, job_id):
+        return self._stamps.get(job_id)
+
+    def add(self, job_id, vector, stamp=None):
+        '''
+        Inserts or replaces the vector stored for job_id.
+        '''
+        vector = _unit(vector)
+        if vector.shape != (self.dim,):
+            raise ValueError(f"Expected a vector of {self.dim} dimensions")
+        with self._lock:
+            row = self._rows.get(job_id)
+            if row is None:
+                row = len(self._ids)
+                self._grow(row + 1)
+                self._ids.append(job_id)
+                self._rows[job_id] = row
+            self._matrix[row] = vector
+            self._stamps[job_id] = stamp
+
+    def remove(self, job_id):
+        '''
+        Removes job_id from the index; unknown ids are ignored.
+        '''
+        with self._lock:
+            row = self._rows.pop(job_id, None)
+            if row is None:
+                return
+            self._stamps.pop(job_id, None)
+            last = len(self._ids) - 1
+            if row != last:
+                moved = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = moved
+                self._rows[moved] = row
+            self._ids.pop()
+
+    def add_many(self, job_ids, vectors, stamps=None):
+        '''
+        Inserts a batch of vectors; rows are normalized in one pass.
+        stamps: the stamp of each vector, None if unknown
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = vectors / norms
+        with self._lock:
+            for job_id, vector in zip(job_ids, vectors):
+                self.remove(job_id)
+            start = len(self._ids)
+            self._grow(start + len(job_ids))
+            self._matrix[start:start + len(job_ids)] = vectors
+            for row, job_id in enumerate(job_ids, start):
+                self._ids.append(job_id)
+                self._rows[job_id] = row
+            self._stamps.update(zip(job_ids, stamps or [None] * len(job_ids)))
+
+    def items(self):
+        '''
+        Returns (ids, matrix) copies of the live rows.
+        '''
+        with self._lock:
+            return list(self._ids), self._matrix[:len(self._ids)].copy()
+
+    def stamps(self, job_ids):
+        with self._lock:
+            return [self._stamps.get(job_id) for job_id in job_ids]
+
+    def search(self, vector, k):
+        '''
+        Returns up to k (job_id, cosine similarity) pairs, best first.
+        '''
+        query = _unit(vector)
+        with self._lock:
+            size = len(self._ids)
+            if size == 0 or k < 1:
+                return []
+            scores = self._matrix[:size] @ query
+            k = min(k, size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self._ids[row], float(scores[row])) for row in top]
+
+    def _grow(self, needed):
+        capacity = self._matrix.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:len(self._ids)] = self._matrix[:len(self._ids)]
+        self._matrix = matrix
+
+
+class IVFIndex:
+    """
+    IVF-flat approximate index.
+    Each inverted list is an ExactIndex holding the jobs whose nearest
+    centroid is that list's centroid. Until train() is called there is
+    a single list and searches are exact.
+    """
+
+    def __init__(self, dim=DIMENSIONS, nprobe=IVF_NPROBE):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.centroids = None
+        # how many vectors the centroids were trained on
+        self.trained_size = 0
+        self.model = None
+        self._lists = [ExactIndex(dim)]
+        self._assigned = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._assigned)
+
+    def __contains__(self, job_id):
+        return job_id in self._assigned
+
+    def ids(self):
+        with self._lock:
+            return list(self._assigned)
+
+    def stamp(self, job_id):
+        with self._lock:
+            list_no = self._assigned.get(job_id)
+            return None if list_no is None else self._lists[list_no].stamp(job_id)
+
+    @property
+    def nlist(self):
+        return len(self._lists)
+
+    def train(self, job_ids, vectors, nlist=IVF_NLIST, seed=0, stamps=None):
+        '''
+        Runs spherical k-means over vectors and rebuilds every list.
+        nlist: number of lists, 0 picks sqrt(len(vectors))
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if not nlist:
+            nlist = int(np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+        centroids = kmeans(vectors, nlist, seed=seed)
+        with self._lock:
+            self.centroids = centroids
+            self.trained_size = len(vectors)
+            self._lists = [ExactIndex(self.dim) for _ in range(nlist)]
+            self._assigned = {}
+            if len(vectors):
+                self._add_many(list(job_ids), vectors, stamps)
+
+    def needs_training(self, min_size=IVF_TRAIN_MIN, growth=IVF_RETRAIN_GROWTH):
+        '''
+        Returns whether the index has no centroids yet but min_size
+        vectors, or has grown growth times since it was trained, so its
+        lists are too few or unbalanced.
+        '''
+        size = len(self)
+        if self.centroids is None:
+            return bool(min_size) and size >= min_size
+        return bool(growth) and size >= growth * max(self.trained_size, 1)
+
+    def retrain(self, nlist=IVF_NLIST):
+        '''
+        Trains new centroids on the vectors already in the index.
+        '''
+        with self._lock:
+            ids, matrices, stamps = [], [], []
+            for inverted in self._lists:
+                list_ids, matrix = inverted.items()
+                ids.extend(list_ids)
+                matrices.append(matrix)
+                stamps.extend(inverted.stamps(list_ids))
+        if ids:
+            self.train(ids, np.concatenate(matrices), nlist, stamps=stamps)
+
+    def add(self, job_id, vector, stamp=None):
+        '''
+        Inserts or replaces job_id in the list of its nearest centroid.
+        '''
+        self.add_many([job_id], [vector], [stamp])
+
+    def add_many(self, job_ids, vectors, stamps=None):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            self._add_many(list(job_ids), vectors, stamps)
+
+    def remove(self, job_id):
+        '''
+        Removes job_id from its list; unknown ids are ignored.
+        '''
+        with self._lock:
+            list_no = self._assigned.pop(job_id, None)
+            if list_no is not None:
+                self._lists[list_no].remove(job_id)
+
+    def search(self, vector, k, nprobe=None):
+        '''
+        Returns up to k (job_id, cosine similarity) pairs, best first,
+        scanning only the nprobe lists nearest to the query.
+        '''
+        query = _unit(vector)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        with self._lock:
+            if self.centroids is None:
+                probes = range(self.nlist)
+            else:
+                scores = self.centroids @ query
+                probes = np.argpartition(-scores, nprobe - 1)[:nprobe]
+            hits = []
+            for list_no in probes:
+                hits.extend(self._lists[list_no].search(query, k))
+        hits.sort(key=lambda hit: -hit[1])
+        return hits[:k]
+
+    def save(self, path):
+        '''
+        Writes the centroids and every list to path atomically.
+        '''
+        with self._lock:
+            ids, matrices, lists, stamps = [], [], [], []
+            for list_no, inverted in enumerate(self._lists):
+                list_ids, matrix = inverted.items()
+                ids.extend(str(job_id) for job_id in list_ids)
+                matrices.append(matrix)
+                lists.extend([list_no] * len(list_ids))
+                stamps.extend(stamp or "" for stamp in inverted.stamps(list_ids))
+            centroids = self.centroids
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                ids=np.array(ids, dtype=str),
+                vectors=np.concatenate(matrices) if ids else np.zeros((0, self.dim)),
+                lists=np.array(lists, dtype=np.int64),
+                centroids=np.zeros((0, self.dim)) if centroids is None else centroids,
+                nprobe=self.nprobe,
+                trained_size=self.trained_size,
+                stamps=np.array(stamps, dtype=str),
+                model=self.model or "",
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, id_type=str, nprobe=None):
+        '''
+        Reads an index written by save().
+        id_type: converts the stored string ids back, e.g. ObjectId
+        nprobe: overrides the saved nprobe, e.g. with IVF_NPROBE
+        '''
+        with np.load(path) as data:
+            centroids = data["centroids"].astype(np.float32)
+            index = cls(dim=centroids.shape[1], nprobe=nprobe or int(data["nprobe"]))
+            ids = [id_type(job_id) for job_id in data["ids"]]
+            lists = data["lists"]
+            vectors = data["vectors"].astype(np.float32)
+            trained_size = (int(data["trained_size"]) if "trained_size" in data.files
+                            else len(ids))
+            # indexes saved before stamps were kept have every row re-read by a sync
+            stamps = ([str(stamp) or None for stamp in data["stamps"]]
+                      if "stamps" in data.files else [None] * len(ids))
+            index.model = (str(data["model"]) or None) if "model" in data.files else None
+        if len(centroids):
+            index.centroids = centroids
+            index.trained_size = trained_size
+            index._lists = [ExactIndex(index.dim) for _ in range(len(centroids))]
+        for list_no in range(index.nlist):
+            rows = np.flatnonzero(lists == list_no)
+            list_ids = [ids[row] for row in rows]
+            index._lists[list_no].add_many(list_ids, vectors[rows], [stamps[row] for row in rows])
+            index._assigned.update((job_id, list_no) for job_id in list_ids)
+        return index
+
+    def _add_many(self, job_ids, vectors, stamps=None):
+        stamps = stamps or [None] * len(job_ids)
+        for job_id in job_ids:
+            self.remove(job_id)
+        if self.centroids is None:
+            assignment = np.zeros(len(job_ids), dtype=np.int64)
+        else:
+            assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+        for list_no in np.unique(assignment):
+            rows = np.flatnonzero(assignment == list_no)
+            list_ids = [job_ids[row] for row in rows]
+            self._lists[list_no].add_many(list_ids, vectors[rows], [stamps[row] for row in rows])
+            self._assigned.update((job_id, int(list_no)) for job_id in list_ids)
+
+
+def kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+    '''
+    vectors: (n, dim) float32 matrix
+    k: number of centroids
+    Spherical k-means on a sample of the vectors; returns unit centroids.
+    '''
+    rng = np.random.default_rng(seed)
+    dim = vectors.shape[1]
+    if len(vectors) == 0:
+        return np.zeros((1, dim), dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    sample = vectors / norms
+    if len(sample) > k * KMEANS_SAMPLE_PER_LIST:
+        sample = sample[rng.choice(len(sample), k * KMEANS_SAMPLE_PER_LIST, replace=False)]
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(k):
+            members = sample[assignment == c]
+            if len(members) == 0:
+                centroids[c] = sample[rng.integers(len(sample))]
+                continue
+            centroid = members.sum(axis=0)
+            norm = np.linalg.norm(centroid)
+            centroids[c] = centroid / norm if norm else centroid
+    return centroids.astype(np.float32)
+
+
+_index = None
+_loaded_at = 0.0
+# set by invalidate(); honored whatever REFRESH_SECONDS is
+_stale = False
+# adds and removes made while a new index is being built, None otherwise
+_journal = None
+# held while the first index is built
+_load_lock = threading.Lock()
+# guards the state above; never held while building
+_state_lock = threading.Lock()
+
+
+def _job_vectors(filt=None):
+    '''
+    Yields batches of (ids, vectors, stamps) for jobs with a usable embedding.
+    '''
+    filt = dict(filt or {}, embedding_vector={"$exists": True})
+    batches = dbc.fetch_batches(
+        "jobs", LOAD_BATCH_SIZE, filt=filt,
+        projection={"embedding_vector": 1, **STAMP_PROJECTION},
+    )
+    for batch in batches:
+        ids, vectors, stamps = [], [], []
+        for job in batch:
+            vector = vector_codec.to_array(job["embedding_vector"])
+            if vector.shape != (DIMENSIONS,):
+                print(f"Skipping job {job[dbc.MONGO_ID]}: bad embedding_vector")
+                continue
+            ids.append(job[dbc.MONGO_ID])
+            vectors.append(vector)
+            stamps.append(stamp(job))
+        yield ids, np.asarray(vectors, dtype=np.float32).reshape(-1, DIMENSIONS), stamps
+
+
+def load_index(model=None):
+    '''
+    model: the model of the vectors queries are embedded with
+    Builds a fresh index of the configured backend from the
+    embedding_vector field of every job.
+    An IVF index is loaded from INDEX_PATH when it exists and was built
+    for model, and then synced with Mongo; otherwise it is trained and
+    saved there.
+    '''
+    if BACKEND == IVF:
+        if INDEX_PATH and os.path.exists(INDEX_PATH):
+            index = IVFIndex.load(INDEX_PATH, id_type=ObjectId, nprobe=IVF_NPROBE)
+            if model is None or index.model == model:
+                sync_index(index)
+                if retrain_if_needed(index) and INDEX_PATH:
+                    index.save(INDEX_PATH)
+                return index
+            print(f"Ignoring the saved vector index of {index.model}; rebuilding it for {model}")
+        index = IVFIndex(dim=DIMENSIONS)
+        ids, vectors, stamps = [], [], []
+        for batch_ids, batch_vectors, batch_stamps in _job_vectors():
+            ids.extend(batch_ids)
+            vectors.append(batch_vectors)
+            stamps.extend(batch_stamps)
+        if ids:
+            index.train(ids, np.concatenate(vectors), stamps=stamps)
+        index.model = model
+        if INDEX_PATH:
+            index.save(INDEX_PATH)
+        return index
+    index = ExactIndex(dim=DIMENSIONS)
+    for ids, vectors, stamps in _job_vectors():
+        index.add_many(ids, vectors, stamps)
+    index.model = model
+    return index
+
+
+def sync_index(index):
+    '''
+    Drops jobs no longer in Mongo and (re-)adds the ones missing from
+    index or whose stamp changed, e.g. re-embedded by another process.
+    Used to catch a saved or long-lived IVF index up without retraining.
+    '''
+    live = {}
+    for batch in dbc.fetch_batches("jobs", LOAD_BATCH_SIZE, projection=STAMP_PROJECTION):
+        live.update((job[dbc.MONGO_ID], stamp(job)) for job in batch)
+    for job_id in [job_id for job_id in index.ids() if job_id not in live]:
+        index.remove(job_id)
+    changed = [job_id for job_id, job_stamp in live.items()
+               if job_id not in index or index.stamp(job_id) != job_stamp]
+    for start in range(0, len(changed), LOAD_BATCH_SIZE):
+        chunk = changed[start:start + LOAD_BATCH_SIZE]
+        for ids, vectors, stamps in _job_vectors({dbc.MONGO_ID: {"$in": chunk}}):
+            index.add_many(ids, vectors, stamps)
+
+
+def retrain_if_needed(index, force=False):
+    '''
+    Retrains an IVF index that needs_training() (or any IVF index when
+    force is True). Returns whether it was retrained.
+    '''
+    if not isinstance(index, IVFIndex) or not (force or index.needs_training()):
+        return False
+    before = index.nlist
+    index.retrain()
+    print(f"Retrained IVF index on {len(index)} vectors: {before} -> {index.nlist} lists")
+    return True
+
+
+def get_index(model=None):
+    '''
+    model: the model of the vectors queries are embedded with, None to
+        take the index as it is
+    Returns the process-wide index, building it on first use.
+    Once it is older than REFRESH_SECONDS, after invalidate() or when it
+    was built for another model, a background thread rebuilds an exact
+    index or syncs an IVF one while searches keep using the current index.
+    '''
+    global _index, _loaded_at, _stale, _journal
+    if _index is None:
+        with _load_lock:
+            if _index is None:
+                with _state_lock:
+                    _journal = []
+                try:
+                    index = load_index(model)
+                finally:
+                    with _state_lock:
+                        journal, _journal = _journal, None
+                with _state_lock:
+                    _replay(index, journal)
+                    _index, _loaded_at, _stale = index, time.monotonic(), False
+    with _state_lock:
+        expired = REFRESH_SECONDS and time.monotonic() - _loaded_at > REFRESH_SECONDS
+        other_model = model is not None and _index.model != model
+        if (_stale or expired or other_model) and _journal is None:
+            _journal, _stale = [], False
+            threading.Thread(target=_refresh, args=(_index, model), daemon=True).start()
+        return _index
+
+
+def _refresh(current, model=None):
+    global _index, _loaded_at, _stale, _journal
+    try:
+        if isinstance(current, IVFIndex) and (model is None or current.model == model):
+            index = current
+            sync_index(index)
+            retrain_if_needed(index)
+            if INDEX_PATH:
+                index.save(INDEX_PATH)
+        else:
+            index = load_index(model)
+    except Exception as e:
+        print(f"Vector index refresh failed, keeping the current one: {e}")
+        with _state_lock:
+            _journal, _stale = None, True
+        return
+    with _state_lock:
+        # writes mirrored while building may be missing from the new index
+        _replay(index, _journal)
+        if _index is current:
+            _index = index
+        _loaded_at, _journal = time.monotonic(), None
+
+
+def _replay(index, journal):
+    for job_id, vector, job_stamp in journal:
+        if vector is None:
+            index.remove(job_id)
+        else:
+            index.add(job_id, vector, job_stamp)
+
+
+def save_index(path=None):
+    '''
+    Saves the loaded IVF index, e.g. before a deploy.
+    '''
+    path = path or INDEX_PATH
+    index = get_index()
+    if not path or not isinstance(index, IVFIndex):
+        raise ValueError("Only an IVF index with a VECTOR_INDEX_PATH can be saved")
+    index.save(path)
+
+
+def add(job_id, vector, fields=None):
+    '''
+    Mirrors an inserted or updated job into the index if it is loaded.
+    fields: the embedding fields written with vector, for its stamp
+    '''
+    job_stamp = stamp(fields or {})
+    with _state_lock:
+        index = _index
+        if _journal is not None:
+            _journal.append((job_id, vector, job_stamp))
+    if index is not None:
+        index.add(job_id, vector, job_stamp)
+
+
+def remove(job_id):
+    '''
+    Mirrors a deleted job into the index if it is loaded.
+    '''
+    with _state_lock:
+        index = _index
+        if _journal is not None:
+            _journal.append((job_id, None, None))
+    if index is not None:
+        index.remove(job_id)
+
+
+def invalidate():
+    '''
+    Marks the loaded index stale after a bulk change whose ids are not
+    known (e.g. delete_many), so the next search refreshes it.
+    '''
+    global _stale
+    with _state_lock:
+        _stale = True
+
+
+def reset():
+    '''
+    Drops the loaded index so the next search rebuilds it.
+    '''
+    global _index
+    with _load_lock, _state_lock:
+        _index = None
+
+
+def search(vector, k, model=None):
+    return get_index(model).search(vector, k)
@@ -4,8 +4,10 @@ The endpoint called `endpoints` will return all available endpoints.
 """
 
 from http import HTTPStatus
+import json
+from urllib.parse import urlencode
 from bson.objectid import ObjectId
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_restx import Resource, Api
 from flask_cors import CORS
 
@@ -14,6 +16,11 @@ from flask_cors import CORS
 import werkzeug.exceptions as wz
 
 import db.db as db
+import db.embed_queue as embed_queue
+import db.schema as schema
+from db.embedding_cache import normalize_text
+import server.response_cache as response_cache
+from server.conditional import conditional
 import HATEOAS.form as form
 from datetime import datetime, date
 
@@ -21,6 +28,21 @@ app = Flask(__name__)
 CORS(app)
 api = Api(app)
 
+
+@app.before_request
+def ensure_indexes():
+    # on the first request rather than at import, so the app can be
+    # imported without a reachable Mongo
+    schema.ensure_indexes()
+
+
+@app.before_request
+def start_embedding_workers():
+    # once per process; a no-op after the first request
+    if embed_queue.ENABLED and embed_queue.WORKERS > 0:
+        db.start_embedding_workers()
+
+
 MAIN_MENU = "MainMenu"
 MAIN_MENU_NM = "Welcome to Text Game!"
 USERS = "users"
@@ -30,6 +52,7 @@ ENDPOINTS
 """
 UPDATE_USER_INFO = "update_user_info"
 ADD_NEW_JOBS = "add_new_job"
+ADD_NEW_JOBS_BULK = "add_new_jobs_bulk"
 USER_REPORT = "add_user_report"
 GET_USER_REPORTS = "get_user_reports"
 DELETE_ACCOUNT = "delete_account"
@@ -48,6 +71,10 @@ HELLO_RESP = "HELLO WORLD"
 GET_USERNAME = "get_username_by_id"
 GET_JOB_BY_ID = "get_job_by_id"
 GET_JOBS_BY_VECTOR = "search_jobs_by_vector"
+DEV_STATS = "dev_stats"
+
+NDJSON = "application/x-ndjson"
+BULK_MAX_JOBS = 1000
 
 
 @api.route(HELLO_EP)
@@ -175,6 +202,14 @@ class UserReport(Resource):
             raise wz.NotAcceptable(str(e))
 
 
+def _report_json(res):
+    res["id"] = str(res["_id"])
+    res["user_id"] = str(res["user_id"])
+    res["job_id"] = str(res["job_id"])
+    del [res["_id"]]
+    return res
+
+
 @api.route(f"/{GET_USER_REPORTS}")
 class GetUserReports(Resource):
     """
@@ -183,18 +218,72 @@ class GetUserReports(Resource):
 
     @api.response(HTTPStatus.OK, "Success")
     @api.response(HTTPStatus.NOT_ACCEPTABLE, "Not Acceptable")
+    @api.doc(
+        params={
+            "job_id": {"description": "Only reports about this job", "type": "string"},
+            "user_id": {"description": "Only reports by this user", "type": "string"},
+            "start_date": {"description": "Reports created on or after (YYYY-MM-DD)",
+                           "type": "string"},
+            "end_date": {"description": "Reports created before (YYYY-MM-DD)",
+                         "type": "string"},
+            "limit": {"description": "Page size; omit for all reports", "type": "int"},
+            "cursor": {"description": "cursor from the previous page's next link",
+                       "type": "string"},
+            "format": {"description": "json or ndjson (streamed)", "type": "string",
+                       "default": "json"},
+        }
+    )
     def get(self):
         """
         returns all user reports
         """
-        response = db.get_user_reports()
+        try:
+            filters = {
+                "job_id": request.args.get("job_id"),
+                "user_id": request.args.get("user_id"),
+                "start": None,
+                "end": None,
+            }
+            if request.args.get("start_date") is not None:
+                filters["start"] = datetime.strptime(request.args["start_date"], "%Y-%m-%d")
+            if request.args.get("end_date") is not None:
+                filters["end"] = datetime.strptime(request.args["end_date"], "%Y-%m-%d")
+            limit = request.args.get("limit")
+            limit = None if limit is None else int(limit)
+            if limit is not None and limit < 1:
+                raise ValueError("limit must be greater than 0")
+            cursor = request.args.get("cursor")
+            if request.args.get("format", "json") == "ndjson":
+                if cursor is not None:
+                    filters["after"] = ObjectId(cursor)
+                return self._stream(filters, limit)
+            if limit is None:
+                response = db.get_user_reports(**filters)
+                next_cursor = None
+            else:
+                response, next_cursor = db.get_user_reports_page(limit, cursor, **filters)
+        except Exception as e:
+            raise wz.NotAcceptable(str(e))
 
         for res in response:
-            res["id"] = str(res["_id"])
-            res["user_id"] = str(res["user_id"])
-            res["job_id"] = str(res["job_id"])
-            del [res["_id"]]
-        return response, 200
+            _report_json(res)
+        headers = {}
+        if next_cursor is not None:
+            args = request.args.to_dict()
+            args["cursor"] = next_cursor
+            headers["Link"] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+        return response, 200, headers
+
+    def _stream(self, filters, limit):
+        """
+        writes one JSON document per line as the Mongo cursor yields them
+        """
+        def generate():
+            for count, res in enumerate(db.iter_user_reports(**filters)):
+                if limit is not None and count >= limit:
+                    return
+                yield json.dumps(_report_json(res)) + "\n"
+        return Response(generate(), mimetype=NDJSON)
 
 
 @api.route(f"/{UPDATE_JOB_POSTING}")
@@ -292,10 +381,22 @@ class read_most_recent_jobs(Resource):
     """
     This endpoint allows getting most recent jobs.
     also returns job_id
+    Pages are linked through a `Link: <...>; rel="next"` header carrying
+    an opaque cursor.
+    Responses carry an ETag that changes with any write to jobs, so
+    If-None-Match gets a 304 while nothing changed.
     """
     @api.response(HTTPStatus.OK,  "Success")
     @api.response(HTTPStatus.NOT_ACCEPTABLE, "Not Acceptable")
-    @api.doc(params={"numbers": {"description": "amount", "type": "int", "default": 5}})
+    @api.response(HTTPStatus.NOT_MODIFIED, "Not Modified")
+    @api.doc(
+        params={
+            "numbers": {"description": "amount", "type": "int", "default": 5},
+            "cursor": {"description": "cursor from the previous page's next link",
+                       "type": "string"},
+        }
+    )
+    @conditional(lambda: db.get_jobs_version())
     def get(self):
         # user_id = request.json.get("user_id")
         # if user_id is None:
@@ -303,10 +404,22 @@ class read_most_recent_jobs(Resource):
         try:
 
             numbers = int(request.args.get("numbers"))
-            res = db.get_most_recent_job(numbers)
-            return res, 200
+            if numbers < 1:
+                raise ValueError("numbers must be greater than 0")
+            cursor = request.args.get("cursor")
+            res, next_cursor = response_cache.cache.get_or_compute(
+                (READ_MOST_RECENT_JOBS, numbers, cursor),
+                lambda: db.get_most_recent_job_page(numbers, cursor),
+            )
         except Exception as e:
             raise wz.NotAcceptable(str(e))
+        headers = {}
+        if next_cursor is not None:
+            next_url = request.base_url + "?" + urlencode(
+                {"numbers": numbers, "cursor": next_cursor}
+            )
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return res, 200, headers
 
 
 @api.route(f"/{ADMIN_DELETE_JOBS}")
@@ -359,14 +472,20 @@ class dev_delete_past_date(Resource):
                 "type": "datetime",
                 "default": "Test2",
             },
+            "archive": {
+                "description": "Move the jobs to jobs_archive instead of deleting them",
+                "type": "bool",
+                "default": False,
+            },
         }
     )
     def delete(self):
         try:
             invalid_past_date_s = request.args.get("invalid_past_date")
             invalid_past_date = datetime.strptime(invalid_past_date_s, "%Y-%m-%d")
-            db.delete_job_past_date(invalid_past_date)
-            return {"status": "success", "message": "Jobs deleted"}, 200
+            archive = request.args.get("archive", "false").lower() == "true"
+            count = db.delete_job_past_date(invalid_past_date, archive=archive)
+            return {"status": "success", "message": "Jobs deleted", "count": count}, 200
         except Exception as e:
             raise wz.NotAcceptable(str(e))
 
@@ -569,6 +688,67 @@ class AddNewJobPosting(Resource):
         return {"status": "success", "message": "job posting successfully submit"}, 200
 
 
+@api.route(f"/{ADD_NEW_JOBS_BULK}")
+class AddNewJobPostingsBulk(Resource):
+    """
+    This class adds many job postings in one request.
+    The body is a JSON array of jobs or NDJSON (one job per line), each
+    with the fields of add_new_job; date is YYYY-MM-DD and defaults to today.
+    Returns a result per job, so a bad job does not fail the others.
+    Jobs already posted are matched on link, company and title and only
+    written if they changed, so re-posting a whole scrape is cheap.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.NOT_ACCEPTABLE, "Not Acceptable")
+    def post(self):
+        try:
+            items = _parse_jobs_body(request.get_data(as_text=True))
+        except ValueError as e:
+            raise wz.NotAcceptable(str(e))
+        if len(items) > BULK_MAX_JOBS:
+            raise wz.NotAcceptable(f"At most {BULK_MAX_JOBS} jobs per request")
+        results = [None] * len(items)
+        jobs = []
+        positions = []
+        for i, item in enumerate(items):
+            try:
+                jobs.append(_bulk_job(item))
+                positions.append(i)
+            except (TypeError, ValueError) as e:
+                results[i] = {"index": i, "status": "error", "message": str(e)}
+        try:
+            created = db.add_job_postings(jobs, indices=positions)
+        except Exception as e:
+            raise wz.NotAcceptable(str(e))
+        for i, result in zip(positions, created):
+            results[i] = {**result, "index": i}
+        return {
+            "created": sum(result["status"] == "created" for result in results),
+            "updated": sum(result["status"] == "updated" for result in results),
+            "unchanged": sum(result["status"] == "unchanged" for result in results),
+            "failed": sum(result["status"] == "error" for result in results),
+            "results": results,
+        }, 200
+
+
+def _parse_jobs_body(body):
+    body = body.strip()
+    if not body:
+        return []
+    if body.startswith("["):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def _bulk_job(item):
+    if not isinstance(item, dict):
+        raise TypeError("Each job must be an object")
+    job = dict(item)
+    job["date"] = datetime.strptime(job.get("date") or date.today().isoformat(), "%Y-%m-%d")
+    return job
+
+
 @api.route(f"/{DELETE_USER_REPORT}")
 class DeleteUserReport(Resource):
     '''
@@ -626,8 +806,10 @@ class GetJobByID(Resource):
     '''
     This endpoint allows users to get a job based on its ID.
     Returns the job that matches the ID.
+    Responses carry an ETag built on the job's version.
     '''
     @api.response(HTTPStatus.OK, "Success")
+    @api.response(HTTPStatus.NOT_MODIFIED, "Not Modified")
     @api.response(HTTPStatus.NOT_ACCEPTABLE, "Not Acceptable")
     @api.doc(
         params={
@@ -638,6 +820,7 @@ class GetJobByID(Resource):
             }
         }
     )
+    @conditional(lambda: db.get_job_version(ObjectId(request.args.get("job_id"))))
     def get(self):
         job_id = request.args.get("job_id")
         try:
@@ -654,6 +837,7 @@ class SearchJobsByVector(Resource):
     The search query is passed to the OpenAI text-embedding-ada-002 model
     and the resulting vector is used to search for jobs that match the vector.
     Returns jobs that matches the search query.
+    Results are cached by normalized query and limit until jobs change.
     '''
     @api.response(HTTPStatus.OK, "Success")
     @api.response(HTTPStatus.NOT_ACCEPTABLE, "Not Acceptable")
@@ -677,8 +861,32 @@ class SearchJobsByVector(Resource):
             limit = int(request.args.get("limit"))
             if limit < 1:
                 raise ValueError("limit must be greater than 0")
-            jobs = db.search_jobs_by_vector(text, limit)
+            jobs = response_cache.search_cache.get_or_compute(
+                (GET_JOBS_BY_VECTOR, normalize_text(text), limit),
+                lambda: db.search_jobs_by_vector(text, limit),
+            )
 
         except Exception as e:
             return {"message": str(e)}, 400
         return jobs, 200
+
+
+@api.route(f"/{DEV_STATS}")
+class DevStats(Resource):
+    """
+    Developer only endpoint that reports cache and performance counters.
+    """
+
+    @api.response(HTTPStatus.OK, "Success")
+    def get(self):
+        """
+        returns the current counters
+        """
+        return {
+            "embedding_cache": db.get_embedding_cache_stats(),
+            "embedding_breaker": db.get_embedding_breaker_stats(),
+            "embedding_dispatch": db.get_embedding_dispatch_stats(),
+            "mongo_pool": db.get_db_pool_stats(),
+            "response_cache": response_cache.cache.stats(),
+            "search_cache": response_cache.search_cache.stats(),
+        }, 200
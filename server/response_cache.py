@@ -0,0 +1,126 @@
+"""
+This file provides in-process caches for endpoint responses built
+from the jobs collection: one for job listings and one for semantic
+search results, which are expensive (an embedding call and a vector
+search) and dominated by a few hundred repeated queries.
+Entries are keyed by endpoint and arguments and remember the jobs
+version (db.job_events.collection_version) they were computed at. That
+counter is shared through Mongo, so a write to jobs from any process
+(another server worker, the ingestion pipeline) invalidates them, and a
+cached body always matches the ETag built from the same version. The
+TTL only bounds how long unused entries are kept.
+Concurrent misses on the same key are coalesced: one request runs the
+query while the others wait for its result.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import db.job_events as job_events
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+DEFAULT_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 30))
+SEARCH_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_SIZE", 512))
+SEARCH_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 300))
+
+
+class _Flight:
+    """
+    A computation in progress that other requests can wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """
+    LRU cache of endpoint results with generation based invalidation
+    and request coalescing.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 generation=job_events.collection_version):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._generation = generation
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0}
+
+    def get_or_compute(self, key, compute):
+        '''
+        key: hashable (endpoint, args...) tuple
+        compute: function producing the response on a miss
+        Returns the cached response for key, computing it at most once
+        across concurrent callers.
+        '''
+        # read outside the lock, the default version lives in Mongo
+        generation = self._generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires, value = entry
+                if entry_generation == generation and expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._counters["invalidations"] += 1
+            flight = self._flights.get((key, generation))
+            leader = flight is None
+            if leader:
+                flight = self._flights[(key, generation)] = _Flight()
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            current = self._generation() if flight.error is None else None
+            with self._lock:
+                del self._flights[(key, generation)]
+                if flight.error is None:
+                    self._store(key, generation, current, flight.value)
+            flight.done.set()
+        return flight.value
+
+    def stats(self):
+        with self._lock:
+            res = dict(self._counters)
+            res["size"] = len(self._entries)
+        lookups = res["hits"] + res["misses"] + res["coalesced"]
+        res["hit_rate"] = (res["hits"] + res["coalesced"]) / lookups if lookups else 0.0
+        return res
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for counter in self._counters:
+                self._counters[counter] = 0
+
+    def _store(self, key, generation, current, value):
+        # a write that landed while we were computing makes value stale
+        if generation != current:
+            return
+        self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+cache = ResponseCache()
+search_cache = ResponseCache(SEARCH_MAX_ENTRIES, SEARCH_TTL)
@@ -0,0 +1,80 @@
+from flask import Flask
+
+from server.conditional import conditional, make_etag
+
+VERSION = {"value": 1}
+CALLS = []
+
+app = Flask(__name__)
+
+
+@app.route("/thing")
+@conditional(lambda: VERSION["value"])
+def thing():
+    CALLS.append(1)
+    return {"value": VERSION["value"]}, 200
+
+
+@app.route("/missing")
+@conditional(lambda: None)
+def missing():
+    return {"message": "nope"}, 404
+
+
+@app.route("/broken_version")
+@conditional(lambda: 1 / 0)
+def broken_version():
+    return {"ok": True}
+
+
+CLIENT = app.test_client()
+
+
+def test_make_etag_depends_on_every_part():
+    assert make_etag("a", 1) == make_etag("a", 1)
+    assert make_etag("a", 1) != make_etag("a", 2)
+    assert make_etag("a", 1) != make_etag("a1")
+
+
+def test_sets_strong_etag():
+    resp = CLIENT.get("/thing")
+    assert resp.status_code == 200
+    tag, weak = resp.get_etag()
+    assert tag and not weak
+
+
+def test_not_modified_skips_handler():
+    etag = CLIENT.get("/thing").headers["ETag"]
+    CALLS.clear()
+    resp = CLIENT.get("/thing", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+    assert CALLS == []
+
+
+def test_matches_in_list_and_star():
+    etag = CLIENT.get("/thing").headers["ETag"]
+    assert CLIENT.get("/thing", headers={"If-None-Match": f'"other", {etag}'}).status_code == 304
+    assert CLIENT.get("/thing", headers={"If-None-Match": "*"}).status_code == 304
+
+
+def test_new_version_returns_body():
+    etag = CLIENT.get("/thing").headers["ETag"]
+    VERSION["value"] += 1
+    resp = CLIENT.get("/thing", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+
+def test_query_string_is_part_of_etag():
+    assert (CLIENT.get("/thing?a=1").headers["ETag"]
+            != CLIENT.get("/thing?a=2").headers["ETag"])
+
+
+def test_no_version_is_unconditional():
+    resp = CLIENT.get("/missing", headers={"If-None-Match": "*"})
+    assert resp.status_code == 404
+    assert "ETag" not in resp.headers
+    resp = CLIENT.get("/broken_version")
+    assert resp.status_code == 200
+    assert "ETag" not in resp.headers
@@ -1,13 +1,14 @@
 from bson import ObjectId
 from datetime import datetime
 import server.endpoints as ep
+import server.response_cache as response_cache
 import json
 import pytest
 
 from db import db
 from db import db_connect as dbc
 from unittest.mock import patch
-from http.client import NOT_ACCEPTABLE, OK
+from http.client import NOT_ACCEPTABLE, NOT_MODIFIED, OK
 
 import sys
 
@@ -30,6 +31,13 @@ companies = ["Apple", "Microsoft", "Google"]
 jobs_type = ["machine learning", "data science", "software engineering"]
 fake_vectors = [[float(i+1)] * 1536 for i in range(len(companies))]
 
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    response_cache.cache.clear()
+    response_cache.search_cache.clear()
+    yield
+
+
 @pytest.fixture
 def sample_data():
     return {
@@ -250,6 +258,44 @@ def test_get_user_reports_empty():
     assert resp == expected_results
 
 
+def test_get_user_reports_filtered(temp_user_report):
+    resp = TEST_CLIENT.get(f"/{ep.GET_USER_REPORTS}", query_string={"job_id": str(job_id)})
+    assert resp._status_code == 200
+    assert [report["id"] for report in resp.get_json()] == [str(report_id)]
+    resp = TEST_CLIENT.get(f"/{ep.GET_USER_REPORTS}", query_string={"user_id": str(job_id)})
+    assert resp.get_json() == []
+
+
+def test_get_user_reports_date_range(temp_user_report):
+    resp = TEST_CLIENT.get(
+        f"/{ep.GET_USER_REPORTS}",
+        query_string={"start_date": "2000-01-01", "end_date": "2000-01-02"},
+    )
+    assert resp._status_code == 200
+    assert resp.get_json() == []
+
+
+def test_get_user_reports_paginated(temp_user_report):
+    resp = TEST_CLIENT.get(f"/{ep.GET_USER_REPORTS}", query_string={"limit": 1})
+    assert resp._status_code == 200
+    assert len(resp.get_json()) == 1
+    assert "Link" not in resp.headers
+
+
+@patch("db.db.iter_user_reports", return_value=iter(sample_get_users()), autospec=True)
+def test_get_user_reports_ndjson(mock_iter):
+    resp = TEST_CLIENT.get(f"/{ep.GET_USER_REPORTS}", query_string={"format": "ndjson"})
+    assert resp._status_code == 200
+    assert resp.mimetype == ep.NDJSON
+    lines = resp.data.decode("utf-8").splitlines()
+    assert [json.loads(line)["id"] for line in lines] == ["65594839ee7a3c7d7d46eead"]
+
+
+def test_get_user_reports_bad_limit():
+    resp = TEST_CLIENT.get(f"/{ep.GET_USER_REPORTS}", query_string={"limit": 0})
+    assert resp._status_code == NOT_ACCEPTABLE
+
+
 @patch("db.db.add_user_report", return_value=True, autospec=True)
 def test_send_user_report(mock_add):
     resp = TEST_CLIENT.post(
@@ -345,15 +391,73 @@ def test_update_preferences_BAD2(mock_add):
     assert resp.status_code == NOT_ACCEPTABLE
 
 
-@patch("db.db.get_most_recent_job", return_value=True, autospec=True)
+@patch("db.db.get_most_recent_job_page", return_value=([], None), autospec=True)
 def test_read_most_recent_jobs_OK(mock_add):
     resp = TEST_CLIENT.get(
         f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"user_id": 1, "numbers": 1}
     )
     assert resp.status_code == OK
+    assert "Link" not in resp.headers
+
+
+@patch("db.db.get_most_recent_job_page", return_value=([], "abc"), autospec=True)
+def test_read_most_recent_jobs_next_link(mock_add):
+    resp = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": 1})
+    assert resp.status_code == OK
+    assert "cursor=abc" in resp.headers["Link"]
+    assert resp.headers["Link"].endswith('rel="next"')
+
+
+def test_integration_read_most_recent_jobs_pages(temp_jobs):
+    seen = []
+    query = {"numbers": 4}
+    while True:
+        resp = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string=query)
+        assert resp.status_code == OK
+        seen.extend(job["job_id"] for job in resp.get_json())
+        if "Link" not in resp.headers:
+            break
+        query = {"numbers": 4, "cursor": resp.headers["Link"].split("cursor=")[1].split(">")[0]}
+    assert len(seen) == len(set(seen))
+    assert len(seen) == len(dbc.fetch_all("jobs"))
+
+
+def test_read_most_recent_jobs_cached():
+    with patch("db.db.get_most_recent_job_page", return_value=([], None)) as mock_page:
+        for _ in range(3):
+            resp = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": 2})
+            assert resp.status_code == OK
+        assert mock_page.call_count == 1
+
+
+def test_read_most_recent_jobs_invalidated_by_writes(temp_jobs):
+    first = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": 1})
+    with patch("db.db.generate_vector", return_value=fake_vectors[0]):
+        job_id = db.add_job_posting(
+            "Newest", "desc", "type", "loc", datetime(2030, 1, 1), "link"
+        ).inserted_id
+    second = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": 1})
+    assert first.get_json() != second.get_json()
+    assert second.get_json()[0]["job_id"] == str(job_id)
+    dbc.client[TEST_DB]["jobs"].delete_one({"_id": job_id})
+
+
+def test_read_most_recent_jobs_bad_cursor():
+    resp = TEST_CLIENT.get(
+        f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": 1, "cursor": "garbage"}
+    )
+    assert resp.status_code == NOT_ACCEPTABLE
+
 
+@patch("db.db.get_most_recent_job_page", autospec=True)
+def test_read_most_recent_jobs_rejects_non_positive_numbers(mock_page):
+    for numbers in (0, -1):
+        resp = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": numbers})
+        assert resp.status_code == NOT_ACCEPTABLE
+    mock_page.assert_not_called()
 
-@patch("db.db.get_most_recent_job", side_effect=KeyError(), autospec=True)
+
+@patch("db.db.get_most_recent_job_page", side_effect=KeyError(), autospec=True)
 def test_read_most_recent_jobs_BAD_for_userID(mock_add):
     resp = TEST_CLIENT.get(
         f"/{ep.READ_MOST_RECENT_JOBS}", json={"user_id": 9, "numbers": 9}
@@ -521,6 +625,102 @@ def test_get_job_by_id_fails(mock_get):
     assert resp._status_code == 400
 
 
+@patch("db.db.get_job_version", return_value=3)
+@patch("db.db.get_job_by_id", return_value={"_id": "662430e9ab497b02d0c59db0"})
+def test_get_job_by_id_not_modified(mock_get, mock_version):
+    test = {"job_id": "662430e9ab497b02d0c59db0"}
+    resp = TEST_CLIENT.get(f"/{ep.GET_JOB_BY_ID}", query_string=test)
+    assert resp.status_code == OK
+    etag = resp.headers["ETag"]
+    resp = TEST_CLIENT.get(f"/{ep.GET_JOB_BY_ID}", query_string=test,
+                           headers={"If-None-Match": etag})
+    assert resp.status_code == NOT_MODIFIED
+    assert resp.headers["ETag"] == etag
+    assert resp.data == b""
+    assert mock_get.call_count == 1
+    mock_version.return_value = 4
+    resp = TEST_CLIENT.get(f"/{ep.GET_JOB_BY_ID}", query_string=test,
+                           headers={"If-None-Match": etag})
+    assert resp.status_code == OK
+    assert resp.headers["ETag"] != etag
+
+
+@patch("db.db.get_jobs_version", return_value=7)
+@patch("db.db.get_most_recent_job_page", return_value=([], None))
+def test_read_most_recent_jobs_not_modified(mock_page, mock_version):
+    url = f"/{ep.READ_MOST_RECENT_JOBS}"
+    etag = TEST_CLIENT.get(url, query_string={"numbers": 2}).headers["ETag"]
+    resp = TEST_CLIENT.get(url, query_string={"numbers": 2}, headers={"If-None-Match": etag})
+    assert resp.status_code == NOT_MODIFIED
+    other = TEST_CLIENT.get(url, query_string={"numbers": 3})
+    assert other.headers["ETag"] != etag
+
+
+def test_integration_read_most_recent_jobs_etag_changes_on_write(temp_jobs):
+    url = f"/{ep.READ_MOST_RECENT_JOBS}"
+    etag = TEST_CLIENT.get(url, query_string={"numbers": 1}).headers["ETag"]
+    job_id = dbc.client[TEST_DB]["jobs"].find_one({}, {"_id": 1})["_id"]
+    db.update_job(job_id, {"link": "fakelink/updated"})
+    resp = TEST_CLIENT.get(url, query_string={"numbers": 1}, headers={"If-None-Match": etag})
+    assert resp.status_code == OK
+
+
+def _created(jobs, indices=None):
+    return [{"index": i, "status": "created", "job_id": str(ObjectId())}
+            for i in indices or range(len(jobs))]
+
+
+@patch("db.db.add_job_postings", side_effect=_created)
+def test_add_new_jobs_bulk_json(mock_add):
+    jobs = [
+        {"company": "Apple", "job_type": "Intern", "location": "SF",
+         "date": "2024-01-02", "link": "a"},
+        {"company": "Google", "job_type": "Intern", "location": "NY", "link": "b"},
+    ]
+    resp = TEST_CLIENT.post(f"/{ep.ADD_NEW_JOBS_BULK}", json=jobs)
+    assert resp.status_code == OK
+    body = resp.get_json()
+    assert body["created"] == 2
+    assert body["failed"] == 0
+    sent = mock_add.call_args[0][0]
+    assert sent[0]["date"] == datetime(2024, 1, 2)
+    assert isinstance(sent[1]["date"], datetime)
+
+
+@patch("db.db.add_job_postings", side_effect=_created)
+def test_add_new_jobs_bulk_ndjson_with_bad_items(mock_add):
+    lines = [
+        json.dumps({"company": "Apple", "job_type": "Intern", "location": "SF",
+                    "date": "2024-01-02", "link": "a"}),
+        json.dumps({"company": "Apple", "date": "not a date"}),
+        json.dumps(["not", "a", "job"]),
+        json.dumps({"company": "Google", "job_type": "Intern", "location": "NY",
+                    "date": "2024-01-03", "link": "b"}),
+    ]
+    resp = TEST_CLIENT.post(f"/{ep.ADD_NEW_JOBS_BULK}", data="\n".join(lines) + "\n",
+                            content_type=ep.NDJSON)
+    assert resp.status_code == OK
+    body = resp.get_json()
+    assert body["created"] == 2
+    assert body["failed"] == 2
+    assert [result["index"] for result in body["results"]] == [0, 1, 2, 3]
+    assert [result["status"] for result in body["results"]] == [
+        "created", "error", "error", "created"]
+    assert len(mock_add.call_args[0][0]) == 2
+    assert mock_add.call_args[1]["indices"] == [0, 3]
+
+
+def test_add_new_jobs_bulk_bad_body():
+    resp = TEST_CLIENT.post(f"/{ep.ADD_NEW_JOBS_BULK}", data="[not json",
+                            content_type="application/json")
+    assert resp.status_code == NOT_ACCEPTABLE
+
+
+def test_add_new_jobs_bulk_too_many():
+    resp = TEST_CLIENT.post(f"/{ep.ADD_NEW_JOBS_BULK}", json=[{}] * (ep.BULK_MAX_JOBS + 1))
+    assert resp.status_code == NOT_ACCEPTABLE
+
+
 def test_integration_read_most_recent_jobs_works(temp_jobs):
     resp = TEST_CLIENT.get(f"/{ep.READ_MOST_RECENT_JOBS}", query_string={"numbers": len(companies)*len(jobs_type)})
     assert resp._status_code == 200
@@ -585,6 +785,38 @@ def test_integration_search_jobs_by_vector_with_bad_limit(temp_jobs, vector_sear
 
     # eprint(resp.get_json()
 
+
+def test_search_jobs_by_vector_cached_by_normalized_query():
+    with patch("db.db.search_jobs_by_vector", return_value=[]) as mock_search:
+        for query in ["Machine Learning", "machine   learning", " MACHINE learning "]:
+            resp = TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}",
+                                   query_string={"query": query, "limit": 3})
+            assert resp.status_code == OK
+        assert mock_search.call_count == 1
+        TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}",
+                        query_string={"query": "machine learning", "limit": 4})
+        TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}",
+                        query_string={"query": "data science", "limit": 3})
+        assert mock_search.call_count == 3
+
+
+def test_search_jobs_by_vector_cache_invalidated_by_writes():
+    with patch("db.db.search_jobs_by_vector", return_value=[]) as mock_search:
+        query = {"query": "machine learning", "limit": 3}
+        TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}", query_string=query)
+        db.job_events.changed()
+        TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}", query_string=query)
+        assert mock_search.call_count == 2
+
+
+def test_search_jobs_by_vector_errors_not_cached():
+    with patch("db.db.search_jobs_by_vector",
+               side_effect=[RuntimeError("Could not embed"), []]) as mock_search:
+        query = {"query": "machine learning", "limit": 3}
+        assert TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}", query_string=query).status_code == 400
+        assert TEST_CLIENT.get(f"/{ep.GET_JOBS_BY_VECTOR}", query_string=query).status_code == OK
+        assert mock_search.call_count == 2
+
 def test_integration_get_jobs_by_id_works(temp_jobs):
     for jobs in dbc.fetch_all("jobs"):
         resp = TEST_CLIENT.get(f"/{ep.GET_JOB_BY_ID}", query_string={"job_id": jobs["_id"]})
@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+import server.response_cache as rc
+
+
+class FakeGeneration:
+    def __init__(self):
+        self.value = 0
+
+    def __call__(self):
+        return self.value
+
+
+@pytest.fixture
+def generation():
+    return FakeGeneration()
+
+
+def test_hit_after_miss(generation):
+    cache = rc.ResponseCache(generation=generation)
+    calls = []
+    for _ in range(3):
+        assert cache.get_or_compute(("ep", 1), lambda: calls.append(1) or "value") == "value"
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+
+
+def test_generation_bump_invalidates(generation):
+    cache = rc.ResponseCache(generation=generation)
+    cache.get_or_compute(("ep", 1), lambda: "old")
+    generation.value += 1
+    assert cache.get_or_compute(("ep", 1), lambda: "new") == "new"
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_ttl_expiry(generation):
+    cache = rc.ResponseCache(ttl=0.01, generation=generation)
+    cache.get_or_compute(("ep", 1), lambda: "old")
+    time.sleep(0.02)
+    assert cache.get_or_compute(("ep", 1), lambda: "new") == "new"
+
+
+def test_keys_are_separate(generation):
+    cache = rc.ResponseCache(generation=generation)
+    assert cache.get_or_compute(("ep", 1), lambda: "one") == "one"
+    assert cache.get_or_compute(("ep", 2), lambda: "two") == "two"
+
+
+def test_errors_are_not_cached(generation):
+    cache = rc.ResponseCache(generation=generation)
+
+    def fail():
+        raise KeyError("boom")
+
+    with pytest.raises(KeyError):
+        cache.get_or_compute(("ep", 1), fail)
+    assert cache.get_or_compute(("ep", 1), lambda: "ok") == "ok"
+
+
+def test_write_during_compute_is_not_cached(generation):
+    cache = rc.ResponseCache(generation=generation)
+
+    def compute():
+        generation.value += 1
+        return "stale"
+
+    assert cache.get_or_compute(("ep", 1), compute) == "stale"
+    assert cache.stats()["size"] == 0
+
+
+def test_concurrent_misses_are_coalesced(generation):
+    cache = rc.ResponseCache(generation=generation)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute(("ep",), slow)))
+               for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_default_generation_is_shared_jobs_version():
+    # the ETags of the listing endpoints come from the same counter
+    assert rc.cache._generation is rc.job_events.collection_version
+    assert rc.search_cache._generation is rc.job_events.collection_version